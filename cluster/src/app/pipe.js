@@ -14,6 +14,11 @@ const axios = require('axios');
 const sharp = require('sharp');
 const {resetFanSpeed} = require("../handlers/nvidiaSettings");
 const os = require('os');
+const path = require('path');
+const { TILE_OVERLAP, TILE_TIMEOUT, tileGrid, tileBox, TileCanvas, scheduleTiles } = require('./tiles');
+
+// must match SHM_DIR in models/src/common/images.py
+const SHM_DIR = '/dev/shm';
 
 function createServerToken(privateKey) {
     let payload = { serverURL: process.env.CLUSTER_SERVER_URL, fullPermissions: true };
@@ -369,15 +374,37 @@ async function handleFindDevice(pipeId, res, fromRemoteServer) {
     };
 }
 
-async function handleLocalInference({ deviceId, requiredVRAM, pipeId, payload, res }) {
+// requests the worker can't start in time are rejected with 503, to be sent to another device
+function sendRejected(res, data) {
+    if (data.queueWait !== undefined) res.setHeader('X-Queue-Wait', data.queueWait);
+    return res.status(503).json({ error: data.error, rejected: data.rejected });
+}
+
+async function handleLocalInference({ deviceId, requiredVRAM, pipeId, payload, res, signal, deadline }) {
     let data;
 
     if (payload['stream']) {
         let i = 0;
-        await unixSocketSend(unixSocketClients[deviceId].socket, { type: CALL_PIPE_REQUEST, pipeId, payload, requiredVRAM }, null, 60, (msg, resolve) => {
+        data = await unixSocketSend(unixSocketClients[deviceId].socket, { type: CALL_PIPE_REQUEST, pipeId, payload, requiredVRAM, deadline }, null, 60, (msg, resolve) => {
             const { type, ...restMSG } = msg;
 
-            if (msg.done) {
+            if (msg.done && (msg.shm || msg.filepath)) {
+                // image of a stream request (after its progress events), sent as a data URL
+                const imagePath = msg.shm ? path.join(SHM_DIR, path.basename(msg.shm)) : msg.filepath;
+                readFile(imagePath)
+                    .then(image => res.write('data: ' + JSON.stringify({
+                        image: 'data:image/png;base64,' + image.toString('base64'),
+                        timeToInference: msg.timeToInference
+                    }) + '\n'))
+                    .catch(e => console.error(`Unable to read ${imagePath}`, e))
+                    .finally(() => {
+                        fs.unlink(imagePath, () => {});
+                        res.write('data: [DONE]' + '\n');
+                        res.end();
+                        resolve();
+                    });
+                return;
+            } else if (msg.done) {
                 res.write('data: [DONE]' + '\n');
                 res.end();
                 resolve();
@@ -386,13 +413,42 @@ async function handleLocalInference({ deviceId, requiredVRAM, pipeId, payload, r
                 res.write('data: ' + JSON.stringify(restMSG) + '\n');
             }
             i++;
-        })
+        }, signal)
+        // answered without a stream, e.g. rejected by the worker's queue
+        if (data?.error && !res.headersSent && !signal?.aborted) {
+            return data.rejected ? sendRejected(res, data) : res.status(500).json({ error: data.error });
+        }
         return;
     } else {
-        data = await unixSocketSend(unixSocketClients[deviceId].socket, { type: CALL_PIPE_REQUEST, pipeId, payload, requiredVRAM });
+        data = await unixSocketSend(unixSocketClients[deviceId].socket, { type: CALL_PIPE_REQUEST, pipeId, payload, requiredVRAM, deadline }, null, 260, null, signal);
     }
 
-    if (data.filepath) {
+    // nobody to answer, the worker was asked to stop the call; an image it still produced is removed
+    if (signal?.aborted) {
+        if (data?.shm) fs.unlink(path.join(SHM_DIR, path.basename(data.shm)), () => {});
+        if (data?.filepath) fs.unlink(data.filepath, () => {});
+        return;
+    }
+
+    if (data.rejected) return sendRejected(res, data);
+    // seconds the request waited in the worker's queue
+    if (data.queueWait !== undefined) res.setHeader('X-Queue-Wait', data.queueWait);
+
+    // deterministic (seeded) requests can be answered from the worker's result cache
+    if (data.cacheHit) res.setHeader('X-Cache', 'HIT');
+
+    if (data.shm) {
+        // image encoded by the worker into shared memory, stream it without touching the disk
+        const shmPath = path.join(SHM_DIR, path.basename(data.shm));
+        res.writeHead(200, { 'Content-Type': 'image/png', ...(data.size && { 'Content-Length': data.size }) });
+        const stream = fs.createReadStream(shmPath);
+        stream.on('close', () => fs.unlink(shmPath, () => {}));
+        stream.on('error', (e) => {
+            console.error(`Unable to read ${shmPath}`, e);
+            res.destroy(e);
+        });
+        return stream.pipe(res);
+    } else if (data.filepath) {
         const filepath = data.filepath;
         const fileData = await readFile(filepath)
         fs.unlink(filepath, () => {})
@@ -432,143 +488,91 @@ async function handleRemoteInference({ deviceId, requiredVRAM, pipeId, payload,
         console.error(`problem with request: ${error.message}`);
     });
 
+    // the remote server cancels the call on its worker when this connection closes
+    res.on('close', () => { if (!res.writableEnded) req.destroy(); });
+
     req.write(JSON.stringify({ deviceId, requiredVRAM, ...payload }));
     req.end();
 }
 
+function requestTile({ device, pipeId, payload, privateKey }) {
+    const { serverURL, deviceId } = device;
+    return new Promise((resolve, reject) => {
+        const options = {
+            hostname: new URL(serverURL).hostname,
+            port: new URL(serverURL).port,
+            path: `/pipeCallFromRemoteServer/${pipeId}`,
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': createServerToken(privateKey),
+                'serverurl': process.env.CLUSTER_SERVER_URL
+            },
+        };
+
+        const req = (serverURL.startsWith('https') ? https : http).request(options, (remoteRes) => {
+            let chunks = [];
+            remoteRes.on('data', (chunk) => {
+                chunks.push(chunk);
+            });
+            remoteRes.on('end', () => {
+                // Combine all the binary chunks into a single Buffer
+                const data = Buffer.concat(chunks);
+                if (remoteRes.statusCode !== 200) {
+                    return reject(new Error(`status ${remoteRes.statusCode}: ${data.toString().slice(0, 200)}`));
+                }
+                resolve(data);
+            });
+            remoteRes.on('error', reject);
+        });
+
+        req.setTimeout(TILE_TIMEOUT, () => req.destroy(new Error('tile timed out')));
+        req.on('error', reject);
+        req.write(JSON.stringify({ ...payload, deviceId }));
+        req.end();
+    });
+}
+
 async function callBatchUpscale({
     deviceId, requiredVRAM, pipeId, payload, adminWSBroadcast, serversWSBroadcast, res, privateKey, transactionJWT, paymentRequired
 }) {
     if (paymentRequired && !(await handlePayment({pipeId, payload, transactionJWT, res}))) return;
-    let devices = findDevicesLoaded(pipeId);
-
-    // Find the largest square number less than or equal to the length of the devices array
-    let maxSquare = Math.floor(Math.sqrt(devices.length)) ** 2;
-
-    // Limit the devices array to the largest square number
-    devices = devices.slice(0, maxSquare);
-
+    // deviceId is only unique within a server
+    const devices = findDevicesLoaded(pipeId).map(device => ({ ...device, key: `${device.serverURL}#${device.deviceId}` }));
 
     // single device handling
-    if (!devices?.length || devices.length < 4) {
+    if (devices.length < 2) {
         return callPipeRequestHandler({ deviceId, requiredVRAM, pipeId, payload, adminWSBroadcast, serversWSBroadcast, res, privateKey });
     }
 
-    function findBestDistribution(numTiles) {
-        let cols = Math.ceil(Math.sqrt(numTiles));
-        let rows = Math.ceil(numTiles / cols);
-
-        // Adjust the columns if we can find a better fit
-        while (numTiles % cols !== 0 && cols > 1) {
-            cols--;
-            rows = Math.ceil(numTiles / cols);
-        }
-
-        return { cols, rows };
+    // the grid depends on the input size, an input the cluster can't fetch is tiled by one device on its own
+    let width, height;
+    try {
+        const { data: input } = await axios.get(payload.image, { responseType: 'arraybuffer' });
+        ({ width, height } = await sharp(input).metadata());
+    } catch (error) {
+        console.error('Unable to read the upscale input size:', error?.message || error);
+    }
+    if (!(width > 0 && height > 0)) {
+        return callPipeRequestHandler({ deviceId, requiredVRAM, pipeId, payload, adminWSBroadcast, serversWSBroadcast, res, privateKey });
     }
-
-    const { rows, cols } = findBestDistribution(devices.length);
-
-    payload.rows = rows;
-    payload.cols = cols;
-
-    // console.log({rows, cols});
-
-    // Prepare all requests and execute them in parallel
-
-    const requests = devices.map((device, index) => {
-        const { serverURL, deviceId } = device;
-        const tile_index = index; // Capture the current tile_index in a closure
-
-        return new Promise((resolve, reject) => {
-            try {
-                const options = {
-                    hostname: new URL(serverURL).hostname,
-                    port: new URL(serverURL).port,
-                    path: `/pipeCallFromRemoteServer/${pipeId}`,
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'Authorization': createServerToken(privateKey),
-                        'serverurl': process.env.CLUSTER_SERVER_URL
-                    },
-                };
-
-                const req = (serverURL.startsWith('https') ? https : http).request(options, (remoteRes) => {
-                    let chunks = [];
-                    remoteRes.on('data', (chunk) => {
-                        chunks.push(chunk);
-                    });
-                    remoteRes.on('end', () => {
-                        // Combine all the binary chunks into a single Buffer
-                        const data = Buffer.concat(chunks);
-                        resolve({tile_index, cols, rows, data});
-                    });
-                });
-
-                req.on('error', (e) => {
-                    reject(e);
-                });
-
-                req.write(JSON.stringify({
-                    ...payload,
-                    tile_index
-                }));
-
-                req.end();
-            } catch (e) {
-                reject(e);
-            }
-        });
-    });
 
     try {
-        // Wait for all requests to complete
-        const responses = await Promise.all(requests);
-
-        const imageBuffer = Buffer.isBuffer(responses[0].data)
-            ? responses[0].data
-            : Buffer.from(responses[0].data, 'binary');
-
-        const tileMeta = await sharp(imageBuffer).metadata();
-
-        const tileWidth = tileMeta.width;
-        const tileHeight = tileMeta.height;
-        const totalWidth = tileWidth * cols;
-        const totalHeight = tileHeight * rows;
-
-        // Create a blank canvas to place the tiles
-        const canvas = sharp({
-            create: {
-                width: totalWidth,
-                height: totalHeight,
-                channels: 4,
-                background: { r: 0, g: 0, b: 0, alpha: 0 }
-            }
-        });
 
-        // Sort responses by tile_index to ensure correct order
-        responses.sort((a, b) => a.tile_index - b.tile_index);
-
-        // Composite the tiles onto the canvas
-        const compositeImages = responses.map(response => {
-            const tileRow = Math.floor(response.tile_index / cols);
-            const tileCol = response.tile_index % cols;
-            const leftOffset = tileCol * tileWidth;
-            const topOffset = tileRow * tileHeight;
-
-            const imageBuffer = Buffer.isBuffer(response.data)
-                ? response.data
-                : Buffer.from(response.data, 'binary');
-
-            return {
-                input: imageBuffer,
-                left: leftOffset,
-                top: topOffset
-            };
+        // many more tiles than devices, devices pull the next tile as soon as they are done
+        const { rows, cols } = tileGrid(width, height, devices.length);
+        const canvas = new TileCanvas(width, height, TILE_OVERLAP, cols);
+
+        await scheduleTiles({
+            numTiles: rows * cols,
+            devices,
+            runTile: (device, tile_index) => requestTile({
+                device, pipeId, privateKey, payload: { ...payload, rows, cols, tile_index, tile_overlap: TILE_OVERLAP }
+            }),
+            onTile: (tile_index, data) => canvas.add(tileBox(width, height, rows, cols, tile_index, TILE_OVERLAP), data),
         });
 
-        const mergedImageBuffer = await canvas.composite(compositeImages).png().toBuffer();
+        const mergedImageBuffer = await canvas.toPNG();
 
         // Send the merged image to the client
         res.writeHead(200, { 'Content-Type': 'image/png' });
@@ -682,11 +686,20 @@ async function callPipeRequestHandler({ fromRemoteServer, deviceId, requiredVRAM
     const queueItem = { pipeId, timeStarted: +new Date(), uuid: generateUUID() }
 
     if (serverURL === process.env.CLUSTER_SERVER_URL && unixSocketClients[deviceId]) {
+        // stops the call on the worker once the client is gone or the deadline passed
+        const controller = new AbortController();
+        const onClose = () => { if (!res.writableEnded) controller.abort('disconnect'); };
+        res.on('close', onClose);
+        // the worker rejects the call if it can't start it by then
+        const deadline = queueItem.timeStarted + 260000;
         try {
             addQueueItem({ serverURL, deviceId, queueItem, adminWSBroadcast, serversWSBroadcast });
-            const timeoutPromise = sleep(260000).then(() => { throw new Error('Timeout'); });
+            const timeoutPromise = sleep(260000).then(() => {
+                controller.abort('timeout');
+                throw new Error('Timeout');
+            });
             await Promise.race([
-                handleLocalInference({ deviceId, requiredVRAM, pipeId, payload, res }),
+                handleLocalInference({ deviceId, requiredVRAM, pipeId, payload, res, signal: controller.signal, deadline }),
                 timeoutPromise
             ]);
         } catch (e) {
@@ -5,7 +5,7 @@ const { listModels, installModel, uninstallModel, isInstallationInProgress } = r
 
 const v8 = require('v8');
 const { unixSocketClients, unixSocketSend } = require("../net/unixSocket");
-const { LOAD_PIPE_REQUEST, DELETE_PIPE_REQUEST } = require("../constants");
+const { LOAD_PIPE_REQUEST, DELETE_PIPE_REQUEST, PRELOAD_PIPE_REQUEST } = require("../constants");
 const { auth, authFromRemoteServer } = require("./auth");
 const { sha256, getGPUType, killPythonWorker} = require("./utils");
 const { signPayload, toPrivateKeyObject } = require("../crypto/crypto");
@@ -199,6 +199,15 @@ function applyRoutes({ app, serverConfig, serverUsers, serverConnections, adminW
         res.status(200).send(data);
     });
 
+    // hint the worker to load the pipe in RAM in the background, sent over socket2 so it never waits behind inference
+    app.get('/preload/:deviceId/:pipeId/', Auth, async (req, res) => {
+        const { pipeId, deviceId } = req.params;
+        if (!unixSocketClients[deviceId]) return res.status(404).send({ error: 'Non existing device' });
+
+        const data = await unixSocketSend(unixSocketClients[deviceId].socket2, { type: PRELOAD_PIPE_REQUEST, pipeId });
+        res.status(200).send(data);
+    });
+
     app.get('/delete_pipe/:deviceId/:pipeId/', Auth, async (req, res) => {
         const { pipeId, deviceId } = req.params;
         const data = await unixSocketSend(unixSocketClients[deviceId].socket, { type: DELETE_PIPE_REQUEST, pipeId })
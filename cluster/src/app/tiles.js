@@ -0,0 +1,221 @@
+const sharp = require('sharp');
+
+// Tile geometry must match tile_box in models/src/common/tiling.py
+
+const TILES_PER_DEVICE = 4;
+const MIN_TILE_SIZE = 128; // input pixels
+const TILE_OVERLAP = 32; // input pixels added on each inner side of a tile
+const TILE_TIMEOUT = 5 * 60 * 1000;
+const MAX_TILE_ATTEMPTS = 3;
+const SLOW_TILE_FACTOR = 2; // a tile running longer than this many times the average is started on an idle device too
+
+// rows x cols grid with about tilesPerDevice tiles per device and roughly square tiles
+function tileGrid(width, height, numDevices, tilesPerDevice = TILES_PER_DEVICE) {
+    const numTiles = numDevices * tilesPerDevice;
+    let cols = Math.max(1, Math.round(Math.sqrt(numTiles * width / height)));
+    cols = Math.min(cols, Math.max(1, Math.floor(width / MIN_TILE_SIZE)));
+    let rows = Math.max(1, Math.ceil(numTiles / cols));
+    rows = Math.min(rows, Math.max(1, Math.floor(height / MIN_TILE_SIZE)));
+    return { rows, cols };
+}
+
+// input pixel box [left, top, right, bottom) of a grid cell extended by overlap on its inner sides
+function tileBox(width, height, rows, cols, tileIndex, overlap) {
+    const row = Math.floor(tileIndex / cols);
+    const col = tileIndex % cols;
+    return [
+        Math.max(Math.floor(col * width / cols) - overlap, 0),
+        Math.max(Math.floor(row * height / rows) - overlap, 0),
+        Math.min(Math.floor((col + 1) * width / cols) + overlap, width),
+        Math.min(Math.floor((row + 1) * height / rows) + overlap, height),
+    ];
+}
+
+// alpha of a tile along one axis: ramps in over its overlap with the tile blended before it, opaque elsewhere
+function leadingRamp(length, start, ramp) {
+    const alpha = Buffer.alloc(length, 255);
+    if (start > 0) {
+        ramp = Math.min(ramp, length);
+        for (let i = 0; i < ramp; i++) alpha[i] = Math.round(255 * (i + 0.5) / ramp);
+    }
+    return alpha;
+}
+
+// raw RGBA pixels of image with a width x height alpha mask
+function withAlpha(image, mask, width, height) {
+    return image.removeAlpha().joinChannel(mask, { raw: { width, height, channels: 1 } }).raw().toBuffer();
+}
+
+function transparent(width, height) {
+    return sharp({ create: { width, height, channels: 4, background: { r: 0, g: 0, b: 0, alpha: 0 } } });
+}
+
+/**
+ * Blends scaled tiles into one image with sharp, off the event loop. Tiles overlap by
+ * 2 * overlap input pixels and ramp in across the whole overlap. As soon as the last
+ * tile of a row arrives, the row is composited left to right into a strip and its
+ * encoded tiles are dropped; toPNG composites the strips top to bottom. Each layer only
+ * fades in over the layer below, so compositing "over" gives the same linear blend as
+ * weighting both sides.
+ */
+class TileCanvas {
+    constructor(width, height, overlap, cols) {
+        this.width = width;
+        this.height = height;
+        this.overlap = overlap;
+        this.cols = cols;
+        this.rows = new Map(); // top -> tiles of a row that is not complete yet
+        this.strips = [];
+        this.scale = null;
+    }
+
+    // box is the input box of an encoded scaled tile, rejects if it can't be decoded
+    async add(box, data) {
+        const { width, height } = await sharp(data).metadata();
+        if (!width || !height) throw new Error('Invalid tile');
+        if (this.scale === null) {
+            this.scale = width / (box[2] - box[0]);
+            this.outWidth = Math.round(this.width * this.scale);
+            this.outHeight = Math.round(this.height * this.scale);
+            this.ramp = Math.round(2 * this.overlap * this.scale);
+        }
+
+        const top = box[1];
+        if (!this.rows.has(top)) this.rows.set(top, []);
+        const row = this.rows.get(top);
+        const tile = { box, data, width, height };
+        row.push(tile);
+        if (row.length < this.cols) return;
+
+        this.rows.delete(top);
+        try {
+            this.strips.push(await this.blendRow(top, row));
+        } catch (e) {
+            // the tile is run again, the rest of the row waits for it
+            this.rows.set(top, row.filter(other => other !== tile));
+            throw e;
+        }
+    }
+
+    async blendRow(top, row) {
+        const { scale, outWidth, ramp } = this;
+        const height = Math.min(row[0].height, this.outHeight - Math.round(top * scale));
+        const layers = await Promise.all(row.sort((a, b) => a.box[0] - b.box[0]).map(async ({ box, data, width }) => {
+            const left = Math.round(box[0] * scale);
+            width = Math.min(width, outWidth - left);
+            const alphaX = leadingRamp(width, box[0], ramp);
+            const mask = Buffer.alloc(width * height);
+            for (let j = 0; j < height; j++) alphaX.copy(mask, j * width);
+            const tile = sharp(data).extract({ left: 0, top: 0, width, height });
+            return { input: await withAlpha(tile, mask, width, height), raw: { width, height, channels: 4 }, left, top: 0 };
+        }));
+        const strip = await transparent(outWidth, height).composite(layers).raw().toBuffer();
+
+        const alphaY = leadingRamp(height, top, ramp);
+        const mask = Buffer.alloc(outWidth * height);
+        for (let j = 0; j < height; j++) mask.fill(alphaY[j], j * outWidth, (j + 1) * outWidth);
+        const input = await withAlpha(sharp(strip, { raw: { width: outWidth, height, channels: 4 } }), mask, outWidth, height);
+        return { input, raw: { width: outWidth, height, channels: 4 }, left: 0, top: Math.round(top * scale) };
+    }
+
+    async toPNG() {
+        if (this.rows.size || !this.strips.length) throw new Error('Missing tiles');
+        // a strip only fades in over the strip above it
+        const strips = this.strips.slice().sort((a, b) => a.top - b.top);
+        return transparent(this.outWidth, this.outHeight).composite(strips).removeAlpha().png().toBuffer();
+    }
+}
+
+/**
+ * Runs numTiles tiles on devices that pull them from a shared queue, so fast devices
+ * take more tiles. A failed tile goes back to the queue for another device, and idle
+ * devices start a copy of a tile that runs much longer than average (the first result
+ * wins). Devices are { key, ... }, runTile(device, tileIndex) returns a promise and
+ * onTile(tileIndex, result) is called as soon as each tile is done.
+ */
+function scheduleTiles({ numTiles, devices, runTile, onTile,
+                         maxAttempts = MAX_TILE_ATTEMPTS, slowTileFactor = SLOW_TILE_FACTOR, pollInterval = 100 }) {
+    const tiles = Array.from({ length: numTiles }, (_, index) => ({ index, attempts: 0, running: new Map(), failedOn: new Set(), done: false }));
+    const queue = tiles.slice();
+    const durations = [];
+    const active = new Set(devices.map(device => device.key));
+    let remaining = numTiles;
+    let failure = null;
+
+    const averageDuration = () => durations.reduce((a, b) => a + b, 0) / durations.length;
+
+    function nextTile(device) {
+        // a tile failed on a device is only retried there when every remaining device failed it
+        const index = queue.findIndex(tile => !tile.failedOn.has(device.key) || [...active].every(key => tile.failedOn.has(key)));
+        if (index !== -1) return queue.splice(index, 1)[0];
+
+        if (!durations.length) return null;
+        const now = Date.now();
+        return tiles.find(tile => !tile.done && tile.running.size === 1 && !tile.running.has(device.key)
+            && now - [...tile.running.values()][0] > slowTileFactor * averageDuration()) || null;
+    }
+
+    return new Promise((resolve, reject) => {
+        const fail = (error) => {
+            if (failure) return;
+            failure = error;
+            reject(error);
+        };
+
+        async function deviceLoop(device) {
+            while (remaining > 0 && !failure) {
+                const tile = nextTile(device);
+                if (!tile) {
+                    await new Promise(r => setTimeout(r, pollInterval));
+                    continue;
+                }
+
+                const started = Date.now();
+                tile.running.set(device.key, started);
+                tile.attempts++;
+                try {
+                    const result = await runTile(device, tile.index);
+                    tile.running.delete(device.key);
+                    if (tile.done || failure) continue;
+                    tile.done = true;
+                    durations.push(Date.now() - started);
+                    try {
+                        await onTile(tile.index, result);
+                    } catch (e) {
+                        // e.g. an undecodable tile, run it again
+                        tile.done = false;
+                        throw e;
+                    }
+                    if (--remaining === 0) resolve();
+                } catch (e) {
+                    tile.running.delete(device.key);
+                    if (tile.done || failure) continue;
+                    console.error(`Tile ${tile.index} failed on device ${device.key}:`, e?.message || e);
+                    tile.failedOn.add(device.key);
+                    if (tile.attempts >= maxAttempts) return fail(e);
+                    if (!tile.running.size && !queue.includes(tile)) queue.push(tile);
+                    // a device that fails twice in a row is left out
+                    if (device.failed) {
+                        active.delete(device.key);
+                        if (!active.size) fail(e);
+                        return;
+                    }
+                    device.failed = true;
+                    continue;
+                }
+                device.failed = false;
+            }
+        }
+
+        devices.forEach(device => deviceLoop({ ...device, failed: false }).catch(fail));
+    });
+}
+
+module.exports = {
+    TILE_OVERLAP,
+    TILE_TIMEOUT,
+    tileGrid,
+    tileBox,
+    TileCanvas,
+    scheduleTiles,
+}
@@ -18,6 +18,12 @@ const MESSAGES = {
     LOAD_PIPE_REQUEST: 'LOAD_PIPE_REQUEST',
     LOAD_PIPE_RESPONSE: 'LOAD_PIPE_RESPONSE',
     STREAM: 'STREAM',
+    EVICTION_STATS_REQUEST: 'EVICTION_STATS_REQUEST',
+    EVICTION_STATS_RESPONSE: 'EVICTION_STATS_RESPONSE',
+    PRELOAD_PIPE_REQUEST: 'PRELOAD_PIPE_REQUEST',
+    PRELOAD_PIPE_RESPONSE: 'PRELOAD_PIPE_RESPONSE',
+    CANCEL_PIPE_REQUEST: 'CANCEL_PIPE_REQUEST',
+    CANCEL_PIPE_RESPONSE: 'CANCEL_PIPE_RESPONSE',
 }
 
 
@@ -0,0 +1,159 @@
+let msgpack = null;
+try {
+    msgpack = require('@msgpack/msgpack');
+} catch (e) {
+    // optional, falls back to JSON encoded frames
+}
+
+/**
+ * Framed messages start with FRAME_MAGIC, which can never start a legacy newline
+ * delimited JSON message, so the Python worker accepts both on the same socket.
+ *
+ * frame = header | body | attachmentLength | attachment | ...
+ * header = magic (u8), version (u8), encoding (u8), attachments count (u8), body length (u32 BE)
+ */
+const FRAME_MAGIC = 0xfb;
+const PROTOCOL_VERSION = 1;
+const HEADER_SIZE = 8;
+const ENCODING = { JSON: 0, MSGPACK: 1 };
+
+// UNIX_SOCKET_FRAMING=framed enables frames, anything else keeps the newline protocol
+// UNIX_SOCKET_ENCODING=msgpack encodes frame bodies with msgpack when the package is installed
+const socketProtocol = {
+    framed: process.env.UNIX_SOCKET_FRAMING === 'framed',
+    encoding: process.env.UNIX_SOCKET_ENCODING === 'msgpack' && msgpack ? ENCODING.MSGPACK : ENCODING.JSON
+};
+
+if (process.env.UNIX_SOCKET_ENCODING === 'msgpack' && !msgpack) {
+    console.log('UNIX_SOCKET_ENCODING=msgpack requires @msgpack/msgpack, using JSON');
+}
+
+function encodeBody(msg, encoding) {
+    if (encoding === ENCODING.MSGPACK) return Buffer.from(msgpack.encode(msg));
+    return Buffer.from(JSON.stringify(msg));
+}
+
+function decodeBody(body, encoding) {
+    if (encoding === ENCODING.MSGPACK) return msgpack.decode(body);
+    return JSON.parse(body.toString());
+}
+
+function encodeFrame(msg, attachments = [], encoding = ENCODING.JSON) {
+    const body = encodeBody(msg, encoding);
+    const header = Buffer.alloc(HEADER_SIZE);
+    header.writeUInt8(FRAME_MAGIC, 0);
+    header.writeUInt8(PROTOCOL_VERSION, 1);
+    header.writeUInt8(encoding, 2);
+    header.writeUInt8(attachments.length, 3);
+    header.writeUInt32BE(body.length, 4);
+
+    const parts = [header, body];
+    for (const attachment of attachments) {
+        const length = Buffer.alloc(4);
+        length.writeUInt32BE(attachment.length, 0);
+        parts.push(length, attachment);
+    }
+    return Buffer.concat(parts);
+}
+
+function encodeMessage(msg, attachments = []) {
+    if (socketProtocol.framed) return encodeFrame(msg, attachments, socketProtocol.encoding);
+    return JSON.stringify(msg) + '\n';
+}
+
+// Returns {body, encoding, attachments, offset} for a complete frame or null if more data is needed
+function readFrame(buffer, offset) {
+    if (buffer.length - offset < HEADER_SIZE) return null;
+
+    const version = buffer.readUInt8(offset + 1);
+    if (version !== PROTOCOL_VERSION) throw new Error(`Unsupported protocol version ${version}`);
+
+    const encoding = buffer.readUInt8(offset + 2);
+    const attachmentsCount = buffer.readUInt8(offset + 3);
+    const bodyLength = buffer.readUInt32BE(offset + 4);
+
+    let position = offset + HEADER_SIZE;
+    if (buffer.length < position + bodyLength) return null;
+    const body = buffer.subarray(position, position + bodyLength);
+    position += bodyLength;
+
+    const attachments = [];
+    for (let i = 0; i < attachmentsCount; i++) {
+        if (buffer.length < position + 4) return null;
+        const attachmentLength = buffer.readUInt32BE(position);
+        position += 4;
+        if (buffer.length < position + attachmentLength) return null;
+        attachments.push(Buffer.from(buffer.subarray(position, position + attachmentLength)));
+        position += attachmentLength;
+    }
+
+    return { body, encoding, attachments, offset: position };
+}
+
+function decodeFrame(frame) {
+    const message = decodeBody(frame.body, frame.encoding);
+    if (frame.attachments.length) message.attachments = frame.attachments;
+    return message;
+}
+
+function decodeLine(line) {
+    const message = JSON.parse(line);
+    if (message.attachmentsEncoding === 'base64') {
+        message.attachments = message.attachments.map(attachment => Buffer.from(attachment, 'base64'));
+        delete message.attachmentsEncoding;
+    }
+    return message;
+}
+
+/**
+ * Buffers socket chunks and calls onMessage once per complete message,
+ * regardless of how the messages were fragmented or merged by the socket.
+ * A message that fails to decode or to be handled is passed to onError and
+ * dropped, the buffer is already past it so the following ones still arrive.
+ */
+function createDecoder(onMessage, onError = (e) => console.log('Unable to decode message', e)) {
+    let buffer = Buffer.alloc(0);
+
+    return (chunk) => {
+        buffer = buffer.length ? Buffer.concat([buffer, chunk]) : chunk;
+
+        while (buffer.length) {
+            let decode;
+            if (buffer[0] === FRAME_MAGIC) {
+                let frame;
+                try {
+                    frame = readFrame(buffer, 0);
+                } catch (e) {
+                    // the length of a frame with an unknown header can't be trusted, resync on the next chunk
+                    buffer = Buffer.alloc(0);
+                    onError(e);
+                    break;
+                }
+                if (!frame) break;
+                buffer = buffer.subarray(frame.offset);
+                decode = () => decodeFrame(frame);
+            } else {
+                const end = buffer.indexOf(0x0a);
+                if (end === -1) break;
+                const line = buffer.toString('utf8', 0, end).trim();
+                buffer = buffer.subarray(end + 1);
+                if (!line) continue;
+                decode = () => decodeLine(line);
+            }
+
+            try {
+                onMessage(decode());
+            } catch (e) {
+                onError(e);
+            }
+        }
+    };
+}
+
+module.exports = {
+    ENCODING,
+    socketProtocol,
+    encodeFrame,
+    encodeMessage,
+    createDecoder
+}
@@ -1,6 +1,7 @@
 const net = require('net');
 const crypto = require('crypto');
-const { GET_PIPES_REQUEST, GET_PIPES_RESPONSE, STREAM } = require('../constants');
+const { GET_PIPES_REQUEST, GET_PIPES_RESPONSE, STREAM, CALL_PIPE_REQUEST, CANCEL_PIPE_REQUEST } = require('../constants');
+const { createDecoder, encodeMessage } = require('./framing');
 
 
 const unixSocketClients = {};
@@ -29,59 +30,69 @@ async function unixSocketBroadcast(message, socketSuffix = '') {
     return await Promise.all(promises);
 }
 
-async function unixSocketSend(socket, msg, parrentResolve = null, timeout = 260, callback = null) {
+// Lets the worker stop a call nobody waits for anymore, at its next denoising step or token
+function cancelPipeRequest(socket, requestUUID, reason) {
+    socket.write(encodeMessage({ type: CANCEL_PIPE_REQUEST, requestUUID, reason, uuid: generateUUID() }));
+}
+
+async function unixSocketSend(socket, msg, parrentResolve = null, timeout = 260, callback = null, signal = null) {
     const promise = new Promise((resolve, reject) => {
         msg.uuid = generateUUID();
         
         const deviceId = socket.CUDA_VISIBLE_DEVICES;
+        if (signal?.aborted) return resolve({ error: 'Request cancelled' });
 
-        // Set up the timeout
-        const timer = setTimeout(() => {
+        const abandon = (reason, error) => {
+            if (!requestsQ[deviceId]?.[msg.uuid]) return;
+            clearTimeout(requestsQ[deviceId][msg.uuid].timer);
             delete requestsQ[deviceId][msg.uuid];
-            resolve({error: `Request timed out after ${timeout} seconds`});
-        }, timeout*1000);
+            if (msg.type === CALL_PIPE_REQUEST) cancelPipeRequest(socket, msg.uuid, reason);
+            resolve({ error });
+        }
+
+        // Set up the timeout
+        const timer = setTimeout(() => abandon('timeout', `Request timed out after ${timeout} seconds`), timeout*1000);
         
         requestsQ[deviceId] = requestsQ[deviceId] || {};
 
-        requestsQ[deviceId][msg.uuid] = {resolve, parrentResolve, callback}
+        requestsQ[deviceId][msg.uuid] = {resolve, parrentResolve, callback, timer}
         if (msg?.pipeId) requestsQ[deviceId][msg.uuid].pipeId = msg.pipeId
 
+        // e.g. the HTTP client disconnected
+        signal?.addEventListener('abort', () => abandon(signal.reason || 'aborted', 'Request cancelled'), { once: true });
+
         if (socket.listenerCount('data') === 0) {
-            socket.on('data', (data) => {        
-                if (data?.toString()?.length < 20000) {
-                    if (!data?.toString()?.includes(GET_PIPES_RESPONSE)) {
-                        console.log(getTime() + ' Received:', data.toString());
-                    }                    
+            const decode = createDecoder((response) => {
+                if (response?.type !== GET_PIPES_RESPONSE) {
+                    const { attachments, ...loggable } = response;
+                    const text = JSON.stringify(loggable);
+                    if (text.length < 20000) console.log(getTime() + ' Received:', text);
                 }
-                const messages = data?.toString().split('\n');
-
-                messages.forEach(responseMessage => {
-                    if (!responseMessage) return;
-                    // console.log('responseMessage', responseMessage);
-                    const response = JSON.parse(responseMessage);
-
-                    const msgResolve = () => {
-                        requestsQ[deviceId][response.uuid]?.resolve(response);
-                        requestsQ[deviceId][response.uuid]?.parrentResolve?.(response);
-                        clearTimeout(timer)
-                        delete requestsQ[deviceId][response.uuid];
-                    }
-
-                    /**
-                     * RESPONSE HANDLERS 
-                     */
-                    if (response?.type === STREAM && requestsQ?.[deviceId]?.[response?.uuid]?.callback) {
-                        requestsQ[deviceId][response?.uuid].callback(response, msgResolve)
-                    }
-                                        
-                    if (requestsQ[deviceId][response.uuid] && response?.type !== STREAM) {
-                        msgResolve();
-                    }
-                });
-            });
+
+                const msgResolve = () => {
+                    const request = requestsQ[deviceId][response.uuid];
+                    clearTimeout(request?.timer);
+                    request?.resolve(response);
+                    request?.parrentResolve?.(response);
+                    delete requestsQ[deviceId][response.uuid];
+                }
+
+                /**
+                 * RESPONSE HANDLERS 
+                 */
+                if (response?.type === STREAM && requestsQ?.[deviceId]?.[response?.uuid]?.callback) {
+                    requestsQ[deviceId][response?.uuid].callback(response, msgResolve)
+                }
+                                    
+                if (requestsQ[deviceId][response.uuid] && response?.type !== STREAM) {
+                    msgResolve();
+                }
+            }, (e) => console.log(getTime() + ' Unable to decode message', e));
+
+            socket.on('data', decode);
         }
 
-        socket.write(JSON.stringify(msg) + '\n');
+        socket.write(encodeMessage(msg));
     });
 
     return promise;
@@ -118,6 +129,7 @@ module.exports = {
     unixSocketClients,
     unixSocketConnect,
     unixSocketSend,
+    cancelPipeRequest,
     requestsQ,
     unixSocketBroadcast,
     generateUUID
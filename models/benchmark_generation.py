@@ -0,0 +1,135 @@
+# Continuous batching engine against one-request-at-a-time generate(), on CPU with a
+# tiny random Llama, with and without the prompt prefix cache. Greedy outputs must match.
+# usage: python models/benchmark_generation.py
+import os
+import sys
+import time
+import random
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from common.generation import GenerationEngine, GenerationRequest
+from common.prefix_cache import PrefixCache
+
+REQUESTS = 24
+SYSTEM_PROMPT_TOKENS = 384
+MAX_BATCH_SIZE = 8
+EOS_TOKEN_ID = 2
+
+
+class ByteTokenizer:
+    def decode(self, ids, skip_special_tokens=False):
+        return bytes(i % 256 for i in ids).decode('latin-1')
+
+
+def tiny_llama():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=512,
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=1024,
+        eos_token_id=EOS_TOKEN_ID,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def workload():
+    random.seed(0)
+    return [
+        ([random.randrange(3, 512) for _ in range(random.randint(4, 64))], random.randint(16, 96))
+        for _ in range(REQUESTS)
+    ]
+
+
+def chat_workload():
+    # same long system prompt, short user turns
+    random.seed(1)
+    system = [random.randrange(3, 512) for _ in range(SYSTEM_PROMPT_TOKENS)]
+    return [
+        (system + [random.randrange(3, 512) for _ in range(random.randint(4, 32))], random.randint(8, 32))
+        for _ in range(REQUESTS)
+    ]
+
+
+def run_sequential(model, requests):
+    outputs = []
+    with torch.inference_mode():
+        for input_ids, max_new_tokens in requests:
+            # min_new_tokens keeps generate() from stopping on a random eos, like the engine below
+            generated = model.generate(
+                torch.tensor([input_ids]),
+                attention_mask=torch.ones((1, len(input_ids)), dtype=torch.long),
+                do_sample=False,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                pad_token_id=0,
+            )
+            outputs.append(generated[0, len(input_ids):].tolist())
+    return outputs
+
+
+def run_engine(model, requests, prefix_cache=None):
+    engine = GenerationEngine(model, ByteTokenizer(), MAX_BATCH_SIZE, device='cpu', prefix_cache=prefix_cache)
+    submitted = []
+    for input_ids, max_new_tokens in requests:
+        request = GenerationRequest(
+            input_ids,
+            lambda request, error=None: error and print(f'failed: {error}'),
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_ids=[EOS_TOKEN_ID],
+        )
+        engine.submit(request)
+        submitted.append(request)
+    for request in submitted:
+        request.done.wait()
+    engine.stop()
+    return [request.generated for request in submitted], engine.steps
+
+
+def compare(name, model, requests, prefix_cache=None):
+    tokens = sum(max_new_tokens for _, max_new_tokens in requests)
+    print(name)
+
+    start = time.time()
+    expected = run_sequential(model, requests)
+    sequential_time = time.time() - start
+    print(f'  {"sequential generate()":<26} {tokens / sequential_time:>10.0f} tokens/s')
+
+    start = time.time()
+    outputs, steps = run_engine(model, requests)
+    engine_time = time.time() - start
+    print(f'  {"continuous batching":<26} {tokens / engine_time:>10.0f} tokens/s  ({steps} decode steps, batch {MAX_BATCH_SIZE})')
+
+    if prefix_cache:
+        start = time.time()
+        cached_outputs, _ = run_engine(model, requests, prefix_cache)
+        cached_time = time.time() - start
+        stats = prefix_cache.stats()
+        print(f'  {"+ prefix cache":<26} {tokens / cached_time:>10.0f} tokens/s  '
+              f'({stats["cachedTokens"]} cached / {stats["computedTokens"]} computed prompt tokens)')
+        outputs_to_check = [outputs, cached_outputs]
+    else:
+        outputs_to_check = [outputs]
+
+    for checked in outputs_to_check:
+        mismatches = [i for i, (a, b) in enumerate(zip(expected, checked)) if a != b]
+        if mismatches:
+            print(f'greedy outputs differ for requests {mismatches}')
+            sys.exit(1)
+    print(f'  greedy outputs match for all {len(requests)} requests')
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(os.cpu_count())
+    model = tiny_llama()
+    compare('random prompts', model, workload())
+    compare(f'shared {SYSTEM_PROMPT_TOKENS} token system prompt', model, chat_workload(), PrefixCache(256 * 1024 ** 2))
@@ -0,0 +1,74 @@
+# Throughput of the unix socket protocols between the cluster and the pipe worker
+# usage: python models/benchmark_protocol.py
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+from common.protocol import SocketChannel, ENCODING_JSON, ENCODING_MSGPACK, msgpack
+
+STREAM_MESSAGES = 20000
+IMAGE_MESSAGES = 200
+IMAGE_SIZE = 1024 * 1024
+
+
+def stream_message(i):
+    return {'id': i, 'content': 'token ', 'type': 'STREAM', 'uuid': '18f3a5c2b10-ab12'}
+
+
+def image_message(i):
+    return {'type': 'CALL_PIPE_RESPONSE', 'CUDA_VISIBLE_DEVICES': '0', 'pipeId': 'stabilityai--sdxl-turbo--default',
+            'uuid': f'18f3a5c2b10-{i}', 'timeToInference': 1.23}
+
+
+def run(name, framed, encoding, messages, attachment=None):
+    reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    sender = SocketChannel(writer)
+    sender.framed = framed
+    sender.encoding = encoding
+    receiver = SocketChannel(reader)
+
+    def produce():
+        for message in messages:
+            sender.send(message, [attachment] if attachment else None)
+
+    start = time.time()
+    thread = threading.Thread(target=produce)
+    thread.start()
+
+    received = 0
+    while received < len(messages):
+        received += len(receiver.receive())
+
+    elapsed = time.time() - start
+    thread.join()
+    reader.close()
+    writer.close()
+
+    payload_mb = (len(json.dumps(messages[0])) + len(attachment or b'')) * len(messages) / 1024 ** 2
+    print(f'{name:<28} {len(messages) / elapsed:>12.0f} msg/s {payload_mb / elapsed:>10.1f} MB/s')
+
+
+if __name__ == '__main__':
+    protocols = [('newline json', False, ENCODING_JSON), ('framed json', True, ENCODING_JSON)]
+    if msgpack is not None:
+        protocols.append(('framed msgpack', True, ENCODING_MSGPACK))
+    else:
+        print('msgpack is not installed, skipping framed msgpack')
+
+    streams = [stream_message(i) for i in range(STREAM_MESSAGES)]
+    images = [image_message(i) for i in range(IMAGE_MESSAGES)]
+    image = os.urandom(IMAGE_SIZE)
+
+    print(f'{STREAM_MESSAGES} STREAM messages')
+    for name, framed, encoding in protocols:
+        run(name, framed, encoding, streams)
+
+    print(f'{IMAGE_MESSAGES} responses with a {IMAGE_SIZE // 1024} KB image attachment')
+    for name, framed, encoding in protocols:
+        run(name, framed, encoding, images, image)
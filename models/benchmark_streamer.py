@@ -0,0 +1,125 @@
+# JSONStreamer cost per generated token: the previous streamer that decodes the whole
+# token cache up to the next newline, against the incremental detokenizer, with and
+# without coalescing STREAM messages. Messages go through a SocketChannel.
+# usage: python models/benchmark_streamer.py [tokenizer name or path]
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+from transformers import AutoTokenizer
+from common.protocol import SocketChannel
+from common.utils import JSONStreamer
+
+TOKENIZER = 'meta-llama/Meta-Llama-3-8B-Instruct'
+PARAGRAPH_TOKENS = 4000
+
+SENTENCES = [
+    "The scheduler keeps every device busy by pulling the next request from the queue.",
+    "Überschriften, naïve café prices and emoji like 🚀 or 🤖 take several bytes.",
+    "Long answers without line breaks are the worst case for re-decoding the cache.",
+    "数据中心的每个节点都运行一个工作进程，模型在显存中常驻。",
+]
+
+
+class PreviousStreamer(JSONStreamer):
+    """put/end of JSONStreamer before the incremental detokenizer"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.print_len = 0
+
+    def put(self, value):
+        if len(value.shape) > 1:
+            value = value[0]
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        self.token_cache.extend(value.tolist())
+        text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
+
+        if text.endswith("\n"):
+            printable_text = text[self.print_len:]
+            self.token_cache = []
+            self.print_len = 0
+        elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
+            printable_text = text[self.print_len:]
+            self.print_len += len(printable_text)
+        else:
+            printable_text = text[self.print_len:text.rfind(" ") + 1]
+            self.print_len += len(printable_text)
+
+        if printable_text:
+            self._count += 1
+            response = json.dumps({"id": self._count, "content": printable_text, "type": "STREAM", "uuid": self._request_uuid})
+            self._send_function(self._connection, response)
+
+    def end(self):
+        if self.token_cache:
+            remaining_text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)[self.print_len:]
+            if remaining_text:
+                self._count += 1
+                response = json.dumps({"id": self._count, "content": remaining_text, "type": "STREAM", "uuid": self._request_uuid})
+                self._send_function(self._connection, response)
+        response = json.dumps({"done": self._count, "type": "STREAM", "uuid": self._request_uuid})
+        self._send_function(self._connection, response)
+
+    def _is_chinese_char(self, cp):
+        return 0x4E00 <= cp <= 0x9FFF or 0x3400 <= cp <= 0x4DBF or 0xF900 <= cp <= 0xFAFF
+
+
+def paragraph(tokenizer):
+    tokens = []
+    while len(tokens) < PARAGRAPH_TOKENS:
+        for sentence in SENTENCES:
+            tokens.extend(tokenizer(" " + sentence, add_special_tokens=False)['input_ids'])
+    return tokens[:PARAGRAPH_TOKENS]
+
+
+def run(name, streamer_class, tokenizer, tokens, **kwargs):
+    reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    sender = SocketChannel(writer)
+    receiver = SocketChannel(reader)
+    received = []
+
+    def consume():
+        while True:
+            for message in receiver.receive():
+                received.append(message)
+                if 'done' in message:
+                    return
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    streamer = streamer_class(sender, lambda connection, msg: connection.send(msg), 'uuid', tokenizer=tokenizer, **kwargs)
+    start = time.time()
+    streamer.put(torch.tensor([[1, 2, 3]]))  # prompt
+    for token in tokens:
+        streamer.put(torch.tensor([token]))
+    streamer.end()
+    elapsed = time.time() - start
+    thread.join()
+    reader.close()
+    writer.close()
+
+    text = ''.join(message['content'] for message in received if 'content' in message)
+    expected = tokenizer.decode(tokens)
+    print(f'{name:<34} {elapsed * 1e6 / len(tokens):8.1f} us/token {len(received) - 1:6d} messages'
+          f'  text {"matches" if text == expected else "DIFFERS"}')
+
+
+if __name__ == '__main__':
+    tokenizer = AutoTokenizer.from_pretrained(sys.argv[1] if len(sys.argv) > 1 else TOKENIZER)
+    tokens = paragraph(tokenizer)
+    print(f'{len(tokens)} tokens without a newline')
+    run('previous streamer', PreviousStreamer, tokenizer, tokens)
+    run('incremental', JSONStreamer, tokenizer, tokens)
+    run('incremental, 256 byte messages', JSONStreamer, tokenizer, tokens, flush_bytes=256)
+    run('incremental, 50 ms messages', JSONStreamer, tokenizer, tokens, flush_interval=0.05)
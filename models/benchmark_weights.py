@@ -0,0 +1,56 @@
+# Host RAM load time (what LOAD_PIPE_RESPONSE reports as timeToLoadInRAM) of a model:
+# from_pretrained from the HF cache, against load_model from the consolidated, already
+# cast snapshot it saves. Page cache effects are included, run it with a cold and a warm
+# cache (echo 3 > /proc/sys/vm/drop_caches) to see both.
+# usage: python models/benchmark_weights.py [repo] [subfolder] [dtype] [variant]
+import os
+import sys
+import time
+import tempfile
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+os.environ.setdefault('WEIGHTS_SNAPSHOT_DIR', tempfile.mkdtemp(prefix='openkbs-snapshots-'))
+
+from common.weights import load_model, save_snapshot, snapshot_dir
+
+REPO = 'stabilityai/stable-diffusion-xl-base-1.0'
+SUBFOLDER = 'unet'
+DTYPE = 'float16'
+VARIANT = 'fp16'
+
+
+def model_class(repo, subfolder):
+    if subfolder in ('unet', 'vae'):
+        from diffusers import AutoencoderKL, UNet2DConditionModel
+        return UNet2DConditionModel if subfolder == 'unet' else AutoencoderKL
+    from transformers import AutoModel, AutoModelForCausalLM
+    return AutoModel if subfolder else AutoModelForCausalLM
+
+
+def timed(name, load):
+    start = time.time()
+    model = load()
+    loaded_in_ram = round(time.time() - start, 2)
+    size = sum(tensor.numel() * tensor.element_size() for tensor in model.state_dict().values())
+    print(f'{name:<28} {loaded_in_ram:7.2f}s  {size / loaded_in_ram / 2**30 if loaded_in_ram else 0:6.2f} GB/s')
+    return model
+
+
+if __name__ == '__main__':
+    repo = sys.argv[1] if len(sys.argv) > 1 else REPO
+    subfolder = (sys.argv[2] if len(sys.argv) > 2 else SUBFOLDER) or None
+    dtype = getattr(torch, sys.argv[3] if len(sys.argv) > 3 else DTYPE)
+    cls = model_class(repo, subfolder)
+    variant = (sys.argv[4] if len(sys.argv) > 4 else VARIANT) or None
+    kwargs = {'subfolder': subfolder} if subfolder else {}
+    if variant:
+        kwargs['variant'] = variant
+
+    model = timed('from_pretrained', lambda: cls.from_pretrained(repo, torch_dtype=dtype, **kwargs))
+    directory = snapshot_dir(repo, subfolder, dtype)
+    if not os.path.exists(directory):
+        save_snapshot(directory, model)
+    del model
+    timed('load_model (snapshot)', lambda: load_model(cls, repo, subfolder, dtype))
@@ -1,36 +1,73 @@
 # from diffusers import StableDiffusionXLPipeline
 import torch
 import time
-import json
 import os
-from common.stablediffusion import extract_params_sdxl
+from common.stablediffusion import extract_params_sdxl, batch_key_sdxl, result_key_sdxl, call_batch_sdxl
+from common.prompt_cache import encode_prompts_sdxl
+from common.images import image_response
+from common.components import SDXL_BASE, sdxl_components
+from common.progress import progress_kwargs
+from common.compile_cache import SDXL_BUCKETS, warmup_text_to_image
 from diffusers import DiffusionPipeline, DDIMScheduler
 from huggingface_hub import hf_hub_download
 
-base_model_id = "stabilityai/stable-diffusion-xl-base-1.0"
+base_model_id = SDXL_BASE
 repo_name = "ByteDance/Hyper-SD"
 ckpt_name = "Hyper-SDXL-2steps-lora.safetensors"
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
-def load():
+# resolutions compiled and warmed at load with COMPILE_TORCH, requests are snapped to the nearest one
+COMPILE_BUCKETS = SDXL_BUCKETS
+
+def load_in_ram():
     start_in_ram = time.time()
 
-    pipe = DiffusionPipeline.from_pretrained(base_model_id, torch_dtype=torch.float16, variant="fp16")
+    # VAE and text encoders are shared with the other SDXL pipes, the UNet is loaded by from_pretrained
+    # outside of the component registry, so the fused copy is never handed out as the SDXL UNet
+    pipe = DiffusionPipeline.from_pretrained(
+        base_model_id, **sdxl_components(('vae', 'text_encoder', 'text_encoder_2'), torch_dtype=torch.float16),
+        torch_dtype=torch.float16, variant="fp16"
+    )
+
+    # load_lora_weights would also put adapters on the shared text encoders, the LoRA goes into the UNet only
+    state_dict, network_alphas = pipe.lora_state_dict(hf_hub_download(repo_name, ckpt_name), unet_config=pipe.unet.config)
+    pipe.load_lora_into_unet(state_dict, network_alphas=network_alphas, unet=pipe.unet, _pipeline=pipe)
+    pipe.fuse_lora(components=['unet'])
+    # the fused weights stay, the adapter layers go
+    pipe.unload_lora_weights()
 
     if os.environ.get("COMPILE_TORCH"):
         pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
 
-    pipe.load_lora_weights(hf_hub_download(repo_name, ckpt_name))
-    pipe.fuse_lora()
-
     loaded_in_ram = round(time.time() - start_in_ram, 2) 
-    start_in_vram = time.time()        
-    pipe.to('cuda')
-    loaded_in_vram = round(time.time() - start_in_vram, 2)
-    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
+    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram}
+
+def load():
+    pipe = load_in_ram()
+    start_in_vram = time.time()
+    pipe['pipe'].to('cuda')
+    pipe['loaded_in_vram'] = round(time.time() - start_in_vram, 2)
+    return pipe
+
+def warmup(pipe, height, width):
+    # same step count and (disabled) guidance as the requests, the batch size of the graph depends on it
+    warmup_text_to_image(pipe['pipe'], height, width, guidance_scale=0, num_inference_steps=2)
+
+# compatible requests (same size, steps, guidance) queued within BATCH_WAIT_MS are denoised together
+BATCH_MAX_SIZE = 4
+BATCH_WAIT_MS = 50
+
+def batch_key(payload):
+    return batch_key_sdxl(payload)
+
+def result_key(payload):
+    return result_key_sdxl(payload)
+
+def call_batch(payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+    return call_batch_sdxl(pipe['pipe'], payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId, defaults={'guidance_scale': 0, 'num_inference_steps': 2}, cache_prompts=True)
 
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
     config_dict = extract_params_sdxl(payload)
 
     seed = payload.get('seed')
@@ -43,16 +80,13 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
 
     start_inference = time.time()
     # image=pipe(prompt=prompt, num_inference_steps=2, guidance_scale=0).images[0]
-    image = pipe['pipe'](**config_dict).images[0]
-    filepath = f"tmp_images/{requestUUID}.png"
-    image.save(filepath)
+    config_dict = encode_prompts_sdxl(pipe['pipe'], pipeId, config_dict)
+    image = pipe['pipe'](**config_dict, **progress_kwargs(streamer, payload, config_dict)).images[0]
     time_inference = round(time.time() - start_inference, 2)
-    response = json.dumps({
+    return image_response(image, requestUUID, {
         'type': 'CALL_PIPE_RESPONSE',
         'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
         'pipeId': pipeId,
         'uuid': requestUUID,
         'timeToInference': time_inference,
-        'filepath': filepath
-    })
-    return response
+    }, streamer=streamer)
@@ -2,12 +2,16 @@ from diffusers import DiffusionPipeline
 
 import torch
 import time
-import json
 import os
-from common.stablediffusion import extract_params_sdxl
+from common.stablediffusion import extract_params_sdxl, batch_key_sdxl, result_key_sdxl, call_batch_sdxl
+from common.images import image_response
+from common.progress import progress_kwargs
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
+# weights are placed by accelerate (cpu offload), can't be demoted to the host tier
+HOST_TIER = False
+
 
 def load():
     start_in_ram = time.time()
@@ -22,7 +26,20 @@ def load():
     loaded_in_vram = round(time.time() - start_in_vram, 2)
     return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
 
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+# compatible requests (same size, steps, guidance) queued within BATCH_WAIT_MS are denoised together
+BATCH_MAX_SIZE = 2
+BATCH_WAIT_MS = 50
+
+def batch_key(payload):
+    return batch_key_sdxl(payload)
+
+def result_key(payload):
+    return result_key_sdxl(payload)
+
+def call_batch(payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+    return call_batch_sdxl(pipe['pipe'], payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId)
+
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
     config_dict = extract_params_sdxl(payload)
 
     seed = payload.get('seed')
@@ -31,16 +48,12 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
         config_dict['generator'].manual_seed(int(payload['seed']))
 
     start_inference = time.time()
-    image = pipe['pipe'](**config_dict).images[0]
-    filepath = f"tmp_images/{requestUUID}.png"
-    image.save(filepath)
+    image = pipe['pipe'](**config_dict, **progress_kwargs(streamer, payload, config_dict)).images[0]
     time_inference = round(time.time() - start_inference, 2)
-    response = json.dumps({
+    return image_response(image, requestUUID, {
         'type': 'CALL_PIPE_RESPONSE',
         'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
         'pipeId': pipeId,
         'uuid': requestUUID,
         'timeToInference': time_inference,
-        'filepath': filepath
-    })
-    return response
+    }, streamer=streamer)
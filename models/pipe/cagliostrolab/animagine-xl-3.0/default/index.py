@@ -1,6 +1,5 @@
 import torch
 import time
-import json
 import os
 from diffusers import (
     StableDiffusionXLPipeline,
@@ -8,12 +7,15 @@ from diffusers import (
     AutoencoderKL
 )
 
-from common.stablediffusion import extract_params_sdxl
+from common.stablediffusion import extract_params_sdxl, batch_key_sdxl, result_key_sdxl, call_batch_sdxl
+from common.prompt_cache import encode_prompts_sdxl
+from common.images import image_response
+from common.progress import progress_kwargs
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
 
-def load():
+def load_in_ram():
     start_in_ram = time.time()
 
     # Load VAE component
@@ -34,16 +36,29 @@ def load():
     pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
 
     loaded_in_ram = round(time.time() - start_in_ram, 2) 
-    
-    start_in_vram = time.time()        
-    
-    pipe.to('cuda')
-    
-    loaded_in_vram = round(time.time() - start_in_vram, 2)
-    
-    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
-
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram}
+
+def load():
+    pipe = load_in_ram()
+    start_in_vram = time.time()
+    pipe['pipe'].to('cuda')
+    pipe['loaded_in_vram'] = round(time.time() - start_in_vram, 2)
+    return pipe
+
+# compatible requests (same size, steps, guidance) queued within BATCH_WAIT_MS are denoised together
+BATCH_MAX_SIZE = 4
+BATCH_WAIT_MS = 50
+
+def batch_key(payload):
+    return batch_key_sdxl(payload)
+
+def result_key(payload):
+    return result_key_sdxl(payload)
+
+def call_batch(payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+    return call_batch_sdxl(pipe['pipe'], payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId, cache_prompts=True)
+
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
     config_dict = extract_params_sdxl(payload)
 
     seed = payload.get('seed')
@@ -52,16 +67,13 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
         config_dict['generator'].manual_seed(int(payload['seed']))
 
     start_inference = time.time()
-    image = pipe['pipe'](**config_dict).images[0]
-    filepath = f"tmp_images/{requestUUID}.png"
-    image.save(filepath)
+    config_dict = encode_prompts_sdxl(pipe['pipe'], pipeId, config_dict)
+    image = pipe['pipe'](**config_dict, **progress_kwargs(streamer, payload, config_dict)).images[0]
     time_inference = round(time.time() - start_inference, 2)
-    response = json.dumps({
+    return image_response(image, requestUUID, {
         'type': 'CALL_PIPE_RESPONSE',
         'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
         'pipeId': pipeId,
         'uuid': requestUUID,
         'timeToInference': time_inference,
-        'filepath': filepath
-    })
-    return response
+    }, streamer=streamer)
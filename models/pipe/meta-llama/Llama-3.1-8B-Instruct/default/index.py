@@ -1,37 +1,49 @@
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, AutoModelForCausalLM
 import transformers
 import torch
 import time
 import json
+import queue
 import os
+from common.generation import GenerationEngine, GenerationRequest
+from common.prefix_cache import create_prefix_cache
+from common.cancellation import cancellations
+from common.weights import load_model, place_model
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
+# weights are placed by accelerate (device_map="auto"), can't be demoted to the host tier
+HOST_TIER = False
+
+# requests decoded together by the continuous batching engine
+MAX_BATCH_SIZE = 8
+
 # https://replicate.com/meta/llama-2-70b/api#output-schema
 
 def load():
     start_in_ram = time.time()
     model_id = "meta-llama/Llama-3.1-8B-Instruct"
     tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = load_model(AutoModelForCausalLM, model_id, torch_dtype=torch.float16)
     loaded_in_ram = round(time.time() - start_in_ram, 2)
     start_in_vram = time.time()
     pipe = transformers.pipeline(
         "text-generation",
-        model=model_id,
-        torch_dtype=torch.float16,
-        device_map="auto",
+        model=place_model(model, device_map="auto"),
+        tokenizer=tokenizer,
     )
     loaded_in_vram = round(time.time() - start_in_vram, 2)
 
     return {
         "pipe": pipe,
         "tokenizer": tokenizer,
+        "engine": GenerationEngine(pipe.model, tokenizer, MAX_BATCH_SIZE, prefix_cache=create_prefix_cache()),
         "loaded_in_ram": loaded_in_ram,
         "loaded_in_vram": loaded_in_vram,
     }
 
 
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
+def submit(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, respond, streamer=None):
     start_inference = time.time()
     max_new_tokens = int(payload.get("max_new_tokens", 500))
     min_new_tokens = int(payload.get("min_new_tokens", -3))
@@ -39,7 +51,7 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None
     top_k = int(payload.get("top_k", 50))
     top_p = float(payload.get("top_p", 0.9))
     stop_sequences = payload.get("stop_sequences", None)
-    # seed = payload.get("seed", None)
+    seed = payload.get("seed", None)
 
     if stop_sequences:
         stop_sequences = [seq.strip() for seq in stop_sequences.split(',')]
@@ -47,38 +59,51 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None
     if streamer:
         streamer.tokenizer = pipe["tokenizer"]
 
-    sequences = pipe["pipe"](
-        payload["prompt"],
-        do_sample=True,
+    prompt = payload["prompt"]
+
+    def on_finish(request, error=None):
+        response = {
+            "type": "CALL_PIPE_RESPONSE",
+            "CUDA_VISIBLE_DEVICES": CUDA_VISIBLE_DEVICES,
+            "pipeId": pipeId,
+            "uuid": requestUUID,
+        }
+        if error:
+            respond(json.dumps({**response, "error": error}))
+        elif not streamer:
+            time_inference = round(time.time() - start_inference, 2)
+            respond(json.dumps({
+                **response,
+                "timeToInference": time_inference,
+                "text": prompt + request.text(),
+                "cachedPromptTokens": request.cached_tokens,
+                "computedPromptTokens": len(request.input_ids) - request.cached_tokens,
+            }))
+        else:
+            # the streamer sent the done message, the request is finished all the same
+            respond(None)
+
+    request = GenerationRequest(
+        pipe["tokenizer"](prompt)["input_ids"],
+        on_finish,
         streamer=streamer,
+        do_sample=True,
         top_k=top_k,
         top_p=top_p,
-        num_return_sequences=1,
-        eos_token_id=pipe["tokenizer"].eos_token_id,
+        eos_token_ids=[pipe["tokenizer"].eos_token_id],
         max_new_tokens=max_new_tokens,
         min_new_tokens=min_new_tokens,
         temperature=temperature,
         stop_sequences=stop_sequences,
-        # seed=seed,
+        seed=seed,
+        cancel=cancellations.current(),
     )
+    pipe["engine"].submit(request)
+    return request
 
-    if streamer:
-        return sequences
-
-    time_inference = round(time.time() - start_inference, 2)
-
-    text = "".join(seq["generated_text"] for seq in sequences)
 
-    # Convert the result into a JSON response
-    response = json.dumps(
-        {
-            "type": "CALL_PIPE_RESPONSE",
-            "CUDA_VISIBLE_DEVICES": CUDA_VISIBLE_DEVICES,
-            "pipeId": pipeId,
-            "uuid": requestUUID,
-            "timeToInference": time_inference,
-            "text": text,
-        }
-    )
-
-    return response
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
+    responses = queue.Queue()
+    request = submit(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, responses.put, streamer)
+    request.done.wait()
+    return None if responses.empty() else responses.get()
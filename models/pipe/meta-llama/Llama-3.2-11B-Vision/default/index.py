@@ -4,9 +4,15 @@ import torch
 import time
 import json
 import os
+from transformers import StoppingCriteriaList
+from common.generation import CancelCriteria
+from common.cancellation import cancellations
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
+# weights are placed by accelerate (device_map="auto"), can't be demoted to the host tier
+HOST_TIER = False
+
 # https://replicate.com/meta/llama-2-70b/api#output-schema
 
 def load():
@@ -47,6 +53,7 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None
     if streamer:
         streamer.tokenizer = pipe["tokenizer"]
 
+    cancel = cancellations.current()
     sequences = pipe["pipe"](
         payload["prompt"],
         do_sample=True,
@@ -59,8 +66,11 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None
         min_new_tokens=min_new_tokens,
         temperature=temperature,
         stop_sequences=stop_sequences,
+        stopping_criteria=StoppingCriteriaList([CancelCriteria(cancel, max_new_tokens)] if cancel else []),
         # seed=seed,
     )
+    if cancel:
+        cancel.check()
 
     if streamer:
         return sequences
@@ -3,10 +3,20 @@ import transformers
 import torch
 import time
 import json
+import queue
 import os
+from common.generation import GenerationEngine, GenerationRequest
+from common.prefix_cache import create_prefix_cache
+from common.cancellation import cancellations
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
+# weights are placed by accelerate (device_map="auto"), can't be demoted to the host tier
+HOST_TIER = False
+
+# requests decoded together by the continuous batching engine
+MAX_BATCH_SIZE = 4
+
 # https://replicate.com/meta/llama-2-70b/api#output-schema
 
 def load():
@@ -26,12 +36,13 @@ def load():
     return {
         "pipe": pipe,
         "tokenizer": tokenizer,
+        "engine": GenerationEngine(pipe.model, tokenizer, MAX_BATCH_SIZE, prefix_cache=create_prefix_cache()),
         "loaded_in_ram": loaded_in_ram,
         "loaded_in_vram": loaded_in_vram,
     }
 
 
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
+def submit(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, respond, streamer=None):
     start_inference = time.time()
     max_new_tokens = int(payload.get("max_new_tokens", 128))
     min_new_tokens = int(payload.get("min_new_tokens", -1))
@@ -39,7 +50,7 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None
     top_k = int(payload.get("top_k", 50))
     top_p = float(payload.get("top_p", 0.9))
     stop_sequences = payload.get("stop_sequences", None)
-    # seed = payload.get("seed", None)
+    seed = payload.get("seed", None)
 
     # Retrieve the 'messages' from the payload
     messages_json = payload.get("messages")
@@ -56,6 +67,9 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None
     else:
         messages = None
 
+    if isinstance(stop_sequences, str):
+        stop_sequences = [stop_sequences]
+
     if streamer:
         streamer.tokenizer = pipe["tokenizer"]
 
@@ -73,39 +87,52 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None
         pipe["tokenizer"].convert_tokens_to_ids("<|eot_id|>")
     ]
 
-    sequences = pipe["pipe"](
-        # payload["prompt"],
-        prompt,
-        do_sample=True,
+    def on_finish(request, error=None):
+        response = {
+            "type": "CALL_PIPE_RESPONSE",
+            "CUDA_VISIBLE_DEVICES": CUDA_VISIBLE_DEVICES,
+            "pipeId": pipeId,
+            "uuid": requestUUID,
+        }
+        if error:
+            respond(json.dumps({**response, "error": error}))
+        elif not streamer:
+            time_inference = round(time.time() - start_inference, 2)
+            respond(json.dumps({
+                **response,
+                "timeToInference": time_inference,
+                "text": prompt + request.text(),
+                "cachedPromptTokens": request.cached_tokens,
+                "computedPromptTokens": len(request.input_ids) - request.cached_tokens,
+            }))
+        else:
+            # the streamer sent the done message, the request is finished all the same
+            respond(None)
+
+    # the chat template already contains <|begin_of_text|>
+    input_ids = pipe["tokenizer"](prompt, add_special_tokens=not messages)["input_ids"]
+
+    request = GenerationRequest(
+        input_ids,
+        on_finish,
         streamer=streamer,
+        do_sample=True,
         top_k=top_k,
         top_p=top_p,
-        num_return_sequences=1,
         max_new_tokens=max_new_tokens,
         min_new_tokens=min_new_tokens,
         temperature=temperature,
         stop_sequences=stop_sequences,
-        eos_token_id=terminators,
-        # seed=seed,
+        eos_token_ids=terminators,
+        seed=seed,
+        cancel=cancellations.current(),
     )
+    pipe["engine"].submit(request)
+    return request
 
-    if streamer:
-        return sequences
-
-    time_inference = round(time.time() - start_inference, 2)
-
-    text = "".join(seq["generated_text"] for seq in sequences)
-
-    # Convert the result into a JSON response
-    response = json.dumps(
-        {
-            "type": "CALL_PIPE_RESPONSE",
-            "CUDA_VISIBLE_DEVICES": CUDA_VISIBLE_DEVICES,
-            "pipeId": pipeId,
-            "uuid": requestUUID,
-            "timeToInference": time_inference,
-            "text": text,
-        }
-    )
 
-    return response
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
+    responses = queue.Queue()
+    request = submit(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, responses.put, streamer)
+    request.done.wait()
+    return None if responses.empty() else responses.get()
@@ -4,27 +4,12 @@ import torch
 import time
 import json
 import os
-import requests
-from urllib.parse import urlparse
+import queue
+from common.whisper import ChunkScheduler
+from common.utils import log
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
-def download_file(url, requestUUID):
-    # Parse the URL to get the path, then split the path to get the extension
-    parsed_url = urlparse(url)
-    _, file_extension = os.path.splitext(parsed_url.path)
-    local_filename = f"tmp_files/{requestUUID}{file_extension}"  # Use the requestUUID with the correct extension
-
-    # Ensure the tmp_files directory exists
-    os.makedirs(os.path.dirname(local_filename), exist_ok=True)
-
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-    return local_filename
-
 def load():
     start_in_ram = time.time()
 
@@ -60,28 +45,51 @@ def load():
     )
 
 
-    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
+    # 30 s windows of concurrent requests share the batch_size slots
+    engine = ChunkScheduler(pipe)
 
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
-    audio = payload.get('audio')
+    return {'pipe': pipe, 'engine': engine, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
 
-    local_audio_file = download_file(audio, requestUUID)
+def submit(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, respond, streamer=None):
+    audio = payload.get('audio')
 
     start_inference = time.time()
 
-    result = pipe["pipe"](local_audio_file)
-
-    time_inference = round(time.time() - start_inference, 2)
-
-    os.remove(local_audio_file)
-
-    response = json.dumps({
-        'type': 'CALL_PIPE_RESPONSE',
-        'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
-        'pipeId': pipeId,
-        'uuid': requestUUID,
-        'timeToInference': time_inference,
-        'text': result["text"]
-    })
-
-    return response
+    def on_segment(transcription, segment):
+        if transcription.emitted == 1:
+            log(f'{requestUUID} time to first text {round(time.time() - start_inference, 2)}s')
+        streamer.put_text(segment['text'], timestamp=segment['timestamp'])
+
+    def on_finish(transcription, result, timings, error=None):
+        response = {
+            'type': 'CALL_PIPE_RESPONSE',
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+            'pipeId': pipeId,
+            'uuid': requestUUID,
+        }
+        if streamer:
+            streamer.end()
+        if error:
+            respond(json.dumps({**response, 'error': error}))
+            return
+        if streamer:
+            # the streamer sent the done message, the request is finished all the same
+            respond(None)
+            return
+
+        time_inference = round(time.time() - start_inference, 2)
+        respond(json.dumps({
+            **response,
+            'timeToInference': time_inference,
+            'timings': {**timings, 'total': time_inference},
+            'text': result["text"]
+        }))
+
+    # download, decode and inference overlap, the audio never touches the disk
+    return pipe["engine"].submit(audio, on_finish, on_segment if streamer else None)
+
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
+    responses = queue.Queue()
+    transcription = submit(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, responses.put, streamer)
+    transcription.done.wait()
+    return None if responses.empty() else responses.get()
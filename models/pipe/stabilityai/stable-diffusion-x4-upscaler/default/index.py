@@ -4,17 +4,23 @@ from common.utils import log, load_image
 from PIL import Image
 import torch
 import time
-import json
 import os
 from common.stablediffusion import extract_params_sdxl
 from common.utils import log
+from common.images import image_response
+from common.tiling import process_tiled, tile_box
 from split_image import split
 import random
 import math
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
-def load():
+# input pixels, the payload may override them with tile_size, tile_overlap and tile_batch_size
+TILE_SIZE = 512
+TILE_OVERLAP = 64
+TILE_BATCH_SIZE = 2
+
+def load_in_ram():
     start_in_ram = time.time()
     pipe = StableDiffusionUpscalePipeline.from_pretrained(
         "stabilityai/stable-diffusion-x4-upscaler", torch_dtype=torch.float16, variant="fp16", use_safetensors=True
@@ -24,51 +30,68 @@ def load():
         pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
 
     loaded_in_ram = round(time.time() - start_in_ram, 2) 
-    start_in_vram = time.time()        
-    pipe.to('cuda')
-    loaded_in_vram = round(time.time() - start_in_vram, 2)
-    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
+    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram}
+
+def load():
+    pipe = load_in_ram()
+    start_in_vram = time.time()
+    pipe['pipe'].to('cuda')
+    pipe['loaded_in_vram'] = round(time.time() - start_in_vram, 2)
+    return pipe
+
+def prepare(payload):
+    # input fetched before the request reaches the GPU, see common/stages.py
+    return {'image': load_image(payload['image']).convert("RGB")}
 
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, inputs=None):
     config_dict = extract_params_sdxl(payload)
-    config_dict['image'] = load_image(payload['image']).convert("RGB")
+    config_dict.update(inputs or prepare(payload))
 
     nonsharded = int(payload['nonsharded']) if 'nonsharded' in payload else None
     rows = int(payload['rows']) if 'rows' in payload else None
     cols = int(payload['cols']) if 'cols' in payload else None
     tile_index = int(payload['tile_index']) if 'tile_index' in payload else None
+    tile_size = int(payload.get('tile_size', TILE_SIZE))
+    tile_overlap = int(payload.get('tile_overlap', TILE_OVERLAP))
+    tile_batch_size = int(payload.get('tile_batch_size', TILE_BATCH_SIZE))
 
     start_inference = time.time()
-    if nonsharded is None and (config_dict['image'].size[1] > 512 or rows is not None):
-        if rows is not None and cols is not None and tile_index is not None:
+    if nonsharded is None and (max(config_dict['image'].size) > tile_size or rows is not None):
+        if rows is not None and cols is not None and tile_index is not None and 'tile_overlap' in payload:
+            # one overlapping tile of a batchUpscale, the cluster blends them
+            box = tile_box(*config_dict['image'].size, rows, cols, tile_index, tile_overlap)
+            config_dict['image'] = config_dict['image'].crop(box)
+            image = pipe['pipe'](**config_dict).images[0]
+        elif rows is not None and cols is not None and tile_index is not None:
             # Process only the specific tile
             tile = split_image(config_dict['image'], rows, cols, True, specific_tile_index=tile_index)
             config_dict['image'] = tile
             image = pipe['pipe'](**config_dict).images[0]
         else:
-            # Process all tiles
-            tiles = split_image(config_dict['image'], 2, 2, True)
-            upscaled_tiles = []
-            for tile in tiles:
-                config_dict['image'] = tile
-                upscaled_tile = pipe['pipe'](**config_dict).images[0]
-                upscaled_tiles.append(upscaled_tile)
-            image = merge_tiles(upscaled_tiles, 2, 2)
+            image = process_tiled(
+                config_dict.pop('image'),
+                lambda tiles: upscale_tiles(pipe['pipe'], config_dict, tiles),
+                tile_size, tile_overlap, tile_batch_size
+            )
     else:
         image = pipe['pipe'](**config_dict).images[0]
 
-    filepath = f"tmp_images/{requestUUID}-x4.png"
-    image.save(filepath)
     time_inference = round(time.time() - start_inference, 2)
-    response = json.dumps({
+    return image_response(image, requestUUID, {
         'type': 'CALL_PIPE_RESPONSE',
         'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
         'pipeId': pipeId,
         'uuid': requestUUID,
         'timeToInference': time_inference,
-        'filepath': filepath
-    })
-    return response
+    }, '-x4')
+
+def upscale_tiles(pipe, config_dict, tiles):
+    """Upscales equally sized tiles in one pipeline call"""
+    params = {**config_dict, 'image': tiles, 'output_type': 'np'}
+    for key in ('prompt', 'negative_prompt'):
+        if key in params and not isinstance(params[key], list):
+            params[key] = [params[key]] * len(tiles)
+    return list(pipe(**params).images)
 
 def distribute_tiles(num_gpus):
     # Calculate the square root of the number of GPUs
@@ -126,15 +149,3 @@ def split_image(im, rows, cols, should_square, specific_tile_index=None):
             images.append(tile)
     return images
 
-
-def merge_tiles(tiles, rows, cols):
-    tile_width = tiles[0].width
-    tile_height = tiles[0].height
-    total_width = tile_width * cols
-    total_height = tile_height * rows
-    merged_image = Image.new("RGB", (total_width, total_height))
-    for i in range(rows):
-        for j in range(cols):
-            tile = tiles[i * cols + j]
-            merged_image.paste(tile, (j * tile_width, i * tile_height))
-    return merged_image
\ No newline at end of file
@@ -1,9 +1,12 @@
 from diffusers import StableDiffusionXLControlNetInpaintPipeline, ControlNetModel
 from common.utils import log, load_image
 from common.stablediffusion import extract_params_sdxl
+from common.prompt_cache import encode_prompts_sdxl
+from common.images import image_response
+from common.components import SDXL_BASE, sdxl_components
+from common.progress import progress_kwargs
 import torch
 import time
-import json
 import os
 import cv2
 import numpy as np
@@ -22,53 +25,58 @@ def make_canny_condition(image):
 
 # https://github.com/huggingface/diffusers/issues/4392
 # https://huggingface.co/diffusers/stable-diffusion-xl-1.0-inpainting-0.1
-def load():
+def load_in_ram():
     start_in_ram = time.time()
     controlnet = ControlNetModel.from_pretrained(
         "diffusers/controlnet-canny-sdxl-1.0", torch_dtype=torch.float16
     )
     pipe = StableDiffusionXLControlNetInpaintPipeline.from_pretrained(
-        "stabilityai/stable-diffusion-xl-base-1.0", controlnet=controlnet, torch_dtype=torch.float16
+        SDXL_BASE, controlnet=controlnet, **sdxl_components(torch_dtype=torch.float16), torch_dtype=torch.float16
     )
 
     if os.environ.get("COMPILE_TORCH"):
         pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True)
 
     loaded_in_ram = round(time.time() - start_in_ram, 2) 
-    start_in_vram = time.time()
-    pipe.to('cuda')
-    loaded_in_vram = round(time.time() - start_in_vram, 2)
-    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
-
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
-    config_dict = extract_params_sdxl(payload)
+    return {'pipe': pipe, 'loaded_in_ram': loaded_in_ram}
 
-    config_dict['generator'] = torch.Generator(device="cpu").manual_seed(1)
+def load():
+    pipe = load_in_ram()
+    start_in_vram = time.time()
+    pipe['pipe'].to('cuda')
+    pipe['loaded_in_vram'] = round(time.time() - start_in_vram, 2)
+    return pipe
 
+def prepare(payload):
+    # runs on the prepare stage while the GPU works on earlier requests
     log('Loading image')
-    config_dict['image'] = load_image(payload['image']).resize((1024, 1024))
+    image = load_image(payload['image']).resize((1024, 1024))
 
     log('Loading mask_image')
-    config_dict['mask_image'] = load_image(payload['mask_image']).resize((1024, 1024))
+    mask_image = load_image(payload['mask_image']).resize((1024, 1024))
 
     log('Loading control_image')
-    config_dict['control_image'] = make_canny_condition(config_dict['image'])
-    config_dict['eta'] = 1.0
+    control_image = make_canny_condition(image)
 
     log('Images loaded')
+    return {'image': image, 'mask_image': mask_image, 'control_image': control_image}
+
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None, inputs=None):
+    config_dict = extract_params_sdxl(payload)
+
+    config_dict['generator'] = torch.Generator(device="cpu").manual_seed(1)
+    config_dict.update(inputs or prepare(payload))
+    config_dict['eta'] = 1.0
 
     start_inference = time.time()
 
-    image = pipe['pipe'](**config_dict).images[0]
-    filepath = f"tmp_images/{requestUUID}.png"
-    image.save(filepath)
+    config_dict = encode_prompts_sdxl(pipe['pipe'], pipeId, config_dict)
+    image = pipe['pipe'](**config_dict, **progress_kwargs(streamer, payload, config_dict)).images[0]
     time_inference = round(time.time() - start_inference, 2)
-    response = json.dumps({
+    return image_response(image, requestUUID, {
         'type': 'CALL_PIPE_RESPONSE',
         'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
         'pipeId': pipeId,
         'uuid': requestUUID,
         'timeToInference': time_inference,
-        'filepath': filepath
-    })
-    return response
\ No newline at end of file
+    }, streamer=streamer)
\ No newline at end of file
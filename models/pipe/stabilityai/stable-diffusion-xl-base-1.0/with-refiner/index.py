@@ -1,18 +1,25 @@
 from diffusers import DiffusionPipeline
 import torch
 import time
-import json
 import os
 from common.stablediffusion import extract_params_sdxl
+from common.images import image_response
+from common.components import SDXL_BASE, sdxl_components
+from common.progress import progress_kwargs
+from common.compile_cache import SDXL_BUCKETS, WARMUP_STEPS
 
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
 
+# resolutions compiled and warmed at load with COMPILE_TORCH, requests are snapped to the nearest one
+COMPILE_BUCKETS = SDXL_BUCKETS
+
 # https://www.reddit.com/r/StableDiffusion/comments/13u25mo/whats_the_best_model_for_inpainting/
-def load():
+def load_in_ram():
     start_in_ram = time.time()
 
     base = DiffusionPipeline.from_pretrained(
-        "stabilityai/stable-diffusion-xl-base-1.0", torch_dtype=torch.float16, variant="fp16", use_safetensors=True
+        SDXL_BASE, **sdxl_components(torch_dtype=torch.float16),
+        torch_dtype=torch.float16, variant="fp16", use_safetensors=True
     )
 
     refiner = DiffusionPipeline.from_pretrained(
@@ -29,14 +36,22 @@ def load():
         refiner.unet = torch.compile(refiner.unet, mode="reduce-overhead", fullgraph=True)
 
     loaded_in_ram = round(time.time() - start_in_ram, 2)
+    return {'base': base, 'refiner': refiner, 'loaded_in_ram': loaded_in_ram}
 
+def load():
+    pipe = load_in_ram()
     start_in_vram = time.time()
-    base.to("cuda")
-    refiner.to("cuda")
-    loaded_in_vram = round(time.time() - start_in_vram, 2)
-    return {'base': base, 'refiner': refiner, 'loaded_in_ram': loaded_in_ram, 'loaded_in_vram': loaded_in_vram}
+    pipe['base'].to('cuda')
+    pipe['refiner'].to('cuda')
+    pipe['loaded_in_vram'] = round(time.time() - start_in_vram, 2)
+    return pipe
+
+def warmup(pipe, height, width):
+    # WARMUP_STEPS steps on each side of the switch
+    latents = pipe['base'](prompt='', height=height, width=width, num_inference_steps=2 * WARMUP_STEPS, denoising_end=0.5, output_type="latent").images
+    pipe['refiner'](prompt='', image=latents, num_inference_steps=2 * WARMUP_STEPS, denoising_start=0.5, output_type="latent")
 
-def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
+def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe, streamer=None):
     config_dict = extract_params_sdxl(payload)
 
     seed = payload.get('seed')
@@ -50,6 +65,7 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
         **config_dict,
         denoising_end=float(payload.get('denoising_switch', 0.8)),
         output_type="latent",
+        **progress_kwargs(streamer, payload, config_dict, stage='base'),
     ).images
 
     config_dict.pop('height', None)
@@ -59,17 +75,14 @@ def call(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipe):
         **config_dict,
         denoising_start=float(payload.get('denoising_switch', 0.8)),
         image=image,
+        **progress_kwargs(streamer, payload, config_dict, stage='refiner'),
     ).images[0]
 
-    filepath = f"tmp_images/{requestUUID}.png"
-    image.save(filepath)
     time_inference = round(time.time() - start_inference, 2)
-    response = json.dumps({
+    return image_response(image, requestUUID, {
         'type': 'CALL_PIPE_RESPONSE',
         'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
         'pipeId': pipeId,
         'uuid': requestUUID,
         'timeToInference': time_inference,
-        'filepath': filepath
-    })
-    return response
\ No newline at end of file
+    }, streamer=streamer)
\ No newline at end of file
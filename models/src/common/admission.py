@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+
+# priority classes of CALL_PIPE_REQUESTs, lower runs first
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+DEFAULT_PRIORITY = 'normal'
+# weight of the latest execution in the per-pipe service time estimate
+SERVICE_TIME_ALPHA = 0.3
+
+
+def priority(json_data):
+    """Priority class of a queued message, set by the cluster or the payload of a call"""
+    name = json_data.get('priority') or json_data.get('payload', {}).get('priority') or DEFAULT_PRIORITY
+    return PRIORITIES.get(name, PRIORITIES[DEFAULT_PRIORITY])
+
+
+def deadline(json_data):
+    """
+    Time (epoch seconds) a call has to start by, None without one. The cluster sends
+    its own deadline in epoch ms, the payload may ask for a tighter deadline_ms after
+    the request was received.
+    """
+    deadlines = []
+    if json_data.get('deadline'):
+        deadlines.append(float(json_data['deadline']) / 1000)
+    if json_data.get('payload', {}).get('deadline_ms'):
+        deadlines.append(json_data.get('queued_at', time.time()) + float(json_data['payload']['deadline_ms']) / 1000)
+    return min(deadlines) if deadlines else None
+
+
+class AdmissionControl:
+    """
+    Decides on arrival whether a call can be queued: the queue holds at most max_depth
+    requests, and a call with a deadline is rejected if the requests ahead of it (by
+    the service times of their pipes) won't let it start in time. Rejected calls are
+    answered right away, so the cluster can send them to another device.
+    """
+
+    def __init__(self, max_depth=0):
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.service_times = {}  # pipeId -> seconds, exponentially weighted
+        self.rejected = {'queue_full': 0, 'deadline': 0, 'expired': 0}
+        self.admitted = 0
+
+    def observe(self, pipeId, seconds):
+        with self.lock:
+            previous = self.service_times.get(pipeId)
+            self.service_times[pipeId] = seconds if previous is None else previous + SERVICE_TIME_ALPHA * (seconds - previous)
+
+    def estimate(self, json_data):
+        """Expected execution time of a queued message, pipes never run are taken as average"""
+        if json_data.get('type') != 'CALL_PIPE_REQUEST':
+            return 0
+        with self.lock:
+            known = self.service_times.get(json_data.get('pipeId'))
+            if known is None and self.service_times:
+                known = sum(self.service_times.values()) / len(self.service_times)
+        return known or 0
+
+    def estimated_wait(self, json_data, work):
+        """Seconds until json_data would start, behind the active request and the ones queued ahead"""
+        wait = sum(self.estimate(queued) for queued in work.ahead(priority(json_data)))
+        active, since = work.active, work.active_since
+        if active and since:
+            wait += max(self.estimate(active) - (time.time() - since), 0)
+        return wait
+
+    def admit(self, json_data, work):
+        """Returns (reason, estimated wait) of a rejection, (None, estimated wait) if admitted"""
+        if self.max_depth and len(work) >= self.max_depth:
+            return self.reject('queue_full'), None
+        wait = self.estimated_wait(json_data, work)
+        start_by = deadline(json_data)
+        if start_by is not None and time.time() + wait > start_by:
+            return self.reject('deadline'), wait
+        with self.lock:
+            self.admitted += 1
+        return None, wait
+
+    def expired(self, json_data):
+        """True if a queued call can't start anymore, counted as rejected"""
+        start_by = deadline(json_data)
+        if start_by is None or time.time() <= start_by:
+            return False
+        self.reject('expired')
+        return True
+
+    def reject(self, reason):
+        with self.lock:
+            self.rejected[reason] += 1
+        return reason
+
+    def stats(self, work):
+        depths = {name: 0 for name in PRIORITIES}
+        for json_data in work.ahead(max(PRIORITIES.values())):
+            if json_data.get('type') == 'CALL_PIPE_REQUEST':
+                depths[next(name for name, value in PRIORITIES.items() if value == priority(json_data))] += 1
+        with self.lock:
+            return {
+                'depth': len(work),
+                'maxDepth': self.max_depth,
+                'byPriority': depths,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'serviceTimes': {pipeId: round(seconds, 2) for pipeId, seconds in self.service_times.items()},
+            }
+
+
+def create_admission():
+    return AdmissionControl(int(os.environ.get('QUEUE_MAX_DEPTH', 64)))
@@ -0,0 +1,168 @@
+import os
+import time
+import queue
+import threading
+import subprocess
+import numpy as np
+import requests
+from common.utils import log
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+READ_SIZE = 16000 * 4  # one second of 16 kHz float32 PCM
+
+
+def ffmpeg_command(source, sampling_rate):
+    return [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", source, "-ac", "1", "-ar", str(sampling_rate), "-f", "f32le", "pipe:1",
+    ]
+
+
+class AudioStream:
+    """
+    Decodes audio from a URL to mono float32 PCM while it downloads: the response body
+    is piped into ffmpeg and its output is read in blocks, all in memory. Iterating
+    yields the PCM blocks as soon as ffmpeg produces them. Containers that need seeking
+    (e.g. mp4 with a trailing moov atom) are decoded again from the downloaded bytes in
+    a memfd once the download is complete.
+    """
+
+    def __init__(self, url, sampling_rate=16000):
+        self.url = url
+        self.sampling_rate = sampling_rate
+        self.blocks = queue.Queue()
+        self.samples = 0
+        self.downloaded = []
+        self.download_error = None
+        self.started_at = time.time()
+        self.timings = {}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def elapsed(self):
+        return round(time.time() - self.started_at, 2)
+
+    def run(self):
+        try:
+            if not self.decode(self.download_into):
+                log(f'Decoding {self.url} from a pipe failed, decoding the downloaded file')
+                fd = os.memfd_create('openkbs-audio')
+                try:
+                    for chunk in self.downloaded:
+                        os.write(fd, chunk)
+                    self.downloaded = []
+                    self.decode(None, fd)
+                finally:
+                    os.close(fd)
+            self.blocks.put(None)
+        except Exception as e:
+            self.blocks.put(e)
+
+    def download_into(self, stdin):
+        try:
+            with requests.get(self.url, stream=True) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    self.downloaded.append(chunk)
+                    stdin.write(chunk)
+            self.timings['download'] = self.elapsed()
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            self.download_error = e
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def decode(self, feed, fd=None):
+        """Runs ffmpeg on the download (feed) or on a file descriptor, returns False if nothing was decoded"""
+        source = "pipe:0" if feed else f"/dev/fd/{fd}"
+        process = subprocess.Popen(
+            ffmpeg_command(source, self.sampling_rate),
+            stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            pass_fds=(fd,) if fd is not None else (),
+        )
+        feeder = None
+        if feed:
+            feeder = threading.Thread(target=feed, args=(process.stdin,), daemon=True)
+            feeder.start()
+
+        remainder = b''
+        while True:
+            data = process.stdout.read1(READ_SIZE) if hasattr(process.stdout, 'read1') else process.stdout.read(READ_SIZE)
+            if not data:
+                break
+            data = remainder + data
+            usable = len(data) - len(data) % 4
+            remainder = data[usable:]
+            if usable:
+                if not self.samples:
+                    self.timings['firstAudio'] = self.elapsed()
+                block = np.frombuffer(data[:usable], dtype=np.float32)
+                self.samples += len(block)
+                self.blocks.put(block)
+
+        if feeder:
+            feeder.join()
+            if self.download_error:
+                process.wait()
+                raise self.download_error
+        error = process.stderr.read().decode(errors='replace').strip()
+        returncode = process.wait()
+        if feed and not self.samples and 'download' in self.timings:
+            return False
+        if returncode != 0 or not self.samples:
+            raise RuntimeError(f'ffmpeg failed to decode {self.url}: {error}')
+        self.downloaded = []
+        self.timings['decode'] = self.elapsed()
+        self.timings.setdefault('download', self.timings['decode'])
+        return True
+
+    def __iter__(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+
+def iter_windows(blocks, chunk_len, stride_left, stride_right):
+    """
+    Incremental version of transformers' chunk_iter over a stream of PCM blocks: yields
+    the same (chunk, stride, is_last) windows, each one as soon as its samples arrived.
+    """
+    step = chunk_len - stride_left - stride_right
+    buffer = np.empty(0, dtype=np.float32)
+    offset = 0  # absolute index of buffer[0]
+    start = 0
+
+    def window(is_last):
+        chunk = buffer[start - offset:start - offset + chunk_len]
+        _stride_left = 0 if start == 0 else stride_left
+        _stride_right = 0 if is_last else stride_right
+        return chunk, (chunk.shape[0], _stride_left, _stride_right), _stride_left
+
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        # a window is not the last one once samples beyond its end exist
+        while offset + buffer.shape[0] > start + chunk_len:
+            chunk, stride, _ = window(False)
+            yield chunk, stride, False
+            start += step
+            buffer = buffer[start - offset:]
+            offset = start
+
+    total = offset + buffer.shape[0]
+    while start < total:
+        is_last = start + chunk_len >= total
+        chunk, stride, _stride_left = window(is_last)
+        if chunk.shape[0] > _stride_left:
+            yield chunk, stride, is_last
+        if is_last:
+            break
+        start += step
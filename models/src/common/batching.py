@@ -0,0 +1,30 @@
+import time
+from common.compile_cache import snap_payload
+
+
+def is_batchable(json_data, pipeId, module, key):
+    return (
+        json_data.get('type') == 'CALL_PIPE_REQUEST'
+        and json_data.get('pipeId') == pipeId
+        and module.batch_key(snap_payload(json_data.get('payload', {}), module)) == key
+    )
+
+
+def collect_batch(first, work, module):
+    """
+    Collects CALL_PIPE_REQUESTs compatible with `first` from the work queue of the
+    dispatcher, waiting for up to BATCH_WAIT_MS for more to arrive. Only compatible
+    requests are taken, the others keep their place in the queue.
+    """
+    max_size = getattr(module, 'BATCH_MAX_SIZE', 1)
+    key = module.batch_key(first.get('payload', {}))
+    if key is None or max_size <= 1:
+        return [first]
+
+    batch = [first]
+    deadline = time.time() + getattr(module, 'BATCH_WAIT_MS', 0) / 1000
+    match = lambda json_data: is_batchable(json_data, first['pipeId'], module, key)
+    while True:
+        batch.extend(work.take(match, max_size - len(batch), timeout=max(deadline - time.time(), 0)))
+        if len(batch) >= max_size or time.time() >= deadline:
+            return batch
@@ -0,0 +1,96 @@
+import time
+import threading
+from contextlib import contextmanager
+from common.utils import log
+
+# tokens of requests that never released theirs (e.g. streamed generations) are dropped after this
+TOKEN_TTL = 3600
+
+
+class Cancelled(Exception):
+    """Raised inside a pipeline call to abandon a cancelled request"""
+
+
+class CancelToken:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.event = threading.Event()
+        self.reason = None
+        self.created = time.time()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason):
+        if not self.event.is_set():
+            self.reason = reason
+            self.event.set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled(f'Request cancelled ({self.reason})')
+
+    def stopped(self, done, total, started, unit='steps'):
+        """Logs the device time saved by stopping after done of total steps, returns it in seconds"""
+        elapsed = time.time() - started
+        freed = round(elapsed / done * (total - done), 2) if done and total and total > done else 0
+        log(f'Cancelled {self.uuid} ({self.reason}) after {done}/{total} {unit}, freed ~{freed}s of device time')
+        return freed
+
+
+class CancelRegistry:
+    """
+    Cancel tokens of the requests queued to the worker. CANCEL_PIPE_REQUEST sets the
+    token, the running pipeline checks it cooperatively: diffusion pipes in their step
+    callback, generations in their stopping criterion. The executor runs a request
+    inside running(uuid), so current() is its token on that thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}  # uuid -> CancelToken
+        self.local = threading.local()
+
+    def register(self, uuid):
+        now = time.time()
+        with self.lock:
+            for stale in [key for key, token in self.tokens.items() if now - token.created > TOKEN_TTL]:
+                del self.tokens[stale]
+            token = self.tokens[uuid] = CancelToken(uuid)
+            return token
+
+    def cancel(self, uuid, reason='cancelled'):
+        """Cancels a known request, returns its token or None"""
+        with self.lock:
+            token = self.tokens.get(uuid)
+        if token:
+            token.cancel(reason)
+        return token
+
+    def cancelled(self, uuid):
+        with self.lock:
+            token = self.tokens.get(uuid)
+        return bool(token and token.cancelled)
+
+    def release(self, uuid):
+        with self.lock:
+            self.tokens.pop(uuid, None)
+
+    @contextmanager
+    def running(self, uuid):
+        with self.lock:
+            token = self.tokens.get(uuid) or self.tokens.setdefault(uuid, CancelToken(uuid))
+        previous = getattr(self.local, 'token', None)
+        self.local.token = token
+        try:
+            yield token
+        finally:
+            self.local.token = previous
+
+    def current(self):
+        """Token of the request running on this thread, None outside of one"""
+        return getattr(self.local, 'token', None)
+
+
+cancellations = CancelRegistry()
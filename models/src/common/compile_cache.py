@@ -0,0 +1,116 @@
+import os
+import math
+import time
+import hashlib
+import torch
+from common.utils import log
+
+COMPILE_TORCH = bool(os.environ.get("COMPILE_TORCH"))
+
+# (height, width) of the SDXL training resolutions, about one megapixel each
+SDXL_BUCKETS = [(1024, 1024), (1152, 896), (896, 1152), (1216, 832), (832, 1216), (1344, 768), (768, 1344)]
+
+# denoising steps of a warmup call, cudagraphs are recorded on the second run of a shape
+WARMUP_STEPS = 3
+
+
+def nearest_bucket(buckets, height, width):
+    """Bucket closest in aspect ratio and area, both compared on a log scale"""
+    return min(buckets, key=lambda bucket: (
+        math.log((bucket[0] / bucket[1]) / (height / width)) ** 2
+        + math.log((bucket[0] * bucket[1]) / (height * width)) ** 2
+    ))
+
+
+def snap_payload(payload, module):
+    """
+    Moves the height and width of a request to the nearest COMPILE_BUCKETS resolution
+    of the module, so it runs on a graph compiled at load. Returns the payload.
+    """
+    buckets = getattr(module, 'COMPILE_BUCKETS', None)
+    if not COMPILE_TORCH or not buckets:
+        return payload
+    height = payload.get('height', payload.get('h'))
+    width = payload.get('width', payload.get('w'))
+    if height is None or width is None:
+        # the pipeline default, which is one of the buckets
+        return payload
+    snapped = nearest_bucket(buckets, int(height), int(width))
+    if snapped != (int(height), int(width)):
+        payload['height'], payload['width'] = str(snapped[0]), str(snapped[1])
+    return payload
+
+
+def warmup_text_to_image(pipeline, height, width, **kwargs):
+    kwargs.setdefault('num_inference_steps', WARMUP_STEPS)
+    pipeline(prompt='', height=height, width=width, output_type='latent', **kwargs)
+
+
+class CompileCache:
+    """
+    Keeps the torch.compile artifacts (inductor graphs, autotuning results) of each pipe
+    on disk, per torch version and GPU, so a restarted worker doesn't compile again.
+    Pipes declaring COMPILE_BUCKETS are compiled and warmed for every bucket at load,
+    warmup(pipe, height, width) of the module runs one generation at a resolution.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, f'torch-{torch.__version__}', self.device_name())
+        os.makedirs(self.directory, exist_ok=True)
+        # the on-disk caches of inductor itself, shared by all pipes. Set unconditionally, inductor
+        # writes its /tmp default to the environment the first time it's asked for it
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(self.directory, 'inductor')
+        from torch._inductor import config as inductor_config
+        from torch._functorch import config as functorch_config
+        inductor_config.fx_graph_cache = True
+        functorch_config.enable_autograd_cache = True
+
+    @staticmethod
+    def device_name():
+        name = torch.cuda.get_device_name() if torch.cuda.is_available() else 'cpu'
+        return name.replace(' ', '-').replace('/', '-')
+
+    def path(self, pipeId, buckets):
+        shapes = ','.join(f'{height}x{width}' for height, width in sorted(buckets))
+        return os.path.join(self.directory, pipeId.replace('/', '--'), hashlib.sha1(shapes.encode()).hexdigest()[:12] + '.bin')
+
+    def warmup(self, pipeId, pipe, module):
+        """Compiles and warms the buckets of a loaded pipe, returns the seconds it took"""
+        buckets = getattr(module, 'COMPILE_BUCKETS', None)
+        if not buckets:
+            return 0
+        start_warmup = time.time()
+        path = self.path(pipeId, buckets)
+        cached = os.path.exists(path)
+        if cached:
+            with open(path, 'rb') as f:
+                torch.compiler.load_cache_artifacts(f.read())
+
+        run = getattr(module, 'warmup', None) or (lambda pipe, height, width: warmup_text_to_image(pipe['pipe'], height, width))
+        try:
+            for height, width in buckets:
+                run(pipe, height, width)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        except Exception as e:
+            # the pipe still works, shapes that weren't warmed are compiled by their first request
+            log(f'Warming up {pipeId} failed: {e}')
+            return round(time.time() - start_warmup, 2)
+
+        if not cached:
+            artifacts = torch.compiler.save_cache_artifacts()
+            if artifacts:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.partial', 'wb') as f:
+                    f.write(artifacts[0])
+                os.replace(path + '.partial', path)
+
+        warmup = round(time.time() - start_warmup, 2)
+        log(f'Warmed up {pipeId} for {len(buckets)} resolutions in {warmup}s ({"cached" if cached else "compiled"})')
+        return warmup
+
+
+def create_compile_cache():
+    if not COMPILE_TORCH:
+        return None
+    return CompileCache(os.environ.get('COMPILE_CACHE_DIR', os.path.expanduser('~/.cache/openkbs/torch-compile')))
@@ -0,0 +1,168 @@
+import threading
+from contextlib import contextmanager
+from common.utils import log
+from common.weights import load_model
+
+SDXL_BASE = "stabilityai/stable-diffusion-xl-base-1.0"
+
+
+def module_size(module):
+    return sum(tensor.numel() * tensor.element_size() for tensor in list(module.parameters()) + list(module.buffers()))
+
+
+def replace_component(pipe, old, new):
+    """Points the diffusers pipelines of a pipe dict that use component old to new"""
+    for value in pipe.values():
+        for name, component in list(getattr(value, 'components', {}).items()):
+            if component is old:
+                setattr(value, name, new)
+
+
+class ComponentRegistry:
+    """
+    Hands out one copy of a model component (VAE, text encoders, UNet) per
+    (repo, subfolder, dtype) to all pipes of the worker that load it. Users are
+    the pipeIds whose load()/load_in_ram() ran inside owner(pipeId); a component
+    is dropped by the registry once release() removed its last user. Pipes demoted
+    to the host tier are parked: their components are registered again by restore()
+    when they are promoted.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> {'module', 'users', 'size'}
+        self.loading = {}  # key -> threading.Event
+        self.parked = {}  # pipeId -> {key: module} of the pipes in the host tier
+        self.local = threading.local()
+
+    @contextmanager
+    def owner(self, pipeId):
+        previous = getattr(self.local, 'owner', None)
+        self.local.owner = pipeId
+        try:
+            yield
+        finally:
+            self.local.owner = previous
+
+    def current_owner(self):
+        return getattr(self.local, 'owner', None)
+
+    def from_pretrained(self, component_class, repo, subfolder=None, torch_dtype=None, **kwargs):
+        """component_class.from_pretrained, returns the loaded copy when another pipe has it"""
+        key = (repo, subfolder, str(torch_dtype))
+        user = self.current_owner()
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry:
+                    entry['users'].add(user)
+                    return entry['module']
+                event = self.loading.get(key)
+                if event is None:
+                    event = self.loading[key] = threading.Event()
+                    break
+            # loaded by another thread (e.g. the preloader) right now
+            event.wait()
+
+        try:
+            module = load_model(component_class, repo, subfolder, torch_dtype, **kwargs)
+            with self.lock:
+                self.entries[key] = {'module': module, 'users': {user}, 'size': module_size(module)}
+            return module
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def release(self, pipeId):
+        """
+        Removes pipeId from the users, components without users are dropped. A dropped
+        component a parked pipe holds too goes back to host memory with that pipe.
+        """
+        with self.lock:
+            parked = {id(module) for modules in self.parked.values() for module in modules.values()}
+            dropped = []
+            for key in list(self.entries):
+                users = self.entries[key]['users']
+                users.discard(pipeId)
+                if not users:
+                    log(f'Dropped shared component {"/".join(str(part) for part in key if part)}')
+                    dropped.append(self.entries.pop(key)['module'])
+        for module in dropped:
+            if id(module) in parked:
+                module.to('cpu')
+
+    def park(self, pipeId):
+        """Releases the components of a pipe demoted to the host tier, restore() registers them again"""
+        with self.lock:
+            self.parked[pipeId] = {key: entry['module'] for key, entry in self.entries.items() if pipeId in entry['users']}
+        self.release(pipeId)
+
+    def unpark(self, pipeId):
+        with self.lock:
+            self.parked.pop(pipeId, None)
+
+    def parked_modules(self, pipeId):
+        """ids of the components other parked pipes hold, they are in host memory already"""
+        with self.lock:
+            return {id(module) for other, modules in self.parked.items() if other != pipeId for module in modules.values()}
+
+    def restore(self, pipeId, pipe):
+        """
+        Registers the components of a pipe promoted from the host tier, before it's moved
+        to the device. A component another pipe loaded meanwhile replaces the pipe's own
+        copy, so it's on the device only once.
+        """
+        with self.lock:
+            parked = self.parked.pop(pipeId, {})
+        for key, module in parked.items():
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    self.entries[key] = {'module': module, 'users': {pipeId}, 'size': module_size(module)}
+                    continue
+                entry['users'].add(pipeId)
+                loaded = entry['module']
+            if loaded is not module:
+                replace_component(pipe, module, loaded)
+
+    def shared(self, pipeId):
+        """True if another pipe uses one of the components of pipeId"""
+        with self.lock:
+            return any(pipeId in entry['users'] and len(entry['users']) > 1 for entry in self.entries.values())
+
+    def stats(self):
+        with self.lock:
+            pipes = {}
+            for entry in self.entries.values():
+                for user in entry['users']:
+                    usage = pipes.setdefault(user, {'shared': 0, 'attributed': 0})
+                    if len(entry['users']) > 1:
+                        usage['shared'] += entry['size']
+                    # the size of a component is split between its users
+                    usage['attributed'] += entry['size'] // len(entry['users'])
+            return {
+                'components': [
+                    {'key': '/'.join(str(part) for part in key if part), 'size': entry['size'], 'users': sorted(map(str, entry['users']))}
+                    for key, entry in self.entries.items()
+                ],
+                'pipes': {str(user): usage for user, usage in pipes.items()},
+            }
+
+
+components = ComponentRegistry()
+
+
+def sdxl_components(names=('vae', 'text_encoder', 'text_encoder_2', 'unet'), repo=SDXL_BASE, torch_dtype=None, variant="fp16"):
+    """Shared components of an SDXL checkpoint, to be passed to a pipeline's from_pretrained"""
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+    from transformers import CLIPTextModel, CLIPTextModelWithProjection
+    classes = {
+        'vae': AutoencoderKL,
+        'text_encoder': CLIPTextModel,
+        'text_encoder_2': CLIPTextModelWithProjection,
+        'unet': UNet2DConditionModel,
+    }
+    return {
+        name: components.from_pretrained(classes[name], repo, name, torch_dtype, variant=variant, use_safetensors=True)
+        for name in names
+    }
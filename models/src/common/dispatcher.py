@@ -0,0 +1,166 @@
+import asyncio
+import bisect
+import itertools
+import threading
+import time
+from common.utils import log
+
+
+class WorkQueue:
+    """
+    Requests handed from the dispatcher to the GPU executor, ordered by priority(json_data)
+    (lower first), then by arrival. A request carries its place in the queue as queue_key,
+    so one taken and put back returns to it. take() lets collect_batch wait for
+    batchable requests while everything else stays queued.
+    """
+
+    FRONT = -1  # priority of put(front=True), ahead of every class, in arrival order
+
+    def __init__(self, priority=None):
+        self.items = []  # (priority, sequence, json_data), sorted
+        self.priority = priority or (lambda json_data: 0)
+        self.sequence = itertools.count()
+        self.front_sequence = itertools.count(-1, -1)
+        self.condition = threading.Condition()
+        self.active = None  # request being executed
+        self.active_since = None
+
+    def put(self, json_data, front=False):
+        with self.condition:
+            if front:
+                self.insert((self.FRONT, next(self.sequence)), json_data)
+            else:
+                self.insert((self.priority(json_data), next(self.sequence)), json_data)
+
+    def put_back(self, messages):
+        """Puts taken messages back at the place they were queued at"""
+        with self.condition:
+            for json_data in messages:
+                key = json_data.get('queue_key') or (self.priority(json_data), next(self.front_sequence))
+                self.insert(tuple(key), json_data)
+
+    def insert(self, key, json_data):
+        json_data['queue_key'] = key
+        bisect.insort(self.items, (*key, json_data), key=lambda item: item[:2])
+        self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+            return self.items.pop(0)[2]
+
+    def take(self, match, limit, timeout=None):
+        """
+        Takes up to limit queued requests match(json_data) is true for, in queue order,
+        waiting up to timeout seconds for one to arrive. [] if none did.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while True:
+                taken = [item for item in self.items if match(item[2])][:limit]
+                if taken:
+                    taken_ids = {id(item) for item in taken}
+                    self.items = [item for item in self.items if id(item) not in taken_ids]
+                    return [item[2] for item in taken]
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return []
+                self.condition.wait(remaining)
+
+    def ahead(self, priority):
+        """Queued requests that run before a new one of this priority"""
+        with self.condition:
+            return [item[2] for item in self.items if item[0] <= priority]
+
+    def remove(self, uuid):
+        """Takes the queued request with this uuid out of the queue, returns it or None"""
+        with self.condition:
+            for item in self.items:
+                if item[2].get('uuid') == uuid:
+                    self.items.remove(item)
+                    return item[2]
+        return None
+
+    def __len__(self):
+        with self.condition:
+            return len(self.items)
+
+
+class Dispatcher:
+    """
+    Reads and parses the frames of the heavy socket on an asyncio loop, also while a
+    request runs. Messages with a handler in `control` are answered on the loop, all
+    others are queued to the GPU executor thread, which runs execute(json_data, messages)
+    one request at a time. Requests left in `messages` (e.g. waiting on the result of
+    another) go back to their place in the queue. Responses carry the request uuid, so any number
+    of requests can be in flight on the connection. on_queue(json_data) is called on the
+    loop for every request before it's queued, e.g. to start preparing its inputs; if it
+    returns False the request was answered and isn't queued. The queue is ordered by
+    priority(json_data), requests carry the time they were received as queued_at.
+    """
+
+    def __init__(self, channel, control, execute, on_queue=None, priority=None):
+        self.channel = channel
+        self.control = control
+        self.execute = execute
+        self.on_queue = on_queue
+        self.work = WorkQueue(priority)
+        self.executor = threading.Thread(target=self.run_executor, daemon=True)
+
+    def run(self):
+        """Serves the connection until the peer closes it"""
+        self.executor.start()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        closed = loop.create_future()
+        # the socket stays blocking for the threads sending responses, it's only read once readable
+        loop.add_reader(self.channel.sock.fileno(), self.on_readable, closed)
+        try:
+            await closed
+        finally:
+            loop.remove_reader(self.channel.sock.fileno())
+
+    def on_readable(self, closed):
+        try:
+            data = self.channel.sock.recv(65536)
+        except (ConnectionResetError, OSError) as e:
+            data = b''
+            log(f'Connection error: {e}')
+        if not data:
+            if not closed.done():
+                closed.set_result(None)
+            return
+        for json_data in self.channel.feed(data):
+            self.dispatch(json_data)
+
+    def dispatch(self, json_data):
+        handler = self.control.get(json_data.get('type'))
+        if handler is None:
+            json_data['queued_at'] = time.time()
+            if self.on_queue and self.on_queue(json_data) is False:
+                return
+            self.work.put(json_data)
+            return
+        try:
+            handler(json_data)
+        except Exception as e:
+            log(f'Handling {json_data.get("type")} failed: {e}')
+
+    def run_executor(self):
+        while True:
+            json_data = self.work.get()
+            messages = []
+            self.work.active_since = time.time()
+            self.work.active = json_data
+            try:
+                self.execute(json_data, messages)
+            except Exception as e:
+                log(f'Executing {json_data.get("type")} failed: {e}')
+            finally:
+                self.work.active = None
+                self.work.active_since = None
+                if messages:
+                    self.work.put_back(messages)
@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+from collections import deque
+
+
+class EvictionPolicy:
+    """
+    Tracks usage of the loaded pipes and decides which one to evict when VRAM is needed.
+    Subclasses only implement priority(), the pipe with the lowest priority is evicted.
+    """
+    name = None
+
+    def __init__(self, history_size=50):
+        self.lock = threading.Lock()
+        self.entries = {}  # pipeId -> {'size', 'cost', 'hits', 'last_access', 'loaded_at'}
+        self.sizes = {}  # pipeId -> VRAM measured on its last load, kept after it is evicted
+        self.hits = 0
+        self.misses = 0
+        self.evictions = deque(maxlen=history_size)
+
+    def on_load(self, pipeId, size, cost):
+        with self.lock:
+            self.misses += 1
+            now = time.time()
+            # pipes offloaded to the CPU barely allocate VRAM, count at least 1 MB
+            self.entries[pipeId] = {'size': max(size, 1024 ** 2), 'cost': cost, 'hits': 1, 'last_access': now, 'loaded_at': now}
+            self.sizes[pipeId] = self.entries[pipeId]['size']
+            self.on_inserted(pipeId)
+
+    def estimate(self, pipeId):
+        """VRAM the pipe took the last time it was loaded, 0 if it never was"""
+        with self.lock:
+            return self.sizes.get(pipeId, 0)
+
+    def on_hit(self, pipeId):
+        with self.lock:
+            self.hits += 1
+            self.touch(pipeId)
+
+    def on_access(self, pipeId):
+        with self.lock:
+            self.touch(pipeId)
+
+    def on_remove(self, pipeId):
+        with self.lock:
+            self.entries.pop(pipeId, None)
+            self.on_removed(pipeId)
+
+    def touch(self, pipeId):
+        entry = self.entries.get(pipeId)
+        if entry:
+            entry['hits'] += 1
+            entry['last_access'] = time.time()
+            self.on_touched(pipeId)
+
+    def on_inserted(self, pipeId):
+        pass
+
+    def on_touched(self, pipeId):
+        pass
+
+    def priority(self, pipeId, entry):
+        raise NotImplementedError
+
+    def choose_victim(self, pipeIds):
+        with self.lock:
+            candidates = [pipeId for pipeId in pipeIds if pipeId in self.entries]
+            if not candidates:
+                # not tracked (should not happen), fall back to insertion order
+                return next(iter(pipeIds))
+            victim = min(candidates, key=lambda pipeId: self.priority(pipeId, self.entries[pipeId]))
+            self.on_evicted(victim)
+            entry = self.entries.pop(victim)
+            self.evictions.append({
+                'pipeId': victim,
+                'time': int(time.time()),
+                'hits': entry['hits'],
+                'size': entry['size'],
+                'cost': entry['cost'],
+                'idle': round(time.time() - entry['last_access'], 2),
+                'candidates': len(candidates),
+            })
+            return victim
+
+    def on_evicted(self, pipeId):
+        pass
+
+    def on_removed(self, pipeId):
+        pass
+
+    def stats(self, detailed=False):
+        with self.lock:
+            requests = self.hits + self.misses
+            stats = {
+                'policy': self.name,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / requests, 4) if requests else None,
+            }
+            if detailed:
+                stats['pipes'] = {
+                    pipeId: {'hits': entry['hits'], 'size': entry['size'], 'cost': entry['cost']}
+                    for pipeId, entry in self.entries.items()
+                }
+                stats['evictions'] = list(self.evictions)
+            return stats
+
+
+class LRUPolicy(EvictionPolicy):
+    name = 'lru'
+
+    def priority(self, pipeId, entry):
+        return entry['last_access']
+
+
+class LFUPolicy(EvictionPolicy):
+    name = 'lfu'
+
+    def priority(self, pipeId, entry):
+        return (entry['hits'], entry['last_access'])
+
+
+class GreedyDualSizePolicy(EvictionPolicy):
+    """
+    GreedyDual-Size: H = L + cost / size, refreshed on every access. Evicting a pipe
+    raises the inflation value L to its H, so pipes that are not used age out even
+    when they are expensive to reload.
+    """
+    name = 'gds'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inflation = 0.0
+        self.h_values = {}
+
+    def value(self, entry):
+        # cost in seconds, size in GB
+        return self.inflation + entry['cost'] / (entry['size'] / 1024 ** 3)
+
+    def on_inserted(self, pipeId):
+        self.h_values[pipeId] = self.value(self.entries[pipeId])
+
+    def on_touched(self, pipeId):
+        self.h_values[pipeId] = self.value(self.entries[pipeId])
+
+    def on_evicted(self, pipeId):
+        self.inflation = self.h_values.pop(pipeId, self.inflation)
+
+    def on_removed(self, pipeId):
+        self.h_values.pop(pipeId, None)
+
+    def priority(self, pipeId, entry):
+        return (self.h_values.get(pipeId, self.inflation), entry['last_access'])
+
+
+EVICTION_POLICIES = {policy.name: policy for policy in (LRUPolicy, LFUPolicy, GreedyDualSizePolicy)}
+
+
+def make_room(pipeIds, policy, required, available, evict, shrink=lambda required: 0):
+    """
+    Evicts pipes chosen by the policy until available() reports at least required bytes.
+    shrink(missing) can give memory back first, it returns the bytes it freed.
+    """
+    while pipeIds:
+        current = available()
+        if current >= required:
+            break
+        if shrink(required - current):
+            continue
+        evict(policy.choose_victim(pipeIds))
+
+
+def create_eviction_policy(name=None):
+    name = name or os.environ.get('EVICTION_POLICY', 'lru')
+    if name not in EVICTION_POLICIES:
+        raise ValueError(f'Unknown EVICTION_POLICY {name}, expected one of {", ".join(EVICTION_POLICIES)}')
+    return EVICTION_POLICIES[name]()
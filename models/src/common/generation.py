@@ -0,0 +1,335 @@
+import time
+import queue
+import threading
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache, StoppingCriteria
+from common.utils import log
+
+
+def cache_layers(cache):
+    """Returns [(keys, values)] per layer, each [batch, heads, length, head_dim]"""
+    if hasattr(cache, 'layers'):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, 'key_cache'):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(layer[0], layer[1]) for layer in cache]
+
+
+def build_cache(layers):
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def left_pad(tensor, length, dim, value=0):
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad = [0, 0] * (tensor.dim() - dim - 1) + [missing, 0]
+    return F.pad(tensor, pad, value=value)
+
+
+class CancelCriteria(StoppingCriteria):
+    """Stopping criterion of model.generate, ends a cancelled generation at the next token"""
+
+    def __init__(self, cancel, max_new_tokens=None):
+        self.cancel = cancel
+        self.max_new_tokens = max_new_tokens
+        self.tokens = 0
+        self.started = time.time()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.tokens += 1
+        cancelled = self.cancel.cancelled
+        if cancelled:
+            self.cancel.stopped(self.tokens, self.max_new_tokens, self.started, 'tokens')
+        return torch.full((input_ids.shape[0],), cancelled, dtype=torch.bool, device=input_ids.device)
+
+
+class GenerationRequest:
+    def __init__(self, input_ids, on_finish, streamer=None, max_new_tokens=500, min_new_tokens=0,
+                 temperature=1.0, top_k=50, top_p=1.0, do_sample=True, eos_token_ids=None,
+                 stop_sequences=None, tokenizer=None, seed=None, cancel=None):
+        self.input_ids = list(input_ids)
+        self.on_finish = on_finish
+        self.streamer = streamer
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.do_sample = do_sample and temperature > 0
+        self.eos_token_ids = set(eos_token_ids or [])
+        self.stop_sequences = [s for s in (stop_sequences or []) if s]
+        self.tokenizer = tokenizer
+        self.generator = None
+        self.seed = seed
+        self.cancel = cancel  # CancelToken, a cancelled request leaves the batch at the next token
+        self.generated = []
+        self.cached_tokens = 0  # prompt tokens reused from the prefix cache
+        self.stopped_by = None
+        self.submitted_at = time.time()
+        self.first_token_at = None
+        self.done = threading.Event()
+
+    @property
+    def position(self):
+        """Position id of the last token"""
+        return len(self.input_ids) + len(self.generated) - 1
+
+    def is_finished(self):
+        if self.cancel and self.cancel.cancelled:
+            self.stopped_by = 'cancelled'
+        elif not self.generated:
+            return False
+        elif self.generated[-1] in self.eos_token_ids and len(self.generated) >= self.min_new_tokens:
+            self.stopped_by = 'eos'
+        elif len(self.generated) >= self.max_new_tokens:
+            self.stopped_by = 'length'
+        elif self.stop_sequences and self.tokenizer:
+            # only the tail can complete a stop sequence
+            tail = self.tokenizer.decode(self.generated[-16:], skip_special_tokens=True)
+            if any(stop in tail for stop in self.stop_sequences):
+                self.stopped_by = 'stop_sequence'
+        return self.stopped_by is not None
+
+    def text(self):
+        text = self.tokenizer.decode(self.generated, skip_special_tokens=True)
+        if self.stopped_by == 'stop_sequence':
+            cut = min((text.find(stop) for stop in self.stop_sequences if stop in text), default=len(text))
+            text = text[:cut]
+        return text
+
+
+class GenerationEngine:
+    """
+    Continuous batching: a single decode batch shared by all running requests.
+    New requests are prefilled on their own and join the batch at the next token
+    boundary, finished requests leave it right away. The batch KV cache is left
+    padded, the attention mask hides the padding and position ids are per request.
+    """
+
+    def __init__(self, model, tokenizer=None, max_batch_size=8, device=None, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.device = device or model.device
+        self.waiting = queue.Queue()
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = False
+        self.idle = threading.Event()
+        self.idle.set()
+        self.steps = 0
+
+    def submit(self, request):
+        if request.tokenizer is None:
+            request.tokenizer = self.tokenizer
+        if request.seed is not None:
+            request.generator = torch.Generator(self.device).manual_seed(int(request.seed))
+        with self.lock:
+            self.idle.clear()
+            self.waiting.put(request)
+            if self.thread is None:
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """Lets the running requests finish and stops the engine thread"""
+        self.idle.wait()
+        with self.lock:
+            self.stopping = True
+            thread, self.thread = self.thread, None
+        if thread:
+            self.waiting.put(None)
+            thread.join()
+
+    def stats(self):
+        stats = {'active': len(self.active), 'waiting': self.waiting.qsize(), 'steps': self.steps}
+        if self.prefix_cache:
+            stats['prefixCache'] = self.prefix_cache.stats()
+        return stats
+
+    def run(self):
+        while True:
+            admitted = []
+            try:
+                while len(self.active) + len(admitted) < self.max_batch_size:
+                    # block only when there is nothing to decode
+                    block = not self.active and not admitted
+                    request = self.waiting.get(block=block)
+                    if request is None:
+                        return
+                    admitted.append(request)
+            except queue.Empty:
+                pass
+
+            try:
+                with torch.inference_mode():
+                    for request in admitted:
+                        self.prefill(request)
+                    if self.active:
+                        self.decode_step()
+            except Exception as e:
+                log(f'Generation failed: {e}')
+                for request in self.active + [r for r in admitted if r not in self.active and not r.done.is_set()]:
+                    self.complete(request, error=str(e))
+                self.active, self.cache, self.attention_mask = [], None, None
+
+            with self.lock:
+                if not self.active and self.waiting.empty():
+                    self.idle.set()
+                    if self.stopping:
+                        return
+
+    def prefill(self, request):
+        if request.is_finished():
+            # cancelled while waiting, its prompt is never computed
+            self.finish(request)
+            return
+
+        if request.streamer:
+            request.streamer.put(torch.tensor([request.input_ids]))
+
+        past_key_values = None
+        if self.prefix_cache:
+            # keep at least one prompt token to compute, its logits give the first token
+            request.cached_tokens, cached_layers = self.prefix_cache.match(request.input_ids[:-1])
+            if cached_layers:
+                past_key_values = build_cache(cached_layers)
+
+        input_ids = torch.tensor([request.input_ids[request.cached_tokens:]], device=self.device)
+        output = self.model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+        layers = cache_layers(output.past_key_values)
+        if self.prefix_cache:
+            self.prefix_cache.insert(request.input_ids, layers)
+            self.prefix_cache.record(request.cached_tokens, len(request.input_ids) - request.cached_tokens)
+
+        token = self.sample(request, output.logits[0, -1])
+        self.append_token(request, token)
+
+        if request.is_finished():
+            self.finish(request)
+            return
+
+        self.merge(request, layers)
+
+    def merge(self, request, layers):
+        new_length = layers[0][0].shape[2]
+        new_mask = torch.ones((1, new_length), dtype=torch.long, device=self.device)
+
+        if self.cache is None:
+            self.cache = build_cache(layers)
+            self.attention_mask = new_mask
+        else:
+            length = max(self.attention_mask.shape[1], new_length)
+            merged = []
+            for (keys, values), (new_keys, new_values) in zip(cache_layers(self.cache), layers):
+                merged.append((
+                    torch.cat([left_pad(keys, length, 2), left_pad(new_keys, length, 2)]),
+                    torch.cat([left_pad(values, length, 2), left_pad(new_values, length, 2)]),
+                ))
+            self.cache = build_cache(merged)
+            self.attention_mask = torch.cat([left_pad(self.attention_mask, length, 1), left_pad(new_mask, length, 1)])
+        self.active.append(request)
+
+    def decode_step(self):
+        self.steps += 1
+        input_ids = torch.tensor([[request.generated[-1]] for request in self.active], device=self.device)
+        position_ids = torch.tensor([[request.position] for request in self.active], device=self.device)
+        self.attention_mask = torch.cat([
+            self.attention_mask,
+            torch.ones((len(self.active), 1), dtype=self.attention_mask.dtype, device=self.device)
+        ], dim=1)
+
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = output.past_key_values
+        logits = output.logits[:, -1]
+
+        finished = []
+        for row, request in enumerate(self.active):
+            self.append_token(request, self.sample(request, logits[row]))
+            if request.is_finished():
+                finished.append(row)
+
+        if finished:
+            self.retire(finished)
+
+    def retire(self, rows):
+        for row in rows:
+            self.finish(self.active[row])
+
+        keep = [row for row in range(len(self.active)) if row not in rows]
+        self.active = [self.active[row] for row in keep]
+        if not self.active:
+            self.cache, self.attention_mask = None, None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop the columns that are padding for every remaining request
+        start = int((attention_mask.cumsum(dim=1) == 0).sum(dim=1).min())
+        self.attention_mask = attention_mask[:, start:]
+        self.cache = build_cache([
+            (keys.index_select(0, index)[:, :, start:], values.index_select(0, index)[:, :, start:])
+            for keys, values in cache_layers(self.cache)
+        ])
+
+    def sample(self, request, logits):
+        logits = logits.float()
+        if len(request.generated) < request.min_new_tokens and request.eos_token_ids:
+            logits[list(request.eos_token_ids)] = -float('inf')
+
+        if not request.do_sample:
+            return int(logits.argmax())
+
+        logits = logits / request.temperature
+        if request.top_k and request.top_k > 0:
+            top_k = min(request.top_k, logits.shape[-1])
+            threshold = torch.topk(logits, top_k).values[-1]
+            logits[logits < threshold] = -float('inf')
+        if request.top_p is not None and request.top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            remove = cumulative > request.top_p
+            remove[1:] = remove[:-1].clone()
+            remove[0] = False
+            logits[sorted_indices[remove]] = -float('inf')
+
+        probs = torch.softmax(logits, dim=-1)
+        return int(torch.multinomial(probs, 1, generator=request.generator))
+
+    def append_token(self, request, token):
+        if request.first_token_at is None:
+            request.first_token_at = time.time()
+        request.generated.append(token)
+        if request.streamer and not (token in request.eos_token_ids):
+            request.streamer.put(torch.tensor([token]))
+
+    def finish(self, request):
+        if request.streamer:
+            request.streamer.end()
+        if request.stopped_by == 'cancelled':
+            request.cancel.stopped(len(request.generated), request.max_new_tokens, request.submitted_at, 'tokens')
+            self.complete(request, error=f'Request cancelled ({request.cancel.reason})')
+            return
+        self.complete(request)
+
+    def complete(self, request, error=None):
+        try:
+            request.on_finish(request, error)
+        finally:
+            request.done.set()
@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import shutil
+from common.utils import log
+from common.progress import finish_stream
+from common.stages import Deferred
+
+# Encoded images are handed to the cluster through POSIX shared memory (tmpfs)
+# so the PNG never touches the disk. IMAGE_HANDOFF=file keeps the tmp_images files.
+SHM_DIR = '/dev/shm'
+use_shm = os.environ.get('IMAGE_HANDOFF', 'shm') == 'shm' and os.path.isdir(SHM_DIR)
+
+
+def save_image(image, requestUUID, suffix=''):
+    """Encodes the image and returns the CALL_PIPE_RESPONSE fields referencing it"""
+    if use_shm:
+        name = f'openkbs-{requestUUID}{suffix}.png'
+        path = os.path.join(SHM_DIR, name)
+        try:
+            image.save(path, format='PNG')
+            return {'shm': name, 'size': os.path.getsize(path)}
+        except OSError as e:
+            log(f'Unable to write {name} to shared memory, using tmp_images: {e}')
+            if os.path.exists(path):
+                os.remove(path)
+
+    filepath = f"tmp_images/{requestUUID}{suffix}.png"
+    image.save(filepath)
+    return {'filepath': filepath}
+
+
+def image_response(image, requestUUID, fields, suffix='', streamer=None):
+    """
+    Deferred CALL_PIPE_RESPONSE with fields and the encoded image, the PNG is written
+    by the finish stage while the GPU runs the next request. Ends the stream if any.
+    """
+    def finish():
+        start_encode = time.time()
+        image_fields = save_image(image, requestUUID, suffix)
+        response = json.dumps({**fields, 'timeToEncode': round(time.time() - start_encode, 2), **image_fields})
+        return finish_stream(streamer, response)
+    return Deferred(finish)
+
+
+def image_path(fields):
+    """Local path of the image referenced by save_image fields"""
+    if 'shm' in fields:
+        return os.path.join(SHM_DIR, fields['shm'])
+    return fields['filepath']
+
+
+def copy_image(path, requestUUID, suffix=''):
+    """Same as save_image for an already encoded PNG file"""
+    if use_shm:
+        name = f'openkbs-{requestUUID}{suffix}.png'
+        try:
+            shutil.copyfile(path, os.path.join(SHM_DIR, name))
+            return {'shm': name, 'size': os.path.getsize(path)}
+        except OSError as e:
+            log(f'Unable to write {name} to shared memory, using tmp_images: {e}')
+            if os.path.exists(os.path.join(SHM_DIR, name)):
+                os.remove(os.path.join(SHM_DIR, name))
+
+    filepath = f"tmp_images/{requestUUID}{suffix}.png"
+    shutil.copyfile(path, filepath)
+    return {'filepath': filepath}
@@ -0,0 +1,67 @@
+import os
+import time
+import threading
+import importlib.util
+from common.utils import log
+
+# pipeId -> {'module', 'mtime', 'path', 'import_time', 'imports'}
+pipe_modules = {}
+pipe_modules_lock = threading.Lock()
+
+
+def get_module_path(pipeId):
+    pipeId_parts = pipeId.split('--')
+    return os.path.join('models', 'pipe', *pipeId_parts, 'index.py')
+
+
+def import_pipe_module(pipeId, module_path):
+    module_name = 'pipe_' + pipeId.replace('--', '__').replace('-', '_').replace('.', '_')
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_module(pipeId):
+    """
+    Returns the imported index.py of a pipe. The module is executed only once and
+    re-imported only when the file's mtime changes.
+    """
+    module_path = get_module_path(pipeId)
+    mtime = os.path.getmtime(module_path)
+
+    with pipe_modules_lock:
+        entry = pipe_modules.get(pipeId)
+        if entry and entry['mtime'] == mtime:
+            return entry['module']
+
+        start_import = time.time()
+        module = import_pipe_module(pipeId, module_path)
+        import_time = round(time.time() - start_import, 2)
+
+        imports = entry['imports'] + 1 if entry else 1
+        pipe_modules[pipeId] = {
+            'module': module,
+            'mtime': mtime,
+            'path': module_path,
+            'import_time': import_time,
+            'imports': imports,
+        }
+
+        log(f'{"reimported" if entry else "imported"} {pipeId} in {import_time}s')
+        return module
+
+
+def get_import_time(pipeId):
+    entry = pipe_modules.get(pipeId)
+    return entry['import_time'] if entry else None
+
+
+def get_modules_stats():
+    # read from the light socket thread while the executor imports
+    with pipe_modules_lock:
+        entries = list(pipe_modules.items())
+    return {
+        pipeId: {'timeToImport': entry['import_time'], 'imports': entry['imports']}
+        for pipeId, entry in entries
+    }
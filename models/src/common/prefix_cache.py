@@ -0,0 +1,158 @@
+import os
+import time
+import threading
+import torch
+
+
+class RadixNode:
+    def __init__(self, tokens=(), layers=None, parent=None):
+        self.tokens = tuple(tokens)  # edge label
+        self.layers = layers or []  # [(keys, values)] for the edge tokens only
+        self.parent = parent
+        self.children = {}  # first token of the child edge -> RadixNode
+        self.last_access = time.time()
+
+    @property
+    def size(self):
+        return sum(keys.numel() * keys.element_size() + values.numel() * values.element_size() for keys, values in self.layers)
+
+
+def slice_layers(layers, start, end=None):
+    return [(keys[:, :, start:end].clone(), values[:, :, start:end].clone()) for keys, values in layers]
+
+
+class PrefixCache:
+    """
+    KV cache of prompt prefixes in a radix tree over token ids. Each node holds the
+    keys/values of its edge, so shared prefixes (system prompts, chat histories) are
+    stored once. Least recently used leaves are evicted to stay within the budget.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.root = RadixNode()
+        self.used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.cached_tokens = 0
+        self.computed_tokens = 0
+
+    def match(self, tokens):
+        """Returns (length, [(keys, values)]) of the longest cached prefix of tokens"""
+        with self.lock:
+            node, length, path = self.root, 0, []
+            now = time.time()
+            while length < len(tokens):
+                child = node.children.get(tokens[length])
+                if child is None:
+                    break
+                common = 0
+                for a, b in zip(child.tokens, tokens[length:]):
+                    if a != b:
+                        break
+                    common += 1
+                child.last_access = now
+                path.append((child, common))
+                length += common
+                if common < len(child.tokens):
+                    break
+                node = child
+
+            if not length:
+                return 0, None
+            layers = []
+            for layer_idx in range(len(path[0][0].layers)):
+                layers.append((
+                    torch.cat([child.layers[layer_idx][0][:, :, :common] for child, common in path], dim=2),
+                    torch.cat([child.layers[layer_idx][1][:, :, :common] for child, common in path], dim=2),
+                ))
+            return length, layers
+
+    def insert(self, tokens, layers):
+        """Stores the keys/values of tokens, layers span the whole token sequence"""
+        with self.lock:
+            node, length = self.root, 0
+            while length < len(tokens):
+                child = node.children.get(tokens[length])
+                if child is None:
+                    leaf = RadixNode(tokens[length:], slice_layers(layers, length), node)
+                    node.children[tokens[length]] = leaf
+                    self.used += leaf.size
+                    break
+                common = 0
+                for a, b in zip(child.tokens, tokens[length:]):
+                    if a != b:
+                        break
+                    common += 1
+                if common < len(child.tokens):
+                    child = self.split(child, common)
+                child.last_access = time.time()
+                node = child
+                length += common
+            self.evict()
+
+    def split(self, node, at):
+        """Splits the edge of node at position at, returns the new upper node"""
+        upper = RadixNode(node.tokens[:at], slice_layers(node.layers, 0, at), node.parent)
+        upper.children[node.tokens[at]] = node
+        upper.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = upper
+        node.layers = slice_layers(node.layers, at)
+        node.tokens = node.tokens[at:]
+        node.parent = upper
+        return upper
+
+    def evict(self):
+        while self.used > self.budget:
+            leaves = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                elif node is not self.root:
+                    leaves.append(node)
+            if not leaves:
+                break
+            victim = min(leaves, key=lambda leaf: leaf.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self.used -= victim.size
+
+    def headroom(self):
+        """Bytes the cache may still allocate before it starts evicting"""
+        with self.lock:
+            return max(self.budget - self.used, 0)
+
+    def resize(self, budget):
+        """Changes the budget, evicting least recently used prefixes down to it"""
+        with self.lock:
+            self.budget = max(int(budget), 0)
+            self.evict()
+
+    def record(self, cached, computed):
+        with self.lock:
+            if cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.cached_tokens += cached
+            self.computed_tokens += computed
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'used': self.used,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / requests, 4) if requests else None,
+                'cachedTokens': self.cached_tokens,
+                'computedTokens': self.computed_tokens,
+            }
+
+
+def create_prefix_cache():
+    budget = int(float(os.environ.get('PREFIX_CACHE_GB', '2')) * 1024 ** 3)
+    return PrefixCache(budget) if budget else None
@@ -0,0 +1,130 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict, defaultdict
+from common.utils import log
+from common.modules import get_module
+from common.components import components
+
+
+class Preloader:
+    """
+    Runs the host RAM phase of a pipe (module.load_in_ram) on a background thread
+    while the request loop keeps serving inference. load_pipe then takes the staged
+    pipe and only does the device transfer. Pipes without load_in_ram are skipped.
+    """
+
+    def __init__(self, max_ready=1):
+        self.max_ready = max_ready
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.ready = OrderedDict()  # pipeId -> staged pipe dict
+        self.pending = {}  # pipeId -> threading.Event, set once the pipe is staged or failed
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, pipeId):
+        """Queues a pipe for preloading, returns the preload status"""
+        if not hasattr(get_module(pipeId), 'load_in_ram'):
+            return 'unsupported'
+        with self.lock:
+            if pipeId in self.ready:
+                return 'ready'
+            if pipeId in self.pending:
+                return 'pending'
+            self.pending[pipeId] = threading.Event()
+        self.requests.put(pipeId)
+        return 'queued'
+
+    def run(self):
+        while True:
+            pipeId = self.requests.get()
+            staged = None
+            try:
+                start_preload = time.time()
+                with components.owner(pipeId):
+                    staged = get_module(pipeId).load_in_ram()
+                log(f'Preloaded {pipeId} in RAM in {round(time.time() - start_preload, 2)}s')
+            except Exception as e:
+                log(f'Preloading {pipeId} failed: {e}')
+                components.release(pipeId)
+
+            with self.lock:
+                if staged is not None:
+                    self.ready[pipeId] = staged
+                    while len(self.ready) > self.max_ready:
+                        dropped, _ = self.ready.popitem(last=False)
+                        components.release(dropped)
+                        log(f'Dropped preloaded {dropped}')
+                self.pending.pop(pipeId).set()
+
+    def take(self, pipeId):
+        """Returns the staged pipe, waiting for an in progress preload, or None"""
+        with self.lock:
+            event = self.pending.get(pipeId)
+        if event:
+            event.wait()
+        with self.lock:
+            return self.ready.pop(pipeId, None)
+
+    def discard(self, pipeId):
+        with self.lock:
+            if self.ready.pop(pipeId, None) is not None:
+                components.release(pipeId)
+
+    def stats(self):
+        with self.lock:
+            return {'ready': list(self.ready.keys()), 'pending': list(self.pending.keys())}
+
+
+class PipePredictor:
+    """
+    First order model of the request stream: counts which pipe follows which and
+    predicts the most likely next pipe once it has been seen often enough.
+    """
+
+    def __init__(self, min_count=3, min_probability=0.3, history_size=1000):
+        self.min_count = min_count
+        self.min_probability = min_probability
+        self.history_size = history_size
+        self.transitions = defaultdict(lambda: defaultdict(int))
+        self.observed = 0
+        self.last = None
+
+    def observe(self, pipeId):
+        if self.last is not None and self.last != pipeId:
+            self.transitions[self.last][pipeId] += 1
+            self.observed += 1
+            if self.observed > self.history_size:
+                self.decay()
+        self.last = pipeId
+
+    def decay(self):
+        # halve all counts so the model follows traffic changes
+        for following in self.transitions.values():
+            for pipeId in list(following):
+                following[pipeId] //= 2
+                if not following[pipeId]:
+                    del following[pipeId]
+        self.observed //= 2
+
+    def predict(self, pipeId):
+        following = self.transitions.get(pipeId)
+        if not following:
+            return None
+        total = sum(following.values())
+        candidate, count = max(following.items(), key=lambda item: item[1])
+        if count >= self.min_count and count / total >= self.min_probability:
+            return candidate
+        return None
+
+
+def create_preloader():
+    return Preloader(int(os.environ.get('PRELOAD_MAX_READY', '1')))
+
+
+def create_predictor():
+    if os.environ.get('PRELOAD_PREDICT') != '1':
+        return None
+    return PipePredictor()
@@ -0,0 +1,162 @@
+import io
+import json
+import math
+import time
+import base64
+import torch
+from PIL import Image
+from common.cancellation import cancellations
+
+PREVIEW_MAX_SIZE = 256
+PREVIEW_QUALITY = 70
+# share of the elapsed denoising time previews may take, later previews are skipped beyond it
+MAX_PREVIEW_OVERHEAD = 0.05
+
+# linear latent -> RGB projections, rows are latent channels
+LATENT_RGB_SD15 = ([
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+], [0, 0, 0])
+LATENT_RGB_SDXL = ([
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+], [0.1084, -0.0175, -0.0011])
+LATENT_RGB_SD3 = ([
+    [-0.0922, -0.0175, 0.0749],
+    [0.0311, 0.0633, 0.0954],
+    [0.1994, 0.0927, 0.0458],
+    [0.0856, 0.0339, 0.0902],
+    [0.0587, 0.0272, -0.0496],
+    [-0.0006, 0.1104, 0.0309],
+    [0.0978, 0.0306, 0.0427],
+    [-0.0042, 0.1038, 0.1358],
+    [-0.0194, 0.0020, 0.0669],
+    [-0.0488, 0.0130, -0.0268],
+    [0.0922, 0.0988, 0.0951],
+    [-0.0278, 0.0524, -0.0542],
+    [0.0332, 0.0456, 0.0895],
+    [-0.0069, -0.0030, -0.0810],
+    [-0.0596, -0.0465, -0.0293],
+    [-0.1448, -0.1463, -0.1189],
+], [0.2394, 0.2135, 0.1925])
+LATENT_RGB_FLUX = ([
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+], [-0.0329, -0.0718, -0.0851])
+
+
+def latent_rgb(pipe, channels):
+    name = type(pipe).__name__
+    if channels == 4:
+        return LATENT_RGB_SDXL if 'XL' in name else LATENT_RGB_SD15
+    if channels == 16:
+        return LATENT_RGB_FLUX if 'Flux' in name else LATENT_RGB_SD3
+    return None
+
+
+def latent_preview(pipe, latents, aspect_ratio=1.0):
+    """JPEG data URL of the first image of a batch of latents, None for unknown latent spaces"""
+    latents = latents[0].detach()
+    if latents.ndim == 2:
+        # packed FLUX latents: (h/2 * w/2, 16 channels * 2 * 2), averaged per 2x2 patch
+        height = max(round(math.sqrt(latents.shape[0] * aspect_ratio)), 1)
+        width = latents.shape[0] // height
+        latents = latents[:height * width].reshape(height, width, -1, 4).mean(-1)
+    else:
+        latents = latents.permute(1, 2, 0)
+
+    projection = latent_rgb(pipe, latents.shape[-1])
+    if projection is None:
+        return None
+    factors, bias = (torch.tensor(values, dtype=torch.float32, device=latents.device) for values in projection)
+    rgb = ((latents.float() @ factors + bias + 1) / 2).clamp(0, 1)
+    image = Image.fromarray((rgb * 255).to(torch.uint8).cpu().numpy())
+    image.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=PREVIEW_QUALITY)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+class DiffusionProgress:
+    """
+    callback_on_step_end of the diffusers pipelines, sends a STREAM event per step and
+    a latent preview every preview_steps steps, as long as previews stay within
+    MAX_PREVIEW_OVERHEAD of the time spent denoising. A cancelled request is stopped
+    by raising Cancelled at the end of the step, before the remaining steps and the VAE.
+    """
+
+    def __init__(self, streamer, preview_steps=0, aspect_ratio=1.0, stage=None, cancel=None):
+        self.streamer = streamer
+        self.preview_steps = preview_steps
+        self.aspect_ratio = aspect_ratio
+        self.stage = stage
+        self.cancel = cancel
+        self.started = time.time()
+        self.preview_time = 0
+
+    def __call__(self, pipe, step, timestep, callback_kwargs):
+        if self.cancel and self.cancel.cancelled:
+            self.cancel.stopped(step + 1, getattr(pipe, 'num_timesteps', None), self.started)
+            self.cancel.check()
+        if not self.streamer:
+            return callback_kwargs
+
+        event = {'step': step + 1, 'steps': getattr(pipe, 'num_timesteps', None)}
+        if self.stage:
+            event['stage'] = self.stage
+
+        elapsed = time.time() - self.started
+        if self.preview_steps and (step + 1) % self.preview_steps == 0 and self.preview_time <= MAX_PREVIEW_OVERHEAD * elapsed:
+            start_preview = time.time()
+            preview = latent_preview(pipe, callback_kwargs['latents'], self.aspect_ratio)
+            self.preview_time += time.time() - start_preview
+            if preview:
+                event['preview'] = preview
+
+        self.streamer.put_event(**event)
+        return callback_kwargs
+
+
+def progress_kwargs(streamer, payload, config_dict, stage=None):
+    """
+    Pipeline call arguments streaming the progress of a stream request and stopping
+    the request running on this thread once it's cancelled, {} outside of a request.
+    """
+    cancel = cancellations.current()
+    if not streamer and not cancel:
+        return {}
+    height, width = config_dict.get('height'), config_dict.get('width')
+    progress = DiffusionProgress(
+        streamer,
+        preview_steps=int(payload.get('preview_steps', 0)),
+        aspect_ratio=float(height) / float(width) if height and width else 1.0,
+        stage=stage,
+        cancel=cancel,
+    )
+    return {'callback_on_step_end': progress, 'callback_on_step_end_tensor_inputs': ['latents']}
+
+
+def finish_stream(streamer, response):
+    """Ends the stream of a stream request, its done message carries the image fields"""
+    if streamer:
+        fields = json.loads(response)
+        streamer.end(**{key: value for key, value in fields.items() if key not in ('type', 'uuid')})
+    return response
@@ -0,0 +1,130 @@
+import os
+import inspect
+import threading
+import torch
+from collections import OrderedDict
+
+PROMPT_KEYS = ('prompt', 'prompt_2', 'negative_prompt', 'negative_prompt_2')
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of CLIP text encoder outputs keyed by (pipeId, text encoder, text).
+    Negative and style prompts repeat a lot, so most calls skip the text encoders.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (pipeId, encoder, text) -> (hidden_states, pooled)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pipeId, encoder, text, compute):
+        key = (pipeId, encoder, text)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def discard(self, pipeId):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == pipeId]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'maxEntries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / requests, 4) if requests else None,
+            }
+
+
+prompt_cache = PromptEmbeddingCache(int(os.environ.get('PROMPT_CACHE_SIZE', '256')))
+
+
+def encode_text(tokenizer, text_encoder, text):
+    """Same as StableDiffusionXLPipeline.encode_prompt for a single text and encoder"""
+    input_ids = tokenizer(
+        text, padding="max_length", max_length=tokenizer.model_max_length, truncation=True, return_tensors="pt"
+    ).input_ids
+    with torch.no_grad():
+        output = text_encoder(input_ids.to(text_encoder.device), output_hidden_states=True)
+    # only CLIPTextModelWithProjection (text_encoder_2) has a pooled output
+    pooled = output[0] if output[0].ndim == 2 else None
+    return output.hidden_states[-2], pooled
+
+
+def encode_prompt_pair(pipe, pipeId, texts):
+    """Returns (prompt_embeds, pooled_prompt_embeds) for one (text, text_2) pair"""
+    hidden_states, pooled = [], None
+    encoders = [('text_encoder', 'tokenizer'), ('text_encoder_2', 'tokenizer_2')]
+    for text, (encoder_name, tokenizer_name) in zip(texts, encoders):
+        text_encoder = getattr(pipe, encoder_name, None)
+        if text_encoder is None:
+            continue
+        encoded, encoded_pooled = prompt_cache.get(
+            pipeId, encoder_name, text,
+            lambda: encode_text(getattr(pipe, tokenizer_name), text_encoder, text)
+        )
+        hidden_states.append(encoded)
+        if encoded_pooled is not None:
+            pooled = encoded_pooled
+    return torch.cat(hidden_states, dim=-1), pooled
+
+
+def uses_negative_prompt(pipe, config_dict):
+    if getattr(pipe.unet.config, 'time_cond_proj_dim', None) is not None:
+        return False
+    guidance_scale = config_dict.get('guidance_scale')
+    if guidance_scale is None:
+        guidance_scale = inspect.signature(pipe.__call__).parameters['guidance_scale'].default
+    return float(guidance_scale) > 1
+
+
+def encode_prompts_sdxl(pipe, pipeId, config_dict):
+    """
+    Replaces the prompt strings of an SDXL config_dict (single values or lists for a
+    batch) by cached prompt_embeds/pooled_prompt_embeds and their negative counterparts.
+    """
+    if 'prompt' not in config_dict and 'prompt_2' not in config_dict:
+        return config_dict
+    prompts = {key: config_dict.pop(key) for key in PROMPT_KEYS if key in config_dict}
+
+    def as_list(value, size):
+        return value if isinstance(value, list) else [value] * size
+
+    size = max(len(value) if isinstance(value, list) else 1 for value in prompts.values())
+    prompt = as_list(prompts.get('prompt', prompts.get('prompt_2')), size)
+    prompt_2 = as_list(prompts.get('prompt_2'), size)
+    pairs = [(text, text_2 if text_2 is not None else text) for text, text_2 in zip(prompt, prompt_2)]
+    encoded = [encode_prompt_pair(pipe, pipeId, pair) for pair in pairs]
+    config_dict['prompt_embeds'] = torch.cat([embeds for embeds, _ in encoded])
+    config_dict['pooled_prompt_embeds'] = torch.cat([pooled for _, pooled in encoded])
+
+    if not uses_negative_prompt(pipe, config_dict):
+        return config_dict
+    if 'negative_prompt' not in prompts and getattr(pipe.config, 'force_zeros_for_empty_prompt', False):
+        # the pipeline uses zeroed negative embeddings
+        return config_dict
+
+    negative_prompt = as_list(prompts.get('negative_prompt') or "", size)
+    negative_prompt_2 = as_list(prompts.get('negative_prompt_2'), size)
+    pairs = [(text, text_2 or text) for text, text_2 in zip(negative_prompt, negative_prompt_2)]
+    encoded = [encode_prompt_pair(pipe, pipeId, pair) for pair in pairs]
+    config_dict['negative_prompt_embeds'] = torch.cat([embeds for embeds, _ in encoded])
+    config_dict['negative_pooled_prompt_embeds'] = torch.cat([pooled for _, pooled in encoded])
+    return config_dict
@@ -0,0 +1,197 @@
+import json
+import struct
+import base64
+import select
+import time
+import threading
+from common.utils import log
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Framed messages start with FRAME_MAGIC, which can never start a legacy newline
+# delimited JSON message, so both protocols can be served on the same socket.
+#
+# frame = header | body | attachment_length | attachment | ...
+# header = magic (u8), version (u8), encoding (u8), attachments count (u8), body length (u32 BE)
+FRAME_MAGIC = 0xFB
+PROTOCOL_VERSION = 1
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+
+HEADER = struct.Struct('>BBBBI')
+ATTACHMENT_LENGTH = struct.Struct('>I')
+
+
+def encode_body(message, encoding):
+    if encoding == ENCODING_MSGPACK:
+        if isinstance(message, str):
+            message = json.loads(message)
+        return msgpack.packb(message, use_bin_type=True)
+    if isinstance(message, str):
+        return message.encode()
+    return json.dumps(message).encode()
+
+
+def decode_body(body, encoding):
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def encode_frame(message, attachments=None, encoding=ENCODING_JSON):
+    attachments = attachments or []
+    body = encode_body(message, encoding)
+    parts = [HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, encoding, len(attachments), len(body)), body]
+    for attachment in attachments:
+        parts.append(ATTACHMENT_LENGTH.pack(len(attachment)))
+        parts.append(attachment)
+    return b''.join(parts)
+
+
+def encode_line(message, attachments=None):
+    """Legacy newline delimited JSON, attachments are inlined as base64"""
+    if attachments:
+        if isinstance(message, str):
+            message = json.loads(message)
+        message = dict(message)
+        message['attachments'] = [base64.b64encode(a).decode() for a in attachments]
+        message['attachmentsEncoding'] = 'base64'
+    if not isinstance(message, str):
+        message = json.dumps(message)
+    return (message + '\n').encode()
+
+
+def read_frame(buffer, offset):
+    """
+    Returns ((encoding, body, attachments), next_offset) or (None, offset) if the frame is incomplete.
+    Raises ValueError for a header it can't read, its length can't be trusted then.
+    """
+    if len(buffer) - offset < HEADER.size:
+        return None, offset
+
+    magic, version, encoding, attachments_count, body_length = HEADER.unpack_from(buffer, offset)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f'Unsupported protocol version {version}')
+
+    position = offset + HEADER.size
+    if len(buffer) < position + body_length:
+        return None, offset
+    body = bytes(buffer[position:position + body_length])
+    position += body_length
+
+    attachments = []
+    for _ in range(attachments_count):
+        if len(buffer) < position + ATTACHMENT_LENGTH.size:
+            return None, offset
+        (attachment_length,) = ATTACHMENT_LENGTH.unpack_from(buffer, position)
+        position += ATTACHMENT_LENGTH.size
+        if len(buffer) < position + attachment_length:
+            return None, offset
+        attachments.append(bytes(buffer[position:position + attachment_length]))
+        position += attachment_length
+
+    return (encoding, body, attachments), position
+
+
+def decode_message(encoding, body, attachments):
+    message = decode_body(body, encoding)
+    if attachments:
+        message['attachments'] = attachments
+    return message
+
+
+def decode_frame(buffer, offset):
+    """Returns (message, encoding, next_offset) or (None, None, offset) if the frame is incomplete"""
+    frame, position = read_frame(buffer, offset)
+    if frame is None:
+        return None, None, offset
+    return decode_message(*frame), frame[0], position
+
+
+class SocketChannel:
+    """
+    Wraps a connected unix socket. Incoming data is buffered until complete
+    messages are available, both framed and legacy newline messages are accepted.
+    Responses are sent with the protocol and encoding of the last received message.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.framed = False
+        self.encoding = ENCODING_JSON
+        self.send_lock = threading.Lock()
+
+    def parse_buffered(self):
+        messages = []
+        offset = 0
+        while offset < len(self.buffer):
+            # the buffer is advanced before decoding, a message that fails to decode is dropped alone
+            if self.buffer[offset] == FRAME_MAGIC:
+                try:
+                    frame, next_offset = read_frame(self.buffer, offset)
+                except ValueError as e:
+                    # the length of a frame with an unknown header can't be trusted, resync on the next data
+                    log(f'Unable to decode message: {e}')
+                    offset = len(self.buffer)
+                    break
+                if frame is None:
+                    break
+                offset = next_offset
+                framed, encoding = True, frame[0]
+                decode = lambda: decode_message(*frame)
+            else:
+                end = self.buffer.find(b'\n', offset)
+                if end == -1:
+                    break
+                line = bytes(self.buffer[offset:end]).strip()
+                offset = end + 1
+                if not line:
+                    continue
+                framed, encoding = False, self.encoding
+                decode = lambda: json.loads(line)
+
+            try:
+                messages.append(decode())
+            except Exception as e:
+                log(f'Unable to decode message: {e}')
+                continue
+            self.framed, self.encoding = framed, encoding
+        del self.buffer[:offset]
+        return messages
+
+    def feed(self, data):
+        """Adds data read from the socket elsewhere (e.g. by an event loop), returns the completed messages"""
+        self.buffer += data
+        return self.parse_buffered()
+
+    def receive(self, buffer_size=65536, timeout=None):
+        """Returns the next complete messages, or [] if nothing arrived within timeout seconds"""
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            messages = self.parse_buffered()
+            if messages:
+                return messages
+            if deadline is not None:
+                readable, _, _ = select.select([self.sock], [], [], max(deadline - time.time(), 0))
+                if not readable:
+                    return []
+            data = self.sock.recv(buffer_size)
+            if not data:
+                raise ConnectionResetError('Socket closed by peer')
+            self.buffer += data
+
+    def send(self, message, attachments=None):
+        if self.framed:
+            encoding = self.encoding if msgpack is not None else ENCODING_JSON
+            data = encode_frame(message, attachments, encoding)
+        else:
+            data = encode_line(message, attachments)
+        with self.send_lock:
+            return self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from common.utils import log
+from common.images import image_path, copy_image
+
+# response fields that belong to a single request
+REQUEST_FIELDS = ('uuid', 'CUDA_VISIBLE_DEVICES', 'shm', 'size', 'filepath', 'batchSize', 'timeToInference')
+
+
+def lock_is_stale(path, timeout):
+    """Lock files hold the pid of the worker computing the result"""
+    if time.time() - os.path.getmtime(path) > timeout:
+        return True
+    try:
+        with open(path) as f:
+            os.kill(int(f.read()), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, PermissionError):
+        pass
+    return False
+
+
+class ResultCache:
+    """
+    Content addressed store of finished CALL_PIPE_RESPONSEs and their images, shared
+    by the workers of the host. Keys come from module.result_key (pipe params incl.
+    the seed), so only deterministic requests are cached. A lock file per key makes
+    identical requests in flight, also on other devices, wait for a single execution.
+    Least recently used results are removed to stay within the budget.
+    """
+
+    def __init__(self, directory, budget, lock_timeout=600):
+        self.directory = directory
+        self.budget = budget
+        self.lock_timeout = lock_timeout
+        self.owned = set()  # keys this worker is computing
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, pipeId, params):
+        data = json.dumps({'pipeId': pipeId, 'params': params}, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, f'{key}.{extension}')
+
+    def acquire(self, key, wait=True):
+        """
+        Returns 'hit' when a stored result exists, 'owner' when the caller has to compute
+        it (and then store or release it), or 'busy' (wait=False) while it is computed.
+        """
+        while True:
+            if os.path.exists(self.path(key, 'json')):
+                return 'hit'
+            try:
+                fd = os.open(self.path(key, 'lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                with self.lock:
+                    self.owned.add(key)
+                return 'owner'
+            except FileExistsError:
+                pass
+
+            try:
+                if lock_is_stale(self.path(key, 'lock'), self.lock_timeout):
+                    log(f'Removing stale result lock {key}')
+                    os.remove(self.path(key, 'lock'))
+                    continue
+            except FileNotFoundError:
+                continue
+
+            if not wait or key in self.owned:
+                return 'busy'
+            time.sleep(0.05)
+
+    def release(self, key):
+        with self.lock:
+            if key not in self.owned:
+                return
+            self.owned.discard(key)
+        try:
+            os.remove(self.path(key, 'lock'))
+        except FileNotFoundError:
+            pass
+
+    def respond(self, key, requestUUID, CUDA_VISIBLE_DEVICES):
+        """Builds the response of a stored result for a new request, None if it is gone"""
+        start_lookup = time.time()
+        try:
+            with open(self.path(key, 'json')) as f:
+                response = json.load(f)
+            image_fields = copy_image(self.path(key, 'png'), requestUUID)
+            os.utime(self.path(key, 'json'))
+        except (OSError, ValueError) as e:
+            log(f'Cached result {key} unavailable: {e}')
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return json.dumps({
+            **response,
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+            'uuid': requestUUID,
+            'timeToInference': round(time.time() - start_lookup, 2),
+            'cacheHit': True,
+            **image_fields,
+        })
+
+    def store(self, key, response):
+        """Stores a finished response, releases the key"""
+        try:
+            data = json.loads(response)
+            if 'error' in data or not ('shm' in data or 'filepath' in data):
+                return
+            shutil.copyfile(image_path(data), self.path(key, 'png'))
+            # the json file marks the result complete, write it last
+            with open(self.path(key, 'json.tmp'), 'w') as f:
+                json.dump({field: value for field, value in data.items() if field not in REQUEST_FIELDS}, f)
+            os.replace(self.path(key, 'json.tmp'), self.path(key, 'json'))
+            with self.lock:
+                self.misses += 1
+        except OSError as e:
+            log(f'Unable to store result {key}: {e}')
+        finally:
+            self.release(key)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        used = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                size = os.path.getsize(self.path(key, 'json')) + os.path.getsize(self.path(key, 'png'))
+                entries.append((os.path.getmtime(self.path(key, 'json')), key, size))
+                used += size
+            except FileNotFoundError:
+                continue
+
+        for _, key, size in sorted(entries):
+            if used <= self.budget:
+                break
+            for extension in ('json', 'png'):
+                try:
+                    os.remove(self.path(key, extension))
+                except FileNotFoundError:
+                    pass
+            used -= size
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'directory': self.directory,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / requests, 4) if requests else None,
+                'inFlight': len(self.owned),
+            }
+
+
+def create_result_cache():
+    budget = int(float(os.environ.get('RESULT_CACHE_MB', '2048')) * 1024 ** 2)
+    if not budget:
+        return None
+    return ResultCache(os.environ.get('RESULT_CACHE_DIR', '/tmp/openkbs-results'), budget)
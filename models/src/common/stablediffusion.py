@@ -1,4 +1,8 @@
+import time
+import torch
 from common.utils import extract_config
+from common.images import image_response
+from common.prompt_cache import encode_prompts_sdxl
 
 def extract_params_sdxl(payload):
     return extract_config(
@@ -26,4 +30,66 @@ def extract_params_sdxl(payload):
             ("negative_target_size", "nts"),
             ("strength", "strength")
         ],
-    )
\ No newline at end of file
+    )
+
+PROMPT_PARAMS = ('prompt', 'prompt_2', 'negative_prompt', 'negative_prompt_2')
+
+
+def batch_key_sdxl(payload):
+    """Requests with equal keys can be denoised together, only prompts and seeds may differ"""
+    if 'stream' in payload:
+        return None
+    config_dict = extract_params_sdxl(payload)
+    shared = tuple(sorted((key, value) for key, value in config_dict.items() if key not in PROMPT_PARAMS))
+    # a missing prompt is not the same as an empty one (e.g. zeroed negative embeddings)
+    present = tuple(key for key in PROMPT_PARAMS if key in config_dict)
+    return shared, present
+
+
+def result_key_sdxl(payload):
+    """Seeded requests are deterministic, their results can be reused for equal params"""
+    if 'stream' in payload or payload.get('seed') is None:
+        return None
+    return {'params': extract_params_sdxl(payload), 'seed': int(payload['seed'])}
+
+
+def call_batch_sdxl(pipe, payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId, defaults=None, overrides=None, cache_prompts=False):
+    """Runs a single pipeline call for payloads sharing the same batch_key_sdxl"""
+    configs = [extract_params_sdxl(payload) for payload in payloads]
+
+    config_dict = {**(defaults or {})}
+    config_dict.update({key: value for key, value in configs[0].items() if key not in PROMPT_PARAMS})
+    config_dict.update(overrides or {})
+    for key in PROMPT_PARAMS:
+        if key in configs[0]:
+            config_dict[key] = [config[key] for config in configs]
+
+    seeds = [payload.get('seed') for payload in payloads]
+    if any(seed is not None for seed in seeds):
+        generators = []
+        for seed in seeds:
+            generator = torch.Generator("cuda")
+            if seed is not None:
+                generator.manual_seed(int(seed))
+            else:
+                generator.seed()
+            generators.append(generator)
+        config_dict['generator'] = generators
+
+    start_inference = time.time()
+    if cache_prompts:
+        config_dict = encode_prompts_sdxl(pipe, pipeId, config_dict)
+    images = pipe(**config_dict).images
+
+    time_inference = round(time.time() - start_inference, 2)
+    return [
+        image_response(image, requestUUID, {
+            'type': 'CALL_PIPE_RESPONSE',
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+            'pipeId': pipeId,
+            'uuid': requestUUID,
+            'timeToInference': time_inference,
+            'batchSize': len(payloads),
+        })
+        for requestUUID, image in zip(requestUUIDs, images)
+    ]
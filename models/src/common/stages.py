@@ -0,0 +1,160 @@
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from common.utils import log
+
+# seconds of history the utilization of a stage is computed over
+STATS_WINDOW = 60
+
+
+class Deferred:
+    """
+    Response of a call whose CPU tail (encoding the image, ending the stream) is
+    left to the finish stage. resolve() runs it and returns the response.
+    """
+
+    def __init__(self, finish):
+        self.finish = finish
+
+    def resolve(self):
+        return self.finish()
+
+
+class StageStats:
+    """Queue depth, throughput and busy share of the last STATS_WINDOW seconds of a stage"""
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.completed = 0
+        self.running = {}  # token -> start
+        self.intervals = deque()  # (start, end) of the finished work
+        self.created = time.time()
+
+    @contextmanager
+    def track(self):
+        token = object()
+        with self.lock:
+            self.running[token] = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.intervals.append((self.running.pop(token), time.time()))
+                self.completed += 1
+
+    def stats(self, queued=None):
+        now = time.time()
+        since = max(now - STATS_WINDOW, self.created)
+        with self.lock:
+            while self.intervals and self.intervals[0][1] < since:
+                self.intervals.popleft()
+            busy = sum(end - max(start, since) for start, end in self.intervals)
+            busy += sum(now - max(start, since) for start in self.running.values())
+            return {
+                'workers': self.workers,
+                'queued': self.queued if queued is None else queued,
+                'running': len(self.running),
+                'completed': self.completed,
+                'utilization': round(busy / ((now - since) * self.workers), 3) if now > since else 0,
+            }
+
+
+class StagePool(StageStats):
+    def __init__(self, workers, name):
+        super().__init__(workers)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=name)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.queued += 1
+        return self.executor.submit(self.run, fn, *args)
+
+    def run(self, fn, *args):
+        with self.lock:
+            self.queued -= 1
+        with self.track():
+            return fn(*args)
+
+
+class Stages:
+    """
+    Overlaps the CPU work of requests with the GPU executor. The prepare stage runs
+    module.prepare(payload) (fetching and preprocessing input images) as soon as a
+    request is queued, the finish stage resolves Deferred responses (PNG encoding)
+    after the GPU is done with them, so the executor moves on to the next request.
+    With 0 workers both run inline on the executor.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.prepare = StagePool(workers, 'prepare') if workers else None
+        self.finish = StagePool(workers, 'finish') if workers else None
+        self.gpu = StageStats()
+        self.lock = threading.Lock()
+        self.prepared = {}  # uuid -> Future of the prepared inputs
+
+    def begin(self, uuid, prepare):
+        """Starts preparing the inputs of a queued request, prepare() returns None if it has none"""
+        if not self.prepare:
+            return
+        future = self.prepare.submit(prepare)
+        with self.lock:
+            self.prepared[uuid] = future
+
+        def drop_empty(future):
+            if future.exception() is None and future.result() is None:
+                self.discard(uuid)
+        future.add_done_callback(drop_empty)
+
+    def inputs(self, uuid, prepare):
+        """Prepared inputs of a request, waits for them or runs prepare() if they weren't started"""
+        with self.lock:
+            future = self.prepared.pop(uuid, None)
+        if future is None:
+            return prepare()
+        return future.result()
+
+    def discard(self, uuid):
+        with self.lock:
+            future = self.prepared.pop(uuid, None)
+        if future:
+            future.cancel()
+
+    def complete(self, response, respond, fail):
+        """
+        Calls respond(response) once a Deferred response is resolved, on the finish
+        stage, or fail(error) if resolving it raised. Plain responses are passed on
+        right away.
+        """
+        if not isinstance(response, Deferred):
+            return respond(response)
+
+        def run():
+            try:
+                resolved = response.resolve()
+            except Exception as e:
+                log(f'Finishing response failed: {e}')
+                return fail(e)
+            respond(resolved)
+
+        if self.finish:
+            self.finish.submit(run)
+        else:
+            run()
+
+    def stats(self, gpu_queued=None):
+        inline = {'workers': 0, 'queued': 0, 'running': 0, 'completed': 0, 'utilization': 0}
+        return {
+            'prepare': self.prepare.stats() if self.prepare else inline,
+            'gpu': self.gpu.stats(gpu_queued),
+            'finish': self.finish.stats() if self.finish else inline,
+        }
+
+
+def create_stages():
+    return Stages(int(os.environ.get('STAGE_WORKERS', 2)))
@@ -0,0 +1,139 @@
+import os
+import time
+import torch
+from common.utils import log
+from common.eviction import create_eviction_policy
+from common.components import components
+
+
+def torch_modules(pipe):
+    """Yields the torch modules held by a pipe dict returned from load()"""
+    for value in pipe.values():
+        if isinstance(value, torch.nn.Module):
+            yield value
+        elif hasattr(value, 'components'):
+            # diffusers pipelines
+            for component in value.components.values():
+                if isinstance(component, torch.nn.Module):
+                    yield component
+        elif isinstance(getattr(value, 'model', None), torch.nn.Module):
+            # transformers pipelines
+            yield value.model
+
+
+def on_host(module):
+    return all(tensor.device.type == 'cpu' for tensor in module.parameters())
+
+
+def move_pipe(pipe, device, pin_memory=False):
+    for module in torch_modules(pipe):
+        module.to(device)
+        if pin_memory:
+            for tensor in list(module.parameters()) + list(module.buffers()):
+                tensor.data = tensor.data.pin_memory()
+
+
+def pipe_size(pipe, skip=()):
+    size = 0
+    seen = set()
+    for module in torch_modules(pipe):
+        if id(module) in skip:
+            continue
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if tensor.data_ptr() not in seen:
+                seen.add(tensor.data_ptr())
+                size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class HostTier:
+    """
+    Second cache tier: pipes evicted from VRAM are kept in (pinned) host memory
+    within HOST_TIER_RAM_GB, so bringing them back is a host to device copy instead
+    of a from_pretrained. Uses its own eviction policy (HOST_TIER_POLICY).
+    """
+
+    def __init__(self, budget, policy, pin_memory=True):
+        self.budget = budget
+        self.policy = policy
+        self.pin_memory = pin_memory
+        self.pipes = {}  # pipeId -> {'pipe', 'size'}
+        self.used = 0
+        # the policy counts demotions as misses, the hit rate is over the pipe loads instead
+        self.hits = 0  # loads served from host memory by promote()
+        self.misses = 0  # loads that read the weights from disk, see record_miss()
+
+    def __contains__(self, pipeId):
+        return pipeId in self.pipes
+
+    def demote(self, pipeId, pipe, module):
+        """Moves the pipe to host memory, returns False if the pipe can't be kept"""
+        if not self.budget or getattr(module, 'HOST_TIER', True) is False:
+            return False
+
+        start_demote = time.time()
+        # components another pipe of the tier holds in host memory are counted with that pipe
+        parked = components.parked_modules(pipeId)
+        held = {id(module) for module in torch_modules(pipe) if id(module) in parked and on_host(module)}
+        size = pipe_size(pipe, held)
+        if size > self.budget:
+            log(f'{pipeId} ({size} bytes) does not fit in the host tier ({self.budget} bytes)')
+            return False
+
+        while self.used + size > self.budget:
+            self.remove(self.policy.choose_victim(self.pipes), evicted=True)
+
+        move_pipe(pipe, 'cpu', self.pin_memory)
+        torch.cuda.empty_cache()
+        components.park(pipeId)
+        self.pipes[pipeId] = {'pipe': pipe, 'size': size}
+        self.used += size
+        self.policy.on_load(pipeId, size, round(time.time() - start_demote, 2))
+        log(f'Demoted {pipeId} to host memory in {round(time.time() - start_demote, 2)}s')
+        return True
+
+    def promote(self, pipeId, device='cuda'):
+        """Moves a pipe back to the device, returns (pipe, seconds)"""
+        self.hits += 1
+        entry = self.pipes.pop(pipeId)
+        self.policy.on_remove(pipeId)
+        self.used -= entry['size']
+
+        start_promote = time.time()
+        components.restore(pipeId, entry['pipe'])
+        move_pipe(entry['pipe'], device)
+        loaded_in_vram = round(time.time() - start_promote, 2)
+        log(f'Promoted {pipeId} from host memory in {loaded_in_vram}s')
+        return entry['pipe'], loaded_in_vram
+
+    def remove(self, pipeId, evicted=False):
+        entry = self.pipes.pop(pipeId, None)
+        if entry:
+            components.unpark(pipeId)
+            self.used -= entry['size']
+            if not evicted:
+                self.policy.on_remove(pipeId)
+            del entry
+            log(f'Freed host memory by DELETING --------------------------------> {pipeId}')
+
+    def record_miss(self):
+        """Counts a pipe loaded from disk (directly or by the preloader) instead of from the tier"""
+        self.misses += 1
+
+    def stats(self):
+        loads = self.hits + self.misses
+        return {
+            'pipes': list(self.pipes.keys()),
+            'used': self.used,
+            'budget': self.budget,
+            **self.policy.stats(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': round(self.hits / loads, 4) if loads else None,
+        }
+
+
+def create_host_tier():
+    budget = int(float(os.environ.get('HOST_TIER_RAM_GB', '0')) * 1024 ** 3)
+    policy = create_eviction_policy(os.environ.get('HOST_TIER_POLICY', 'lru'))
+    return HostTier(budget, policy, os.environ.get('HOST_TIER_PIN', '1') == '1')
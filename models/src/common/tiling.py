@@ -0,0 +1,100 @@
+import math
+import numpy as np
+from PIL import Image
+
+
+def tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    count = math.ceil((length - overlap) / step)
+    # the last tile is moved inside the image, it overlaps its neighbour a bit more
+    return sorted({min(index * step, length - tile_size) for index in range(count)})
+
+
+def tile_boxes(width, height, tile_size, overlap):
+    """(left, top, right, bottom) boxes of equally sized tiles covering the image, row by row"""
+    return [
+        (left, top, min(left + tile_size, width), min(top + tile_size, height))
+        for top in tile_starts(height, tile_size, overlap)
+        for left in tile_starts(width, tile_size, overlap)
+    ]
+
+
+def tile_box(width, height, rows, cols, tile_index, overlap):
+    """
+    Input box of one tile of a rows x cols grid, extended by overlap on its inner sides.
+    Must match tileBox in cluster/src/app/tiles.js, which blends the tiles of batchUpscale.
+    """
+    row, col = divmod(tile_index, cols)
+    return (
+        max(col * width // cols - overlap, 0),
+        max(row * height // rows - overlap, 0),
+        min((col + 1) * width // cols + overlap, width),
+        min((row + 1) * height // rows + overlap, height),
+    )
+
+
+def feather(length, start, end, total, ramp):
+    """1-D blending weights of a tile spanning [start, end) of total, ramps only towards neighbours"""
+    weights = np.ones(length, dtype=np.float32)
+    ramp = min(ramp, length)
+    if ramp:
+        rising = (np.arange(ramp, dtype=np.float32) + 0.5) / ramp
+        if start > 0:
+            weights[:ramp] = np.minimum(weights[:ramp], rising)
+        if end < total:
+            weights[-ramp:] = np.minimum(weights[-ramp:], rising[::-1])
+    return weights
+
+
+class TileCanvas:
+    """
+    Accumulates scaled tiles with feathered weights. Overlapping tiles blend linearly
+    into each other, so no seams are left where they meet.
+    """
+
+    def __init__(self, width, height, overlap):
+        self.width = width
+        self.height = height
+        self.overlap = overlap
+        self.pixels = None
+        self.weights = None
+
+    def add(self, box, tile):
+        """Adds a (h, w, 3) float tile, the scaled result of the input box"""
+        left, top, right, bottom = box
+        scale = tile.shape[1] / (right - left)
+        if self.pixels is None:
+            self.pixels = np.zeros((round(self.height * scale), round(self.width * scale), tile.shape[2]), dtype=np.float32)
+            self.weights = np.zeros(self.pixels.shape[:2], dtype=np.float32)
+
+        x, y = round(left * scale), round(top * scale)
+        h, w = tile.shape[:2]
+        ramp = round(self.overlap * scale)
+        weights = np.outer(
+            feather(h, top, bottom, self.height, ramp),
+            feather(w, left, right, self.width, ramp),
+        )
+        self.pixels[y:y + h, x:x + w] += tile * weights[:, :, None]
+        self.weights[y:y + h, x:x + w] += weights
+
+    def image(self):
+        pixels = self.pixels / np.maximum(self.weights, 1e-8)[:, :, None]
+        return Image.fromarray((np.clip(pixels, 0, 1) * 255).round().astype(np.uint8))
+
+
+def process_tiled(image, run, tile_size=512, overlap=64, batch_size=2):
+    """
+    Runs run(tiles) -> [(h, w, 3) float arrays in [0, 1]] on overlapping tiles of a PIL
+    image, batch_size tiles per call, and blends the results into one image. Device
+    memory depends on the tile and batch size only.
+    """
+    overlap = min(overlap, tile_size // 2)
+    boxes = tile_boxes(image.width, image.height, tile_size, overlap)
+    canvas = TileCanvas(image.width, image.height, overlap)
+    for start in range(0, len(boxes), batch_size):
+        batch = boxes[start:start + batch_size]
+        for box, tile in zip(batch, run([image.crop(box) for box in batch])):
+            canvas.add(box, np.asarray(tile, dtype=np.float32))
+    return canvas.image()
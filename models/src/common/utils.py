@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import datetime
 import io
 import requests
@@ -55,7 +56,8 @@ def is_json(data):
 
 
 class JSONStreamer:
-    def __init__(self, connection=None, send_function=None, request_uuid=None, tokenizer=None, **decode_kwargs):
+    def __init__(self, connection=None, send_function=None, request_uuid=None, tokenizer=None,
+                 flush_interval=0, flush_bytes=0, **decode_kwargs):
         self._tokenizer = tokenizer
         self._count = 0
         self._send_function = send_function
@@ -63,9 +65,13 @@ class JSONStreamer:
         self._request_uuid = request_uuid
         self.skip_prompt = True
         self.next_tokens_are_prompt = True
-        self.token_cache = []
+        self.token_cache = []  # tokens printed last and the ones not printed yet
+        self.read_offset = 0  # tokens in token_cache that were printed
         self.decode_kwargs = decode_kwargs
-        self.print_len = 0
+        self.flush_interval = flush_interval  # seconds
+        self.flush_bytes = flush_bytes
+        self.pending = ""
+        self.last_flush = 0
 
     @property
     def tokenizer(self):
@@ -144,70 +150,78 @@ class JSONStreamer:
             return
 
         self.token_cache.extend(value.tolist())
+        text = self.decode_new_text()
+        if text:
+            self.pending += text.replace("<|eot_id|>", "")
+            if self.flush_due():
+                self.flush()
+
+    def decode_new_text(self):
+        """
+        Text of the tokens since the last call. Only the window of tokens after the
+        previously printed text is decoded (together with the tokens printed last, as
+        leading spaces depend on them), so each token costs the same however long the
+        text gets. Incomplete UTF-8 sequences are held back until they are complete.
+        """
+        prefix_text = self.tokenizer.decode(self.token_cache[:self.read_offset], **self.decode_kwargs)
         text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return ""
+        self.token_cache = self.token_cache[self.read_offset:]
+        self.read_offset = len(self.token_cache)
+        return text[len(prefix_text):]
+
+    def flush_due(self):
+        if not self.flush_interval and not self.flush_bytes:
+            return True
+        if self.flush_interval and time.time() - self.last_flush >= self.flush_interval:
+            return True
+        return bool(self.flush_bytes) and len(self.pending.encode()) >= self.flush_bytes
 
-        if text.endswith("\n"):
-            printable_text = text[self.print_len:]
-            self.token_cache = []
-            self.print_len = 0
-        elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-            printable_text = text[self.print_len:]
-            self.print_len += len(printable_text)
-        else:
-            printable_text = text[self.print_len:text.rfind(" ") + 1]
-            self.print_len += len(printable_text)
-
-        if printable_text:
-            self._count += 1  # Increment the count here to ensure no skips
-            response = json.dumps({"id": self._count, "content": printable_text, "type": "STREAM", "uuid": self._request_uuid})
+    def flush(self):
+        """Sends the coalesced text as one STREAM message"""
+        if self.pending:
+            self._count += 1
+            response = json.dumps({"id": self._count, "content": self.pending, "type": "STREAM", "uuid": self._request_uuid})
             self._send_function(self._connection, response)
+            self.pending = ""
+        self.last_flush = time.time()
+
+    def put_text(self, text, **fields):
+        """Sends already decoded text, fields (e.g. timestamps) are added to the message"""
+        self.put_event(content=text, **fields)
+
+    def put_event(self, **fields):
+        """Sends a STREAM message with arbitrary fields, e.g. the progress of an image"""
+        self.flush()
+        self._count += 1
+        response = json.dumps({"id": self._count, **fields, "type": "STREAM", "uuid": self._request_uuid})
+        self._send_function(self._connection, response)
+
+    def end(self, **fields):
+        if self.token_cache[self.read_offset:]:
+            prefix_text = self.tokenizer.decode(self.token_cache[:self.read_offset], **self.decode_kwargs)
+            remaining_text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)[len(prefix_text):]
+            self.pending += remaining_text.replace("<|eot_id|>", "")
+        self.token_cache = []
+        self.read_offset = 0
+        self.flush()
 
-    def end(self):
-        if self.token_cache:
-            remaining_text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
-            remaining_text = remaining_text[self.print_len:]  # Only print unprinted text
-
-            # Remove any special tokens like <|eot_id|>
-            remaining_text = remaining_text.replace("<|eot_id|>", "").strip()
-
-            if remaining_text:
-                self._count += 1  # Increment count for the final message
-                response = json.dumps({
-                    "id": self._count,
-                    "content": remaining_text,
-                    "type": "STREAM",
-                    "uuid": self._request_uuid
-                })
-                self._send_function(self._connection, response)
-            self.token_cache = []
-            self.print_len = 0
-
-        response = json.dumps({"done": self._count, "type": "STREAM", "uuid": self._request_uuid})
+        response = json.dumps({"done": self._count, **fields, "type": "STREAM", "uuid": self._request_uuid})
         self._send_function(self._connection, response)
 
-    def _is_chinese_char(self, cp):
-        """Checks whether CP is the codepoint of a CJK character."""
-        # This defines a "chinese character" as anything in the CJK Unicode block:
-        #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-        #
-        # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-        # despite its name. The modern Korean Hangul alphabet is a different block,
-        # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-        # space-separated words, so they are not treated specially and handled
-        # like the all of the other languages.
-        if (
-            (cp >= 0x4E00 and cp <= 0x9FFF)
-            or (cp >= 0x3400 and cp <= 0x4DBF)  #
-            or (cp >= 0x20000 and cp <= 0x2A6DF)  #
-            or (cp >= 0x2A700 and cp <= 0x2B73F)  #
-            or (cp >= 0x2B740 and cp <= 0x2B81F)  #
-            or (cp >= 0x2B820 and cp <= 0x2CEAF)  #
-            or (cp >= 0xF900 and cp <= 0xFAFF)
-            or (cp >= 0x2F800 and cp <= 0x2FA1F)  #
-        ):  #
-            return True
 
-        return False
+def create_streamer(connection, send_function, request_uuid, payload):
+    """
+    JSONStreamer of a stream request. STREAM messages are coalesced until
+    stream_interval_ms passed or stream_max_bytes of text are pending, the first text
+    is sent right away. Both default to 0, every new piece of text is sent at once.
+    """
+    return JSONStreamer(
+        connection, send_function, request_uuid,
+        flush_interval=float(payload.get('stream_interval_ms', os.environ.get('STREAM_INTERVAL_MS', 0))) / 1000,
+        flush_bytes=int(payload.get('stream_max_bytes', os.environ.get('STREAM_MAX_BYTES', 0))),
+    )
 
 def convert_str_to_numeric(s):
     if s is None:
@@ -0,0 +1,268 @@
+import os
+import json
+import mmap
+import time
+import shutil
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from common.utils import log
+
+SNAPSHOT_FILE = 'model.safetensors'
+LOAD_WORKERS = 8
+# tensors are copied out of the mapped files in pieces of this size, spread over the workers
+CHUNK_BYTES = 64 << 20
+
+DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+    'F8_E4M3': torch.float8_e4m3fn,
+    'F8_E5M2': torch.float8_e5m2,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def read_safetensors(paths, workers=LOAD_WORKERS):
+    """
+    State dict and metadata of safetensors files. The files are mapped and the tensors
+    copied out of them by a thread pool, so the page faults of large tensors are served
+    in parallel instead of one shard after another.
+    """
+    state, metadata, chunks, maps = {}, {}, [], []
+    for path in paths:
+        header, data_start = read_header(path)
+        metadata.update(header.pop('__metadata__', None) or {})
+        if os.path.getsize(path) == data_start:
+            maps.append(None)
+        else:
+            with open(path, 'rb') as f:
+                # a private mapping is writable, torch.frombuffer doesn't accept read-only buffers
+                maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+        for name, info in header.items():
+            tensor = torch.empty(info['shape'], dtype=DTYPES[info['dtype']])
+            state[name] = tensor
+            begin, end = info['data_offsets']
+            target = tensor.reshape(-1).view(torch.uint8)
+            for offset in range(0, end - begin, CHUNK_BYTES):
+                chunks.append((maps[-1], data_start + begin + offset, target, offset, min(offset + CHUNK_BYTES, end - begin)))
+
+    def copy(chunk):
+        buffer, source, target, start, stop = chunk
+        target[start:stop].copy_(torch.frombuffer(buffer, dtype=torch.uint8, count=stop - start, offset=source))
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(copy, chunks))
+    return state, metadata
+
+
+def write_safetensors(path, tensors, metadata=None):
+    """Writes tensors one at a time, device tensors are copied to the host as they are written"""
+    header, offset = {}, 0
+    for name, tensor in tensors.items():
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + size]}
+        offset += size
+    if metadata:
+        header['__metadata__'] = metadata
+    encoded = json.dumps(header, separators=(',', ':')).encode()
+    encoded += b' ' * (-len(encoded) % 8)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        for tensor in tensors.values():
+            if tensor.numel():
+                f.write(memoryview(tensor.detach().to('cpu').contiguous().reshape(-1).view(torch.uint8).numpy()))
+
+
+def warm(paths):
+    """Asks the kernel to read the files into the page cache in the background, returns the bytes advised"""
+    advised = 0
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    mapped.madvise(mmap.MADV_WILLNEED)
+                    advised += len(mapped)
+        except (OSError, ValueError) as e:
+            log(f'Warming {path} failed: {e}')
+    return advised
+
+
+def snapshot_dir(repo, subfolder=None, torch_dtype=None):
+    """Snapshot directory of a model, None unless WEIGHTS_SNAPSHOT_DIR is set"""
+    root = os.environ.get('WEIGHTS_SNAPSHOT_DIR')
+    if not root:
+        return None
+    dtype = str(torch_dtype).replace('torch.', '') if torch_dtype else 'default'
+    return os.path.join(root, repo.replace('/', '--'), subfolder or '', dtype)
+
+
+def save_snapshot(directory, model):
+    """
+    Saves the config and the already cast (and LoRA fused) weights of a loaded model as one
+    safetensors file. Tensors sharing memory (tied weights) are stored once.
+    """
+    model = getattr(model, '_orig_mod', model)  # torch.compile wrapper
+    state = model.state_dict()
+    if any(tensor.device.type == 'meta' for tensor in state.values()):
+        log(f'Not saving snapshot {directory}, weights are offloaded')
+        return
+
+    tensors, aliases, seen = {}, {}, {}
+    for name, tensor in state.items():
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.dtype)
+        if tensor.numel() and key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        tensors[name] = tensor
+
+    start_save = time.time()
+    partial = f'{directory}.{os.getpid()}.{threading.get_ident()}.partial'
+    try:
+        os.makedirs(partial)
+        if hasattr(model, 'save_config'):  # diffusers
+            model.save_config(partial)
+        else:
+            model.config.save_pretrained(partial)
+            if getattr(model, 'generation_config', None) is not None:
+                model.generation_config.save_pretrained(partial)
+        write_safetensors(os.path.join(partial, SNAPSHOT_FILE), tensors, {
+            'class': type(model).__name__,
+            'aliases': json.dumps(aliases),
+        })
+        os.rename(partial, directory)
+        log(f'Saved snapshot {directory} in {round(time.time() - start_save, 2)}s')
+    except OSError as e:
+        # e.g. the disk is full, or another worker saved the same snapshot first
+        log(f'Saving snapshot {directory} failed: {e}')
+        shutil.rmtree(partial, ignore_errors=True)
+
+
+def remove_partial_snapshots():
+    """Removes the *.partial directories of workers that exited while saving a snapshot"""
+    root = os.environ.get('WEIGHTS_SNAPSHOT_DIR')
+    if not root:
+        return
+    for parent, directories, _ in os.walk(root):
+        for name in [name for name in directories if name.endswith('.partial')]:
+            directories.remove(name)
+            try:
+                # <dtype>.<pid>.<thread>.partial
+                os.kill(int(name.split('.')[-3]), 0)
+                continue  # still being saved by a running worker
+            except (ValueError, IndexError, ProcessLookupError):
+                pass
+            except PermissionError:
+                continue
+            log(f'Removing partial snapshot {os.path.join(parent, name)}')
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def load_snapshot(model_class, directory):
+    from accelerate import init_empty_weights
+
+    state, metadata = read_safetensors([os.path.join(directory, SNAPSHOT_FILE)])
+    for name, original in json.loads(metadata.get('aliases', '{}')).items():
+        state[name] = state[original]
+
+    # parameters are created on the meta device and replaced by the loaded tensors
+    with init_empty_weights(include_buffers=False):
+        if hasattr(model_class, 'load_config'):  # diffusers
+            model = model_class.from_config(model_class.load_config(directory))
+        else:
+            from transformers import AutoConfig
+            config = AutoConfig.from_pretrained(directory)
+            model = model_class.from_config(config) if hasattr(model_class, 'from_config') else model_class._from_config(config)
+    model.load_state_dict(state, strict=True, assign=True)
+    if hasattr(model, 'tie_weights'):
+        # assign=True gives tied names separate parameters on the same memory
+        model.tie_weights()
+
+    if hasattr(model, 'generation_config') and os.path.exists(os.path.join(directory, 'generation_config.json')):
+        from transformers import GenerationConfig
+        model.generation_config = GenerationConfig.from_pretrained(directory)
+    return model.eval()
+
+
+class WeightLoader:
+    """
+    model_class.from_pretrained that starts from a snapshot saved by an earlier load of the
+    same (repo, subfolder, dtype). Without a snapshot the model is loaded from the HF cache
+    and the snapshot is saved from it before it is returned, while it is still on the host.
+    The snapshot files read for a pipe are remembered, warm(pipeId) pulls them into the
+    page cache before it is loaded again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}  # pipeId -> snapshot files
+
+    def load(self, model_class, repo, subfolder=None, torch_dtype=None, **kwargs):
+        directory = snapshot_dir(repo, subfolder, torch_dtype)
+        path = os.path.join(directory, SNAPSHOT_FILE) if directory else None
+        name = '/'.join(part for part in (repo, subfolder) if part)
+
+        if path and os.path.exists(path):
+            try:
+                start_load = time.time()
+                model = load_snapshot(model_class, directory)
+                log(f'Loaded {name} from snapshot in {round(time.time() - start_load, 2)}s')
+                self.remember(path)
+                return model
+            except Exception as e:
+                # e.g. saved by an incompatible library version, loaded from the HF cache below
+                log(f'Loading snapshot {directory} failed: {e}')
+
+        if subfolder:
+            kwargs['subfolder'] = subfolder
+        model = model_class.from_pretrained(repo, torch_dtype=torch_dtype, **kwargs)
+        if directory and not os.path.exists(path):
+            # saved before the model moves to the device, once per model, with no second copy of the weights
+            save_snapshot(directory, model)
+            self.remember(path)
+        return model
+
+    def remember(self, path):
+        from common.components import components
+        with self.lock:
+            self.files.setdefault(components.current_owner(), set()).add(path)
+
+    def warm(self, pipeId):
+        with self.lock:
+            files = sorted(path for path in self.files.get(pipeId, ()) if os.path.exists(path))
+        if files:
+            start_warm = time.time()
+            advised = warm(files)
+            log(f'Warming {advised >> 20} MB of {pipeId} weights ({round(time.time() - start_warm, 3)}s)')
+
+
+weights = WeightLoader()
+
+
+def load_model(model_class, repo, subfolder=None, torch_dtype=None, **kwargs):
+    return weights.load(model_class, repo, subfolder, torch_dtype, **kwargs)
+
+
+def place_model(model, device_map='auto'):
+    """Device placement of a loaded model like from_pretrained(device_map=...) does it"""
+    from accelerate import dispatch_model, infer_auto_device_map
+    if device_map == 'auto':
+        device_map = infer_auto_device_map(model, no_split_module_classes=getattr(model, '_no_split_modules', None) or [])
+    return dispatch_model(model, device_map=device_map)
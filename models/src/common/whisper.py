@@ -0,0 +1,259 @@
+import time
+import queue
+import threading
+import torch
+from common.audio import AudioStream, iter_windows
+from common.utils import log
+
+
+def chunk_params(pipe):
+    """Window and stride lengths in samples, the same as the ASR pipeline's preprocess"""
+    sampling_rate = pipe.feature_extractor.sampling_rate
+    chunk_length_s = pipe._preprocess_params.get('chunk_length_s') or 30
+    stride_length_s = pipe._preprocess_params.get('stride_length_s')
+    if stride_length_s is None:
+        stride_length_s = chunk_length_s / 6
+    if isinstance(stride_length_s, (int, float)):
+        stride_length_s = [stride_length_s, stride_length_s]
+    align_to = getattr(pipe, '_align_to', 1)
+    return (
+        int(round(chunk_length_s * sampling_rate / align_to) * align_to),
+        int(round(stride_length_s[0] * sampling_rate / align_to) * align_to),
+        int(round(stride_length_s[1] * sampling_rate / align_to) * align_to),
+    )
+
+
+class ChunkFeed:
+    """
+    Ingest stage of a transcription: download, decode, windowing and feature extraction
+    run on a background thread. The model inputs of each 30 s window are put on the
+    scheduler queue as (feed, item) as soon as they are ready, followed by (feed, None)
+    or (feed, exception).
+    """
+
+    def __init__(self, pipe, url, items):
+        self.pipe = pipe
+        self.audio = AudioStream(url, pipe.feature_extractor.sampling_rate)
+        self.items = items
+        self.timings = self.audio.timings
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            feature_extractor = self.pipe.feature_extractor
+            dtype = getattr(self.pipe, 'dtype', None)
+            for index, (chunk, stride, is_last) in enumerate(iter_windows(self.audio, *chunk_params(self.pipe))):
+                processed = feature_extractor(
+                    chunk,
+                    sampling_rate=feature_extractor.sampling_rate,
+                    return_tensors="pt",
+                    return_attention_mask=True,
+                )
+                if dtype is not None:
+                    processed = processed.to(dtype=dtype)
+                if index == 0:
+                    self.timings['firstChunk'] = self.audio.elapsed()
+                self.items.put((self, {'index': index, 'is_last': is_last, 'stride': stride, **processed}))
+            self.items.put((self, None))
+        except Exception as e:
+            self.items.put((self, e))
+
+
+def forward_chunks(pipe, items):
+    """Runs the model on a batch of windows, returns one pipeline model output per window"""
+    model_inputs = {
+        'input_features': torch.cat([item['input_features'] for item in items]),
+        'attention_mask': torch.cat([item['attention_mask'] for item in items]),
+        'is_last': False,
+    }
+    output = pipe.forward(model_inputs, **pipe._forward_params)
+    return [
+        {'is_last': item['is_last'], 'stride': item['stride'], 'tokens': output['tokens'][row:row + 1]}
+        for row, item in enumerate(items)
+    ]
+
+
+class Transcription:
+    def __init__(self, url, on_finish, on_segment=None):
+        self.url = url
+        self.on_finish = on_finish
+        self.on_segment = on_segment
+        self.outputs = []
+        self.decoded = 0  # windows of the in order prefix that were postprocessed
+        self.emitted = 0  # segments passed to on_segment
+        self.model_time = 0
+        self.finished = False
+        self.done = threading.Event()
+        self.feed = None
+
+
+class ChunkScheduler:
+    """
+    Pools the windows of all in flight transcriptions of a pipe into shared model
+    batches (up to the pipeline batch_size), in the order they became ready. Each
+    transcription collects its own outputs in window order and is merged by the
+    pipeline postprocess once its last window was decoded.
+
+    With on_segment, the in order prefix of the decoded windows is postprocessed after
+    every batch and the timestamped segments that end before the next window starts
+    (so merging the overlap can not change them anymore) are passed on right away.
+    """
+
+    def __init__(self, pipe, batch_size=None, wait_ms=20):
+        self.pipe = pipe
+        self.batch_size = batch_size or pipe._batch_size or 1
+        self.wait_ms = wait_ms
+        self.items = queue.Queue()
+        self.transcriptions = {}  # ChunkFeed -> Transcription
+        self.lock = threading.Lock()
+        self.thread = None
+        self.idle = threading.Event()
+        self.idle.set()
+        self.batches = 0
+        self.chunks = 0
+        chunk_len, stride_left, stride_right = chunk_params(pipe)
+        self.step_s = (chunk_len - stride_left - stride_right) / pipe.feature_extractor.sampling_rate
+
+    def submit(self, url, on_finish, on_segment=None):
+        """
+        Starts transcribing url, on_finish(transcription, result, timings, error=None) and
+        on_segment(transcription, {'text', 'timestamp'}) are called from the scheduler thread
+        """
+        transcription = Transcription(url, on_finish, on_segment)
+        with self.lock:
+            self.idle.clear()
+            transcription.feed = ChunkFeed(self.pipe, url, self.items)
+            self.transcriptions[transcription.feed] = transcription
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return transcription
+
+    def stop(self):
+        """Lets the running transcriptions finish and stops the scheduler thread"""
+        self.idle.wait()
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread:
+            self.items.put((None, None))
+            thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': len(self.transcriptions),
+                'batches': self.batches,
+                'chunks': self.chunks,
+                'averageBatchSize': round(self.chunks / self.batches, 2) if self.batches else None,
+            }
+
+    def run(self):
+        while True:
+            pulled = [self.items.get()]
+            # windows becoming ready within wait_ms join the batch
+            deadline = time.time() + self.wait_ms / 1000
+            while sum(1 for _, item in pulled if isinstance(item, dict)) < self.batch_size:
+                try:
+                    pulled.append(self.items.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+            if any(feed is None for feed, _ in pulled):
+                return
+
+            # windows first, end markers of a feed always come after its windows
+            batch = [(self.transcriptions[feed], item) for feed, item in pulled if isinstance(item, dict)]
+            batch = [(transcription, item) for transcription, item in batch if not transcription.finished]
+            if batch:
+                self.forward(batch)
+
+            for feed, item in pulled:
+                if item is None or isinstance(item, Exception):
+                    self.finish(self.transcriptions[feed], error=str(item) if item is not None else None)
+                    with self.lock:
+                        del self.transcriptions[feed]
+
+            with self.lock:
+                if not self.transcriptions and self.items.empty():
+                    self.idle.set()
+
+    def forward(self, batch):
+        start_model = time.time()
+        try:
+            outputs = forward_chunks(self.pipe, [item for _, item in batch])
+        except Exception as e:
+            for transcription in {transcription for transcription, _ in batch}:
+                self.finish(transcription, error=str(e))
+            return
+        elapsed = time.time() - start_model
+        for transcription in {transcription for transcription, _ in batch}:
+            transcription.model_time += elapsed
+        for (transcription, item), output in zip(batch, outputs):
+            transcription.outputs.append((item['index'], output))
+        self.batches += 1
+        self.chunks += len(batch)
+        for transcription in {transcription for transcription, _ in batch}:
+            if transcription.on_segment:
+                self.stream(transcription)
+
+    def stream(self, transcription, result=None):
+        """Passes the segments that became final to on_segment, all remaining ones with the final result"""
+        if result is not None:
+            segments = result.get('chunks') or [{'text': result['text'], 'timestamp': None}]
+        else:
+            if not self.pipe._postprocess_params.get('return_timestamps'):
+                return
+            indices = sorted(index for index, _ in transcription.outputs)
+            prefix = 0
+            while prefix < len(indices) and indices[prefix] == prefix:
+                prefix += 1
+            if prefix == transcription.decoded:
+                return
+            transcription.decoded = prefix
+            # postprocess rewrites the output dicts in place
+            outputs = [dict(output) for _, output in sorted(transcription.outputs, key=lambda entry: entry[0])[:prefix]]
+            try:
+                segments = self.pipe.postprocess(outputs, **self.pipe._postprocess_params).get('chunks', [])
+            except Exception as e:
+                log(f'Unable to postprocess the first {prefix} windows of {transcription.url}: {e}')
+                return
+            # the next window starts here, anything before it is not overlapped
+            stable_until = prefix * self.step_s
+            stable = 0
+            while stable < len(segments) and segments[stable]['timestamp'][1] is not None and segments[stable]['timestamp'][1] <= stable_until:
+                stable += 1
+            segments = segments[:stable]
+
+        for segment in segments[transcription.emitted:]:
+            if not transcription.emitted:
+                transcription.feed.timings['firstText'] = transcription.feed.audio.elapsed()
+            transcription.emitted += 1
+            transcription.on_segment(transcription, {'text': segment['text'], 'timestamp': segment['timestamp']})
+
+    def finish(self, transcription, error=None):
+        if transcription.finished:
+            return
+        result, timings = None, None
+        if not error:
+            start_postprocess = time.time()
+            try:
+                outputs = [output for _, output in sorted(transcription.outputs, key=lambda entry: entry[0])]
+                if outputs:
+                    result = self.pipe.postprocess(outputs, **self.pipe._postprocess_params)
+                else:
+                    result = {'text': '', 'chunks': []}
+            except Exception as e:
+                error = str(e)
+            if result is not None and transcription.on_segment:
+                self.stream(transcription, result)
+            timings = {
+                **transcription.feed.timings,
+                'model': round(transcription.model_time, 2),
+                'postprocess': round(time.time() - start_postprocess, 2),
+            }
+        # after a failed batch the feed may still be queueing windows, they are skipped
+        transcription.finished = True
+        try:
+            transcription.on_finish(transcription, result, timings, error)
+        finally:
+            transcription.done.set()
@@ -3,22 +3,32 @@ import socket
 import os
 import json
 import queue
-import importlib.util
-from common.utils import JSONStreamer
+from common.utils import create_streamer
+from common.modules import get_module, get_import_time, get_modules_stats
+from common.protocol import SocketChannel
+from common.eviction import create_eviction_policy, make_room
+from common.tiers import create_host_tier, move_pipe
+from common.preload import create_preloader, create_predictor
+from common.batching import collect_batch
+from common.dispatcher import Dispatcher
+from common.prompt_cache import prompt_cache
+from common.result_cache import create_result_cache
+from common.components import components
+from common.weights import weights, remove_partial_snapshots
+from common.compile_cache import create_compile_cache, snap_payload
+from common.stages import create_stages
+from common.cancellation import cancellations, Cancelled
+from common.admission import create_admission, priority
 import threading
 from collections import OrderedDict
 import datetime
+import time
 
 load_pipe_queue = queue.Queue()
 
-def is_json(data):
-    try:
-        _ = json.loads(data)
-    except ValueError as e:
-        return False
-    return True
-
 CUDA_VISIBLE_DEVICES = os.environ["CUDA_VISIBLE_DEVICES"]
+# predicted pipes that can't be preloaded get their snapshot files read into the page cache
+WARM_PREDICTED = os.environ.get('WEIGHTS_WARM') == '1'
 
 def log(msg):
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -48,27 +58,198 @@ sock2 = create_and_bind_socket(f'./unix{CUDA_VISIBLE_DEVICES}.sock2')
 print('Up and Running!', flush=True)
 
 pipes = OrderedDict()
+eviction_policy = create_eviction_policy()
+host_tier = create_host_tier()
+preloader = create_preloader()
+predictor = create_predictor()
+result_cache = create_result_cache()
+compile_cache = create_compile_cache()
+stages = create_stages()
+admission = create_admission()
+remove_partial_snapshots()
+queue_waits = {}  # uuid -> seconds a started call spent in the work queue, added to its response
+dispatcher = None  # serves the heavy socket once it's connected
+result_keys = {}  # uuid -> result cache key of the requests computed by this worker
+# pipes, eviction policy and host tier are changed by the GPU executor and by deletes on the dispatcher
+state_lock = threading.RLock()
 
 def call_pipe(pipeId, payload, requestUUID, streamer = None):
     log(pipeId)
     log(requestUUID)
-    pipeId_parts = pipeId.split('--')
-    module_path = os.path.join('models', 'pipe', *pipeId_parts, 'index.py')
-    spec = importlib.util.spec_from_file_location("module.name", module_path)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
+    module = get_module(pipeId)
+    with state_lock:
+        eviction_policy.on_access(pipeId)
 
     args = [payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipes[pipeId]]
+    kwargs = {}
+    if hasattr(module, 'prepare'):
+        kwargs['inputs'] = stages.inputs(requestUUID, lambda: module.prepare(payload))
     log('executing module.call')
     if streamer:
         args.append(streamer)
-    return module.call(*args)
-    
+    with stages.gpu.track():
+        return module.call(*args, **kwargs)
+
+def submit_pipe(pipeId, payload, requestUUID, respond, streamer = None):
+    # continuous batching pipes answer from their engine thread through respond
+    module = get_module(pipeId)
+    with state_lock:
+        eviction_policy.on_access(pipeId)
+    log('executing module.submit')
+    return module.submit(payload, requestUUID, CUDA_VISIBLE_DEVICES, pipeId, pipes[pipeId], respond, streamer)
+
+def call_pipe_batch(pipeId, batch):
+    module = get_module(pipeId)
+    with state_lock:
+        eviction_policy.on_access(pipeId)
+    log(f'executing module.call_batch with {len(batch)} requests')
+    payloads = [json_data['payload'] for json_data in batch]
+    requestUUIDs = [json_data['uuid'] for json_data in batch]
+    with stages.gpu.track():
+        return module.call_batch(payloads, requestUUIDs, CUDA_VISIBLE_DEVICES, pipeId, pipes[pipeId])
+
+def prepare_inputs(json_data):
+    module = get_module(json_data['pipeId'])
+    return module.prepare(json_data['payload']) if hasattr(module, 'prepare') else None
+
+def queue_request(json_data):
+    """Admits a call to the work queue, False if it was rejected"""
+    if json_data.get('type') != 'CALL_PIPE_REQUEST':
+        return True
+    reason, wait = admission.admit(json_data, dispatcher.work)
+    if reason:
+        send_rejected(json_data, reason, wait)
+        return False
+    cancellations.register(json_data['uuid'])
+    # inputs of a call are fetched and preprocessed while the requests queued before it run
+    stages.begin(json_data['uuid'], lambda: prepare_inputs(json_data))
+    return True
+
+def record_queue_wait(json_data):
+    if 'queued_at' in json_data:
+        queue_waits[json_data['uuid']] = round(time.time() - json_data['queued_at'], 3)
+
+def send_rejected(json_data, reason, wait=None):
+    record_queue_wait(json_data)
+    if reason == 'queue_full':
+        error = f'Rejected, the queue of device {CUDA_VISIBLE_DEVICES} is full ({admission.max_depth} requests)'
+    elif reason == 'deadline':
+        error = f'Rejected, estimated to start in {round(wait, 1)}s, after its deadline'
+    else:
+        error = f'Rejected, its deadline passed after {queue_waits.get(json_data["uuid"])}s in the queue'
+    log(f'{error}: {json_data["uuid"]}')
+    send(connection, json.dumps({
+        'type': 'CALL_PIPE_RESPONSE',
+        'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+        'pipeId': json_data['pipeId'],
+        'uuid': json_data['uuid'],
+        'error': error,
+        'rejected': reason,
+        **({'estimatedWait': round(wait, 2)} if wait is not None else {}),
+    }))
+    stages.discard(json_data['uuid'])
+    cancellations.release(json_data['uuid'])
+
+def finish_call(request, response, stream=False):
+    """Sends the response of a call, a Deferred one after the finish stage resolved it"""
+    def respond(response):
+        # stored first, the cluster unlinks the shm image once it has read it
+        store_result(request['uuid'], response)
+        if not stream:
+            # stream responses were sent by the streamer as its done message
+            send(connection, response)
+        cancellations.release(request['uuid'])
+
+    def fail(error):
+        send(connection, json.dumps({
+            'type': 'CALL_PIPE_RESPONSE',
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+            'pipeId': request['pipeId'],
+            'uuid': request['uuid'],
+            'error': str(error),
+        }))
+        release_result(request['uuid'])
+        cancellations.release(request['uuid'])
+
+    stages.complete(response, respond, fail)
+
+def respond_submitted(requestUUID):
+    # the response of a submitted request comes from the engine thread of the pipe,
+    # None when a stream request finished and its streamer sent the done message
+    def respond(response):
+        if response is not None:
+            send(connection, response)
+        cancellations.release(requestUUID)
+    return respond
+
+def send_cancelled(json_data, reason):
+    record_queue_wait(json_data)
+    send(connection, json.dumps({
+        'type': 'CALL_PIPE_RESPONSE',
+        'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+        'pipeId': json_data['pipeId'],
+        'uuid': json_data['uuid'],
+        'error': f'Request cancelled ({reason})',
+        'cancelled': True,
+    }))
+    stages.discard(json_data['uuid'])
+    cancellations.release(json_data['uuid'])
+
+
+def acquire_result(json_data, module, wait=True):
+    """
+    Sends the cached result of a deterministic request. Returns 'hit' when answered,
+    'busy' when an identical request is running and wait is False, otherwise None.
+    """
+    if not result_cache or not hasattr(module, 'result_key'):
+        return None
+    params = module.result_key(json_data['payload'])
+    if params is None:
+        return None
+
+    key = result_cache.key(json_data['pipeId'], params)
+    while True:
+        status = result_cache.acquire(key, wait)
+        if status == 'owner':
+            result_keys[json_data['uuid']] = key
+            return None
+        if status == 'busy':
+            return status
+        response = result_cache.respond(key, json_data['uuid'], CUDA_VISIBLE_DEVICES)
+        if response:
+            log(f'Result cache hit {json_data["uuid"]}')
+            send(connection, response)
+            return status
+
+def store_result(requestUUID, response):
+    key = result_keys.pop(requestUUID, None)
+    if key:
+        result_cache.store(key, response)
+
+def release_result(requestUUID):
+    key = result_keys.pop(requestUUID, None)
+    if key:
+        result_cache.release(key)
+
+def prefix_caches():
+    return [pipe['engine'].prefix_cache for pipe in list(pipes.values()) if 'engine' in pipe and pipe['engine'].prefix_cache]
 
 def check_vram():
     torch.cuda.empty_cache()
     free_vram = torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated()
-    return free_vram
+    # the prefix caches of loaded pipes grow up to their budget, that VRAM is taken already
+    return free_vram - sum(cache.headroom() for cache in prefix_caches())
+
+def shrink_prefix_caches(required):
+    """Gives up to required bytes of prefix cache budget back, largest budgets first. Returns the bytes freed"""
+    freed = 0
+    for cache in sorted(prefix_caches(), key=lambda cache: cache.budget, reverse=True):
+        if freed >= required:
+            break
+        taken = min(cache.budget, required - freed)
+        cache.resize(cache.budget - taken)
+        freed += taken
+    return freed
 
 def free_vram(required_vram, offset = 0.5):
     if not pipes:
@@ -79,191 +260,408 @@ def free_vram(required_vram, offset = 0.5):
 
     log('requiredVRAM with offset ------------------------------------> ' + str(required_vram_with_offset))
 
-    while True:
-        if not pipes:
-            break
+    def available():
         current_vram = check_vram()
         log('Current VRAM ------------------------------------> ' + str(current_vram))
-        if current_vram >= required_vram_with_offset:
-            break
-        pipeId, pipe = pipes.popitem(last=False)  # remove the first inserted item
-        del pipe  # delete the pipe
-        torch.cuda.empty_cache()  # free up the memory
-        log(f'Freed VRAM by DELETING --------------------------------> {pipeId}')
+        return current_vram
 
+    def shrink(missing):
+        # cached prompt prefixes are cheaper to lose than a loaded pipe
+        freed = shrink_prefix_caches(missing)
+        if freed:
+            log(f'Freed VRAM by shrinking prefix caches --------------------------------> {freed}')
+        return freed
+
+    def evict(pipeId):
+        tier = evict_pipe(pipeId)
+        log(f'Freed VRAM by {"DEMOTING" if tier else "DELETING"} ({eviction_policy.name}) --------------------------------> {pipeId}')
+
+    make_room(pipes, eviction_policy, required_vram_with_offset, available, evict, shrink)
     return True
 
 
+def evict_pipe(pipeId):
+    """Frees the VRAM of a loaded pipe, returns 'host' if it was demoted to the host tier"""
+    pipe = pipes.pop(pipeId)
+    if 'engine' in pipe:
+        # let the running generations finish before the weights go away
+        pipe['engine'].stop()
+    prompt_cache.discard(pipeId)
+    # components other loaded pipes still use have to stay on the device, a demoted pipe's are parked
+    shared = components.shared(pipeId)
+    demoted = not shared and host_tier.demote(pipeId, pipe, get_module(pipeId))
+    if not demoted:
+        components.release(pipeId)
+    del pipe  # delete the pipe
+    torch.cuda.empty_cache()  # free up the memory
+    return 'host' if demoted else None
+
+
 def load_pipe(pipeId, requiredVRAM):
-    requiredVRAM = 10*10**12
+    with state_lock:
+        return load_pipe_locked(pipeId, requiredVRAM)
+
+def load_pipe_locked(pipeId, requiredVRAM):
     load_pipe_queue.put(pipeId)
 
     while not load_pipe_queue.empty():
         pipeId = load_pipe_queue.get()
 
         if pipeId in pipes:
+            eviction_policy.on_hit(pipeId)
+            pipes[pipeId]['tier'] = 'device'
             return pipes[pipeId]
 
         log('load ' + pipeId)
 
-        # free only part of the vram
-        free_vram(requiredVRAM, 0.3)
-
-        pipeId_parts = pipeId.split('--')
-        module_path = os.path.join('models', 'pipe', *pipeId_parts, 'index.py')
-        spec = importlib.util.spec_from_file_location("module.name", module_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        pipes[pipeId] = module.load()
+        # free only part of the vram, callers that don't know the size get the one measured on its last load
+        free_vram(requiredVRAM or eviction_policy.estimate(pipeId), 0.3)
+
+        allocated_before = torch.cuda.memory_allocated()
+        staged = preloader.take(pipeId)
+        if pipeId in host_tier:
+            pipe, loaded_in_vram = host_tier.promote(pipeId)
+            pipe.update({'loaded_in_ram': 0, 'loaded_in_vram': loaded_in_vram, 'warmup': 0, 'tier': 'host'})
+        elif staged:
+            # host RAM phase already done by the preloader, only the device transfer is left
+            host_tier.record_miss()
+            start_in_vram = time.time()
+            move_pipe(staged, 'cuda')
+            pipe = staged
+            pipe.update({'loaded_in_vram': round(time.time() - start_in_vram, 2), 'tier': 'preload'})
+        else:
+            host_tier.record_miss()
+            with components.owner(pipeId):
+                pipe = get_module(pipeId).load()
+            pipe['tier'] = 'disk'
+        if compile_cache and 'warmup' not in pipe:
+            pipe['warmup'] = compile_cache.warmup(pipeId, pipe, get_module(pipeId))
+        pipes[pipeId] = pipe
+        eviction_policy.on_load(
+            pipeId,
+            torch.cuda.memory_allocated() - allocated_before,
+            pipes[pipeId]['loaded_in_ram'] + pipes[pipeId]['loaded_in_vram'] + pipes[pipeId].get('warmup', 0)
+        )
         load_pipe_queue.task_done()
 
         return pipes[pipeId]
 
 
-def send(connection, msg):
+def send(connection, msg, attachments=None):
     # log(f'send {msg}')
-    return connection.sendall((msg + '\n').encode())
-
-def receive_all(sock, buffer_size=4096):
-    data = b''
-    while True:
-        part = sock.recv(buffer_size)
-        data += part
-        if len(part) < buffer_size:
-            # either 0 or end of data
-            break
-    return data.decode().split('\n')
+    if queue_waits and isinstance(msg, str) and ('CALL_PIPE_RESPONSE' in msg or '"done"' in msg):
+        msg = with_queue_wait(msg)
+    return connection.send(msg, attachments)
+
+def with_queue_wait(msg):
+    # the final message of a call (its response or the done message of its stream) reports the queue wait
+    data = json.loads(msg)
+    if data.get('type') != 'CALL_PIPE_RESPONSE' and 'done' not in data:
+        return msg
+    wait = queue_waits.pop(data.get('uuid'), None)
+    if wait is None:
+        return msg
+    return json.dumps({**data, 'queueWait': wait})
 
 # handles lite/safe tasks
 def handle_sock2(connection2):
     while True:
-        messages = receive_all(connection2)
-        for message in messages:
-            if message:
-                # log(f'received(2) {message}')        
-                if is_json(message):
-                    json_data = json.loads(message) 
-
-                if 'type' in json_data and json_data['type'] == 'GET_PIPES_REQUEST':
-                    response = json.dumps({
-                        'type': 'GET_PIPES_RESPONSE', 
-                        'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
-                        'pipes': list(pipes.keys()),
-                        'uuid': json_data['uuid']
-                        })
-                    send(connection2, response)
+        messages = connection2.receive()
+        for json_data in messages:
+            # log(f'received(2) {json_data}')
+            if 'type' in json_data and json_data['type'] == 'GET_PIPES_REQUEST':
+                # loads, evictions and deletes change both dicts under state_lock on other threads
+                with state_lock:
+                    loaded = list(pipes.items())
+                    host_pipes = list(host_tier.pipes.keys())
+                response = json.dumps({
+                    'type': 'GET_PIPES_RESPONSE', 
+                    'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+                    'pipes': [pipeId for pipeId, pipe in loaded],
+                    'hostPipes': host_pipes,
+                    'modules': get_modules_stats(),
+                    'cache': eviction_policy.stats(),
+                    'preload': preloader.stats(),
+                    'promptCache': prompt_cache.stats(),
+                    'components': components.stats(),
+                    'resultCache': result_cache.stats() if result_cache else None,
+                    'generation': {pipeId: pipe['engine'].stats() for pipeId, pipe in loaded if 'engine' in pipe},
+                    'stages': stages.stats(len(dispatcher.work) if dispatcher else 0),
+                    'queue': admission.stats(dispatcher.work) if dispatcher else None,
+                    'uuid': json_data['uuid']
+                    })
+                send(connection2, response)
+
+            elif 'type' in json_data and json_data['type'] == 'PRELOAD_PIPE_REQUEST':
+                pipeId = json_data['pipeId']
+                if pipeId in pipes:
+                    status = 'loaded'
+                elif pipeId in host_tier:
+                    status = 'host'
+                else:
+                    status = preloader.request(pipeId)
+                response = json.dumps({
+                    'type': 'PRELOAD_PIPE_RESPONSE',
+                    'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+                    'pipeId': pipeId,
+                    'status': status,
+                    'uuid': json_data['uuid']
+                    })
+                send(connection2, response)
+
+            elif 'type' in json_data and json_data['type'] == 'EVICTION_STATS_REQUEST':
+                response = json.dumps({
+                    'type': 'EVICTION_STATS_RESPONSE',
+                    'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+                    **eviction_policy.stats(detailed=True),
+                    'hostTier': host_tier.stats(),
+                    'uuid': json_data['uuid']
+                    })
+                send(connection2, response)
 
 is_sock2_thread = True
 if is_sock2_thread:
     is_sock2_thread = False
     connection2, client_address2 = sock2.accept()
+    connection2 = SocketChannel(connection2)
     thread = threading.Thread(target=handle_sock2, args=(connection2,))
     thread.daemon = True
     thread.start()
 
-# handles heavy tasks
+def handle_state(json_data):
+    response = json.dumps({
+        'type': 'STATE_RESPONSE', 
+        'uuid': json_data['uuid']
+        })
+    send(connection, response)
+
+def load_pipe_request(json_data):
+    p = load_pipe(json_data['pipeId'], int(json_data.get('requiredVRAM', '0'))) 
+    response = json.dumps({
+        'type': 'LOAD_PIPE_RESPONSE', 
+        'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES, 
+        'pipeId': json_data['pipeId'], 
+        'timeToLoadInRAM': p['loaded_in_ram'], 
+        'timeToLoadInVRAM': p['loaded_in_vram'], 
+        'timeToWarmup': p.get('warmup', 0),
+        'timeToImport': get_import_time(json_data['pipeId']),
+        'tier': p['tier'],
+        'uuid': json_data['uuid'],
+        })
+    send(connection, response)
+
+def delete_pipe(json_data):
+    pipeId = json_data['pipeId']
+    preloader.discard(pipeId)
+    if pipeId in pipes:
+        eviction_policy.on_remove(pipeId)
+        tier = evict_pipe(pipeId)
+        response = json.dumps({
+            'type': 'DELETE_PIPE_RESPONSE', 
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES, 
+            'pipeId': pipeId, 
+            'tier': tier,
+            'uuid': json_data['uuid']
+            })
+    elif pipeId in host_tier:
+        host_tier.remove(pipeId)
+        response = json.dumps({
+            'type': 'DELETE_PIPE_RESPONSE', 
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES, 
+            'pipeId': pipeId, 
+            'tier': None,
+            'uuid': json_data['uuid']
+            })
+    else:
+        response = json.dumps({
+            'type': 'DELETE_PIPE_RESPONSE', 
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES, 
+            'pipeId': pipeId, 
+            'error': 'failure', 
+            'message': 'Model not found', 
+            'uuid': json_data['uuid']
+            })
+    send(connection, response)
+
+def handle_delete(json_data):
+    # stopping an engine and demoting weights block, so they run off the loop
+    threading.Thread(target=delete_pipe_inline, args=(json_data,), daemon=True).start()
+
+def delete_pipe_inline(json_data):
+    """Deletes a pipe the executor is not running right away, an active one ahead of the queued requests"""
+    try:
+        with state_lock:
+            # the executor marks a request active before it loads its pipe
+            active = dispatcher.work.active
+            if not active or active.get('pipeId') != json_data['pipeId']:
+                return delete_pipe(json_data)
+        dispatcher.work.put(json_data, front=True)
+    except Exception as e:
+        log(f'Deleting {json_data["pipeId"]} failed: {e}')
+
+def handle_cancel(json_data):
+    # queued requests are answered right away, running ones stop at their next step or token
+    requestUUID = json_data['requestUUID']
+    reason = json_data.get('reason', 'cancelled')
+    token = cancellations.cancel(requestUUID, reason)
+    queued = dispatcher.work.remove(requestUUID)
+    if queued:
+        log(f'Cancelled queued {requestUUID} ({reason})')
+        send_cancelled(queued, reason)
+    response = json.dumps({
+        'type': 'CANCEL_PIPE_RESPONSE',
+        'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+        'requestUUID': requestUUID,
+        'status': 'queued' if queued else 'running' if token else 'unknown',
+        'uuid': json_data['uuid'],
+        })
+    send(connection, response)
+
+def call_pipe_request(json_data, messages):
+    with cancellations.running(json_data['uuid']) as cancel:
+        pending = call_pipe_cancellable(json_data, messages, cancel)
+    if not pending:
+        cancellations.release(json_data['uuid'])
+
+def call_pipe_cancellable(json_data, messages, cancel):
+    """Runs a call, returns True if it is still pending: submitted to the engine of the pipe or put back"""
+    batch = [json_data]
+    try:
+        cancel.check()
+        if admission.expired(json_data):
+            return send_rejected(json_data, 'expired')
+        record_queue_wait(json_data)
+        start_execution = time.time()
+        module = get_module(json_data['pipeId'])
+        snap_payload(json_data['payload'], module)
+        status = acquire_result(json_data, module)
+        if status == 'hit':
+            return
+        if status == 'busy':
+            # an identical request of this worker is still finishing, answered from its result afterwards
+            messages.append(json_data)
+            return True
+
+        load_pipe(json_data['pipeId'], int(json_data.get('requiredVRAM', '0')))
+
+        if predictor:
+            predictor.observe(json_data['pipeId'])
+            next_pipeId = predictor.predict(json_data['pipeId'])
+            if next_pipeId and next_pipeId not in pipes and next_pipeId not in host_tier:
+                if preloader.request(next_pipeId) == 'unsupported' and WARM_PREDICTED:
+                    weights.warm(next_pipeId)
+
+        if hasattr(module, 'call_batch'):
+            batch = collect_batch(json_data, dispatcher.work, module)
+            deferred = []
+            for request in batch[1:]:
+                if cancellations.cancelled(request['uuid']):
+                    batch.remove(request)
+                    send_cancelled(request, 'cancelled while queued')
+                    continue
+                if admission.expired(request):
+                    batch.remove(request)
+                    send_rejected(request, 'expired')
+                    continue
+                record_queue_wait(request)
+                status = acquire_result(request, module, wait=False)
+                if status:
+                    batch.remove(request)
+                if status == 'busy':
+                    # same params as a running request, answered from its result afterwards
+                    deferred.append(request)
+            messages[:0] = deferred
+
+        if len(batch) > 1:
+            for request, response in zip(batch, call_pipe_batch(json_data['pipeId'], batch)):
+                finish_call(request, response)
+        elif hasattr(module, 'submit'):
+            streamer = create_streamer(connection, send, json_data['uuid'], json_data['payload']) if 'stream' in json_data['payload'] else None
+            submit_pipe(json_data['pipeId'], json_data['payload'], json_data['uuid'], respond_submitted(json_data['uuid']), streamer)
+            # the engine runs it alongside the next requests, only its admission took executor time
+            admission.observe(json_data['pipeId'], time.time() - start_execution)
+            return True
+        elif 'payload' in json_data and 'stream' in json_data['payload']:
+            streamer = create_streamer(connection, send, json_data['uuid'], json_data['payload'])
+            finish_call(json_data, call_pipe(json_data['pipeId'], json_data['payload'], json_data['uuid'], streamer), stream=True)
+        else:
+            response = call_pipe(json_data['pipeId'], json_data['payload'], json_data['uuid'])
+            finish_call(json_data, response)
+        admission.observe(json_data['pipeId'], time.time() - start_execution)
+    except Exception as e:
+        response_data = {
+            'type': 'CALL_PIPE_RESPONSE',
+            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
+            'pipeId': json_data['pipeId'],
+            'uuid': json_data['uuid'],
+        }
+
+        if isinstance(e, Cancelled):
+            response_data['error'] = str(e)
+            response_data['cancelled'] = True
+        elif "CUDA out of memory" in str(e) and os.environ.get("RELOAD_ON_OUT_OF_MEMORY"):
+            # Delete all pipes to free up memory
+            with state_lock:
+                for pipeId in list(pipes):
+                    pipe = pipes[pipeId]
+                    del pipes[pipeId]
+                    if 'engine' in pipe:
+                        # the engine thread holds the model and its KV caches
+                        pipe['engine'].stop()
+                    del pipe
+                    components.release(pipeId)
+                    eviction_policy.on_remove(pipeId)
+            torch.cuda.empty_cache()
+
+            # Attempt to reload the last pipe
+            try:
+                pipe = load_pipe(json_data['pipeId'], int(json_data.get('requiredVRAM', '0')))
+                response_data['error'] = "Job failed (500)"
+            except Exception as e:
+                response_data['error'] = "Job failed (501)"
+                # print('Exiting process due to failure to reload the last pipe after freeing up memory.', flush=True)
+                # os._exit(1)  # Exit the process with an error code
+        else:
+            response_data['error'] = "job failed (502)" if "CUDA out of memory" in str(e) else str(e)
+
+        response = json.dumps(response_data)
+        send(connection, response)
+        for request in batch[1:]:
+            send(connection, json.dumps({**response_data, 'uuid': request['uuid']}))
+
+        for request in batch:
+            release_result(request['uuid'])
+
+        # Check if the error code is 502 and exit the process
+        if response_data['error'] == "job failed (502)":
+            print('Exiting process due to job failure with error code 502.', flush=True)
+            os._exit(1)
+    finally:
+        # inputs prepared for a request answered without running it, a put back one still needs them
+        if json_data not in messages:
+            stages.discard(json_data['uuid'])
+
+def execute(json_data, messages):
+    """Runs a request queued to the GPU executor, requests left in messages are queued again"""
+    if json_data.get('type') == 'LOAD_PIPE_REQUEST':
+        load_pipe_request(json_data)
+    elif json_data.get('type') == 'DELETE_PIPE_REQUEST':
+        with state_lock:
+            delete_pipe(json_data)
+    elif json_data.get('type') == 'CALL_PIPE_REQUEST':
+        call_pipe_request(json_data, messages)
+
+# handles heavy tasks, control messages are answered while a request runs
 connection, client_address = sock.accept()
+connection = SocketChannel(connection)
+dispatcher = Dispatcher(connection, {
+    'STATE_REQUEST': handle_state,
+    'DELETE_PIPE_REQUEST': handle_delete,
+    'CANCEL_PIPE_REQUEST': handle_cancel,
+}, execute, queue_request, priority)
 try:
-    while True:
-        # Wait for a connection
-        # Receive the data in small chunks
-        messages = receive_all(connection)
-        for message in messages:
-            if message:
-                # log(f'received {message}')        
-                if is_json(message):
-                    json_data = json.loads(message) 
-
-                if 'type' in json_data and json_data['type'] == 'STATE_REQUEST':
-                    response = json.dumps({
-                        'type': 'STATE_RESPONSE', 
-                        'uuid': json_data['uuid']
-                        })
-                    send(connection, response)
-
-                elif 'type' in json_data and json_data['type'] == 'LOAD_PIPE_REQUEST':                    
-                    p = load_pipe(json_data['pipeId'], int(json_data.get('requiredVRAM', '0'))) 
-                    response = json.dumps({
-                        'type': 'LOAD_PIPE_RESPONSE', 
-                        'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES, 
-                        'pipeId': json_data['pipeId'], 
-                        'timeToLoadInRAM': p['loaded_in_ram'], 
-                        'timeToLoadInVRAM': p['loaded_in_vram'], 
-                        'uuid': json_data['uuid'],
-                        })
-                    send(connection, response)
-
-                elif 'type' in json_data and json_data['type'] == 'DELETE_PIPE_REQUEST':
-                    pipeId = json_data['pipeId']
-                    if pipeId in pipes:    
-                        pipe = pipes[pipeId]
-                        del pipes[pipeId]
-                        del pipe           
-                        torch.cuda.empty_cache()
-                        response = json.dumps({
-                            'type': 'DELETE_PIPE_RESPONSE', 
-                            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES, 
-                            'pipeId': pipeId, 
-                            'uuid': json_data['uuid']
-                            })
-                    else:
-                        response = json.dumps({
-                            'type': 'DELETE_PIPE_RESPONSE', 
-                            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES, 
-                            'pipeId': pipeId, 
-                            'error': 'failure', 
-                            'message': 'Model not found', 
-                            'uuid': json_data['uuid']
-                            })
-                    send(connection, response)
-
-                elif 'type' in json_data and json_data['type'] == 'CALL_PIPE_REQUEST':
-                    try:
-                        load_pipe(json_data['pipeId'], int(json_data.get('requiredVRAM', '0')))
-
-                        if 'payload' in json_data and 'stream' in json_data['payload']:
-                            streamer = JSONStreamer(connection, send, json_data['uuid'])
-                            call_pipe(json_data['pipeId'], json_data['payload'], json_data['uuid'], streamer)
-                        else:
-                            response = call_pipe(json_data['pipeId'], json_data['payload'], json_data['uuid'])
-                            send(connection, response)
-                    except Exception as e:
-                        response_data = {
-                            'type': 'CALL_PIPE_RESPONSE',
-                            'CUDA_VISIBLE_DEVICES': CUDA_VISIBLE_DEVICES,
-                            'pipeId': json_data['pipeId'],
-                            'uuid': json_data['uuid'],
-                        }
-
-                        if "CUDA out of memory" in str(e) and os.environ.get("RELOAD_ON_OUT_OF_MEMORY"):
-                            # Delete all pipes to free up memory
-                            for pipeId in list(pipes):
-                                pipe = pipes[pipeId]
-                                del pipes[pipeId]
-                                del pipe
-                            torch.cuda.empty_cache()
-
-                            # Attempt to reload the last pipe
-                            try:
-                                pipe = load_pipe(json_data['pipeId'], int(json_data.get('requiredVRAM', '0')))
-                                response_data['error'] = "Job failed (500)"
-                            except Exception as e:
-                                response_data['error'] = "Job failed (501)"
-                                # print('Exiting process due to failure to reload the last pipe after freeing up memory.', flush=True)
-                                # os._exit(1)  # Exit the process with an error code
-                        else:
-                            response_data['error'] = "job failed (502)" if "CUDA out of memory" in str(e) else str(e)
-
-                        response = json.dumps(response_data)
-                        send(connection, response)
-
-                        # Check if the error code is 502 and exit the process
-                        if response_data['error'] == "job failed (502)":
-                            print('Exiting process due to job failure with error code 502.', flush=True)
-                            os._exit(1)
-                    
-                    
+    dispatcher.run()
 finally:
     print('Close', flush=True)
     # Clean up the connection
-    connection.close()
\ No newline at end of file
+    connection.close()
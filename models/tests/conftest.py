@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the worker modules import as top level packages from models/src, as in pipe.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
@@ -0,0 +1,45 @@
+# VRAM made room for a cold load, against a fake device that only counts allocations.
+from common.eviction import LRUPolicy, make_room
+
+GB = 1024 ** 3
+
+
+class Device:
+    def __init__(self, total):
+        self.total = total
+        self.pipes = {}  # pipeId -> bytes allocated
+
+    def free(self):
+        return self.total - sum(self.pipes.values())
+
+    def load(self, policy, pipeId, size):
+        make_room(self.pipes, policy, policy.estimate(pipeId), self.free, self.pipes.pop)
+        self.pipes[pipeId] = size
+        policy.on_load(pipeId, size, 1.0)
+
+
+def test_hot_pipe_survives_a_cold_load_that_fits():
+    device, policy = Device(24 * GB), LRUPolicy()
+    device.load(policy, 'hot', 8 * GB)
+    device.load(policy, 'cold', 4 * GB)
+    policy.on_hit('hot')
+    device.pipes.pop('cold')
+    policy.on_remove('cold')
+
+    # 'cold' was measured on its first load, the 12 GB left are enough for it
+    assert policy.estimate('cold') == 4 * GB
+    device.load(policy, 'cold', 4 * GB)
+    assert set(device.pipes) == {'hot', 'cold'}
+    assert policy.stats()['misses'] == 3
+
+
+def test_cold_load_that_does_not_fit_evicts_the_least_recent():
+    device, policy = Device(24 * GB), LRUPolicy()
+    for pipeId in ('a', 'b', 'c'):
+        device.load(policy, pipeId, 7 * GB)
+    policy.on_hit('a')
+    policy.sizes['big'] = 6 * GB  # measured on an earlier load
+
+    device.load(policy, 'big', 6 * GB)
+    assert set(device.pipes) == {'a', 'c', 'big'}
+    assert [eviction['pipeId'] for eviction in policy.stats(detailed=True)['evictions']] == ['b']
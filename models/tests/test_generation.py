@@ -0,0 +1,202 @@
+# Continuous batching engine against one-request-at-a-time generate(), on CPU with a
+# tiny random Llama. Greedy outputs must match token for token.
+import random
+import threading
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+from common.cancellation import CancelToken
+from common.generation import GenerationEngine, GenerationRequest
+from common.prefix_cache import PrefixCache
+
+VOCAB_SIZE = 256
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+        bos_token_id=None,
+        eos_token_id=None,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def prompts(count, seed=0, min_length=2, max_length=40):
+    rng = random.Random(seed)
+    return [[rng.randrange(3, VOCAB_SIZE) for _ in range(rng.randint(min_length, max_length))] for _ in range(count)]
+
+
+def reference(model, input_ids, max_new_tokens, min_new_tokens=0, eos_token_id=None):
+    with torch.inference_mode():
+        generated = model.generate(
+            torch.tensor([input_ids]),
+            attention_mask=torch.ones((1, len(input_ids)), dtype=torch.long),
+            do_sample=False,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=min_new_tokens,
+            eos_token_id=eos_token_id,
+            pad_token_id=0,
+        )
+    return generated[0, len(input_ids):].tolist()
+
+
+def request(input_ids, max_new_tokens, **kwargs):
+    errors = []
+    generation = GenerationRequest(
+        input_ids,
+        lambda request, error=None: errors.append(error),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        **kwargs,
+    )
+    generation.errors = errors
+    return generation
+
+
+def wait(requests):
+    for generation in requests:
+        assert generation.done.wait(60), 'generation did not finish'
+
+
+class CancellingStreamer:
+    """Cancels the request after it streamed `after` generated tokens"""
+
+    def __init__(self, cancel, after):
+        self.cancel = cancel
+        self.after = after
+        self.tokens = -1  # the prompt is put first
+
+    def put(self, value):
+        self.tokens += 1
+        if self.tokens == self.after:
+            self.cancel.cancel('disconnect')
+
+    def end(self):
+        pass
+
+
+def test_batched_greedy_matches_generate(model):
+    rng = random.Random(1)
+    workload = [(input_ids, rng.randint(1, 24)) for input_ids in prompts(12)]
+    engine = GenerationEngine(model, max_batch_size=4, device='cpu')
+    submitted = [request(input_ids, max_new_tokens) for input_ids, max_new_tokens in workload]
+    for generation in submitted:
+        engine.submit(generation)
+    wait(submitted)
+    engine.stop()
+
+    # with 12 requests of different lengths in a batch of 4, requests joined and left mid-batch
+    assert engine.steps < sum(max_new_tokens for _, max_new_tokens in workload)
+    for generation, (input_ids, max_new_tokens) in zip(submitted, workload):
+        assert generation.errors == [None]
+        assert generation.stopped_by == 'length'
+        assert generation.generated == reference(model, input_ids, max_new_tokens)
+
+
+def test_requests_join_a_running_batch(model):
+    long_prompts, late_prompts = prompts(2, seed=2), prompts(3, seed=3)
+    engine = GenerationEngine(model, max_batch_size=8, device='cpu')
+    running = [request(input_ids, 40) for input_ids in long_prompts]
+    for generation in running:
+        engine.submit(generation)
+
+    joined = []
+    late = [request(input_ids, 8) for input_ids in late_prompts]
+
+    def join_after_first_steps():
+        while engine.steps < 5:
+            threading.Event().wait(0.001)
+        for generation in late:
+            engine.submit(generation)
+        joined.append(not any(generation.done.is_set() for generation in running))
+
+    thread = threading.Thread(target=join_after_first_steps, daemon=True)
+    thread.start()
+    thread.join(60)
+    wait(running + late)
+    engine.stop()
+
+    assert joined == [True], 'the late requests did not join while the batch was running'
+    for generation, input_ids in zip(running, long_prompts):
+        assert generation.generated == reference(model, input_ids, 40)
+    for generation, input_ids in zip(late, late_prompts):
+        assert generation.generated == reference(model, input_ids, 8)
+
+
+def test_eos_and_min_new_tokens(model):
+    input_ids = prompts(1, seed=4)[0]
+    greedy = reference(model, input_ids, 16)
+    eos = greedy[3]
+    stop_at = greedy.index(eos) + 1
+
+    engine = GenerationEngine(model, max_batch_size=4, device='cpu')
+    stopped = request(input_ids, 16, eos_token_ids=[eos])
+    held = request(input_ids, 16, eos_token_ids=[eos], min_new_tokens=stop_at + 2)
+    engine.submit(stopped)
+    engine.submit(held)
+    wait([stopped, held])
+    engine.stop()
+
+    assert stopped.stopped_by == 'eos'
+    assert stopped.generated == greedy[:stop_at]
+    assert stopped.generated == reference(model, input_ids, 16, eos_token_id=eos)
+    # eos is masked until min_new_tokens, the generation goes on differently afterwards
+    assert len(held.generated) >= stop_at + 2
+    assert held.generated == reference(model, input_ids, 16, min_new_tokens=stop_at + 2, eos_token_id=eos)
+
+
+def test_cancelled_request_leaves_the_batch(model):
+    workload = prompts(3, seed=5)
+    engine = GenerationEngine(model, max_batch_size=4, device='cpu')
+    cancel = CancelToken('cancelled')
+    cancelled = request(workload[0], 30, cancel=cancel, streamer=CancellingStreamer(cancel, after=4))
+    others = [request(input_ids, 12) for input_ids in workload[1:]]
+    for generation in [cancelled] + others:
+        engine.submit(generation)
+    wait([cancelled] + others)
+    engine.stop()
+
+    assert cancelled.stopped_by == 'cancelled'
+    assert cancelled.errors == ['Request cancelled (disconnect)']
+    assert cancelled.generated == reference(model, workload[0], 30)[:4]
+    # the rest of the batch is not affected by the request leaving it
+    for generation, input_ids in zip(others, workload[1:]):
+        assert generation.errors == [None]
+        assert generation.generated == reference(model, input_ids, 12)
+
+
+def test_request_cancelled_while_waiting_is_not_prefilled(model):
+    engine = GenerationEngine(model, max_batch_size=4, device='cpu')
+    cancel = CancelToken('waiting')
+    cancel.cancel('timeout')
+    generation = request(prompts(1, seed=6)[0], 10, cancel=cancel)
+    engine.submit(generation)
+    wait([generation])
+    engine.stop()
+
+    assert generation.generated == []
+    assert generation.errors == ['Request cancelled (timeout)']
+
+
+def test_prefix_cache_keeps_outputs(model):
+    system = prompts(1, seed=7, min_length=48, max_length=48)[0]
+    workload = [system + turn for turn in prompts(4, seed=8, max_length=8)]
+    prefix_cache = PrefixCache(64 * 1024 ** 2)
+    engine = GenerationEngine(model, max_batch_size=2, device='cpu', prefix_cache=prefix_cache)
+    submitted = [request(input_ids, 10) for input_ids in workload]
+    for generation in submitted:
+        engine.submit(generation)
+    wait(submitted)
+    engine.stop()
+
+    assert any(generation.cached_tokens >= len(system) for generation in submitted)
+    for generation, input_ids in zip(submitted, workload):
+        assert generation.generated == reference(model, input_ids, 10)
@@ -0,0 +1,32 @@
+# A message that can't be decoded is dropped without wedging the channel.
+import socket
+from common.protocol import SocketChannel, HEADER, FRAME_MAGIC, encode_frame, encode_line
+
+
+def channel():
+    left, right = socket.socketpair()
+    right.close()
+    return SocketChannel(left)
+
+
+def test_bad_line_followed_by_a_good_one():
+    sock = channel()
+    messages = sock.feed(b'{"type": "CALL_PIPE_REQ\n' + encode_line({'type': 'STATE_REQUEST'}))
+    assert messages == [{'type': 'STATE_REQUEST'}]
+    assert sock.buffer == bytearray()
+    assert sock.feed(encode_line({'type': 'CANCEL_PIPE_REQUEST'})) == [{'type': 'CANCEL_PIPE_REQUEST'}]
+
+
+def test_bad_frame_body_followed_by_a_good_frame():
+    sock = channel()
+    bad = HEADER.pack(FRAME_MAGIC, 1, 0, 0, 5) + b'{"typ'
+    messages = sock.feed(bad + encode_frame({'type': 'STATE_REQUEST'}, [b'\x00\x01']))
+    assert messages == [{'type': 'STATE_REQUEST', 'attachments': [b'\x00\x01']}]
+    assert sock.framed
+
+
+def test_bad_frame_version_clears_the_buffer():
+    sock = channel()
+    assert sock.feed(HEADER.pack(FRAME_MAGIC, 9, 0, 0, 1000) + b'garbage') == []
+    assert sock.buffer == bytearray()
+    assert sock.feed(encode_frame({'type': 'STATE_REQUEST'})) == [{'type': 'STATE_REQUEST'}]
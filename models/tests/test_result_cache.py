@@ -0,0 +1,44 @@
+# Two identical seeded requests on one worker: the second waits for the result of the first.
+import json
+import pytest
+from common import images
+from common.dispatcher import WorkQueue
+from common.result_cache import ResultCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(images, 'use_shm', False)
+    (tmp_path / 'tmp_images').mkdir()
+    return ResultCache(str(tmp_path / 'results'), 1024 ** 2)
+
+
+def response(requestUUID):
+    with open(f'tmp_images/{requestUUID}.png', 'wb') as f:
+        f.write(b'\x89PNG seeded image')
+    return json.dumps({'type': 'CALL_PIPE_RESPONSE', 'uuid': requestUUID, 'seed': 42, 'filepath': f'tmp_images/{requestUUID}.png'})
+
+
+def test_identical_seeded_requests_share_one_execution(cache):
+    key = cache.key('stabilityai--sdxl-turbo--default', {'prompt': 'a cat', 'seed': 42})
+    work = WorkQueue()
+    for requestUUID in ('first', 'second'):
+        work.put({'type': 'CALL_PIPE_REQUEST', 'uuid': requestUUID})
+
+    first = work.get()
+    assert cache.acquire(key) == 'owner'
+    # the first one is still finishing, e.g. encoding its image, when the executor takes the second
+    second = work.get()
+    assert cache.acquire(key) == 'busy', 'waiting on a key this worker computes never ends'
+    work.put_back([second])
+    assert len(work) == 1
+
+    cache.store(key, response(first['uuid']))
+    assert work.get() is second
+    assert cache.acquire(key) == 'hit'
+    answer = json.loads(cache.respond(key, second['uuid'], '0'))
+    assert answer['uuid'] == 'second' and answer['cacheHit'] and answer['seed'] == 42
+    with open(answer['filepath'], 'rb') as f:
+        assert f.read() == b'\x89PNG seeded image'
+    assert cache.stats()['hits'] == 1 and cache.stats()['inFlight'] == 0